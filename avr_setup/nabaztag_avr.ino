@@ -34,6 +34,38 @@ const char BOTTOM = 'B';
 const char LEFT = 'L';
 const char RIGHT = 'R';
 const int ZERO_EAR_POS = 0;
+const int EAR_PINS = 17;
+
+/*
+Binary frames are an alternative to the ASCII serial commands:
+
+[SYNC] [OPCODE] [PAYLOAD...] [CHECKSUM]
+
+The size of each frame is fixed by its opcode, and the checksum
+is the XOR of the opcode and payload bytes. Frames are always
+accepted, messages are only sent as frames once the BINARY
+command has been received.
+*/
+const byte FRAME_SYNC = 0xA5;
+const int MAX_FRAME_SIZE = 9;
+
+// Commands: [SYNC] [0x01] [L|R] [0-17] [CHECKSUM]
+//           [SYNC] [0x02] [T|B] [R] [G] [B] [CHECKSUM]
+//           [SYNC] [0x03] [L|R] [0-17] [MS HIGH] [MS LOW] [CHECKSUM]
+//           [SYNC] [0x04] [T|B] [R] [G] [B] [MS HIGH] [MS LOW] [CHECKSUM]
+const byte OP_EARMOV = 0x01;
+const byte OP_LED = 0x02;
+const byte OP_EARMOV_TIMED = 0x03;
+const byte OP_LEDFADE = 0x04;
+
+// Messages: [SYNC] [0x81] [L|R] [0-17] [CHECKSUM]
+//           [SYNC] [0x82] [L|R] [CHECKSUM]
+//           [SYNC] [0x83] [CHECKSUM]
+//           [SYNC] [0x84] [CHECKSUM]
+const byte OP_EAR_POS = 0x81;
+const byte OP_EAR_MOVED = 0x82;
+const byte OP_BUTTON = 0x83;
+const byte OP_INVALID = 0x84;
 
 
 /* GLOBAL VARIABLES */
@@ -44,6 +76,9 @@ volatile long leftInterruptTime;
 volatile long leftLastInterruptTime;
 volatile long leftPulseWidth;
 volatile boolean seenLeftGap;
+volatile int leftEarFinalPosition;
+volatile unsigned long leftStepInterval;
+volatile unsigned long leftNextStepTime;
 
 volatile int rightPinPosition;
 volatile int rightEarTargetPosition;
@@ -51,6 +86,21 @@ volatile long rightInterruptTime;
 volatile long rightLastInterruptTime;
 volatile long rightPulseWidth;
 volatile boolean seenRightGap;
+volatile int rightEarFinalPosition;
+volatile unsigned long rightStepInterval;
+volatile unsigned long rightNextStepTime;
+
+// LED colours, indexed by ledIndex, and the fade in progress on
+// each LED, if its fadeDuration is not 0.
+int ledColor[2][3];
+int fadeFrom[2][3];
+int fadeTo[2][3];
+unsigned long fadeStart[2];
+unsigned long fadeDuration[2];
+
+boolean binaryMode = false;
+byte frame[MAX_FRAME_SIZE];
+int frameLength = 0;
 
 PciListenerImp listener(HEADBUTTON_INTERRUPT, buttonPress);
 SerialCommand serialCommand;
@@ -80,7 +130,10 @@ void setup() {
 
 	// Add Serial Handlers
 	serialCommand.addCommand("LED", LED);
+	serialCommand.addCommand("LEDFADE", LEDFADE);
 	serialCommand.addCommand("EARMOV", EARMOV);
+	serialCommand.addCommand("BINARY", BINARY);
+	serialCommand.addCommand("ASCII", ASCII);
 	serialCommand.setDefaultHandler(INVALID);
 
 	// Turn on IR LED for Rotary Encoders
@@ -100,10 +153,136 @@ void setup() {
 
 
 /*
-Main loop just listens for Serial Commands
+Main loop listens for Serial Commands, passing binary frames,
+which start with FRAME_SYNC, to readFrame. Between commands it
+moves on any LED fades and timed ear movements in progress.
 */
 void loop() {
-	serialCommand.readSerial();
+	if (Serial.available() > 0 && (frameLength > 0 || Serial.peek() == FRAME_SYNC)) {
+		readFrame(Serial.read());
+	} else {
+		serialCommand.readSerial();
+	}
+
+	updateFades();
+	stepEars();
+}
+
+
+/*
+readFrame collects the bytes of a binary frame. Once the whole
+frame has been received, and the checksum matches, the command
+is carried out.
+*/
+void readFrame(byte inByte) {
+	int size;
+
+	frame[frameLength++] = inByte;
+	if (frameLength < 2) {
+		return;
+	}
+
+	size = frameSize(frame[1]);
+	if (size == 0) {
+		frameLength = 0;
+		INVALID(NULL);
+		return;
+	}
+
+	if (frameLength == size) {
+		frameLength = 0;
+		if (frameChecksum(frame + 1, size - 2) != frame[size - 1]) {
+			INVALID(NULL);
+			return;
+		}
+
+		switch(frame[1]){
+			case OP_EARMOV:
+				noInterrupts();
+				moveEar(frame[2], frame[3]);
+				interrupts();
+				break;
+			case OP_LED:
+				setLED(frame[2], frame[3], frame[4], frame[5]);
+				break;
+			case OP_EARMOV_TIMED:
+				noInterrupts();
+				moveEarOver(frame[2], frame[3], (frame[4] << 8) | frame[5]);
+				interrupts();
+				break;
+			case OP_LEDFADE:
+				fadeLED(frame[2], frame[3], frame[4], frame[5], (frame[6] << 8) | frame[7]);
+				break;
+		}
+	}
+}
+
+
+/*
+frameSize returns the total size of a command frame, or 0 if
+the opcode is not a valid command.
+*/
+int frameSize(byte opcode) {
+	switch(opcode){
+		case OP_EARMOV:
+			return 5;
+		case OP_LED:
+			return 7;
+		case OP_EARMOV_TIMED:
+			return 7;
+		case OP_LEDFADE:
+			return 9;
+		default:
+			return 0;
+	}
+}
+
+
+/*
+frameChecksum returns the XOR of the given bytes.
+*/
+byte frameChecksum(byte *data, int length) {
+	byte checksum = 0;
+	for (int i = 0; i < length; i++) {
+		checksum ^= data[i];
+	}
+	return checksum;
+}
+
+
+/*
+sendFrame sends a message frame with the given opcode and payload.
+*/
+void sendFrame(byte opcode, byte *payload, int length) {
+	byte message[MAX_FRAME_SIZE];
+	message[0] = FRAME_SYNC;
+	message[1] = opcode;
+	for (int i = 0; i < length; i++) {
+		message[i + 2] = payload[i];
+	}
+	message[length + 2] = frameChecksum(message + 1, length + 1);
+	Serial.write(message, length + 3);
+}
+
+
+/*
+BINARY is called when receiving the serial command BINARY.
+Messages are sent as binary frames from then on. The reply
+is always sent as JSON, so the sender can tell it was understood.
+*/
+void BINARY() {
+	binaryMode = true;
+	Serial.print("{\"binary\": 1}\n");
+}
+
+
+/*
+ASCII is called when receiving the serial command ASCII.
+Messages are sent as JSON strings from then on.
+*/
+void ASCII() {
+	binaryMode = false;
+	Serial.print("{\"binary\": 0}\n");
 }
 
 
@@ -143,6 +322,155 @@ void LED() {
 		bluefreq = atoi(arg); 
 	}
 
+	setLED(ledPos, redfreq, greenfreq, bluefreq);
+}
+
+
+/*
+LEDFADE is called when receiving serial commands of the form:
+
+LEDFADE [T|B] [0-255] [0-255] [0-255] [0-65535]
+|		 |		 |       |		 |
+pos     R		 G		 B		 ms
+
+The respective LED fades from its current colour to the R, G & B
+values over the given number of milliseconds.
+*/
+void LEDFADE() {
+	char *arg;
+	char ledPos;
+	int redfreq;
+	int greenfreq;
+	int bluefreq;
+	unsigned int duration = 0;
+
+	arg = serialCommand.next();
+	if (arg != NULL) {
+		ledPos = *arg;
+	}
+
+	arg = serialCommand.next();
+	if (arg != NULL) {
+		redfreq = atoi(arg);
+	}
+
+	arg = serialCommand.next();
+	if (arg != NULL) {
+		greenfreq = atoi(arg);
+	}
+
+	arg = serialCommand.next();
+	if (arg != NULL) {
+		bluefreq = atoi(arg);
+	}
+
+	arg = serialCommand.next();
+	if (arg != NULL) {
+		duration = atol(arg);
+	}
+
+	fadeLED(ledPos, redfreq, greenfreq, bluefreq, duration);
+}
+
+
+/*
+setLED sets the colour of the respective LED straight away,
+stopping any fade in progress.
+*/
+void setLED(char ledPos, int redfreq, int greenfreq, int bluefreq) {
+	fadeLED(ledPos, redfreq, greenfreq, bluefreq, 0);
+}
+
+
+/*
+fadeLED starts fading the respective LED from its current colour
+to the R, G & B values. The fade is carried out by updateFades,
+so commands can still be received while it runs. A duration of
+0 sets the colour straight away.
+*/
+void fadeLED(char ledPos, int redfreq, int greenfreq, int bluefreq, unsigned int duration) {
+	int led = ledIndex(ledPos);
+	if (led < 0) {
+		return;
+	}
+
+	for (int i = 0; i < 3; i++) {
+		fadeFrom[led][i] = ledColor[led][i];
+	}
+	fadeTo[led][0] = redfreq;
+	fadeTo[led][1] = greenfreq;
+	fadeTo[led][2] = bluefreq;
+	fadeStart[led] = millis();
+	fadeDuration[led] = duration;
+
+	if (duration == 0) {
+		writeLED(ledPos, redfreq, greenfreq, bluefreq);
+	}
+}
+
+
+/*
+updateFades is called from the main loop, and sets each fading
+LED to the colour it should have reached by now. Colours are
+only written when they change.
+*/
+void updateFades() {
+	const char ledPositions[] = {TOP, BOTTOM};
+	unsigned long now = millis();
+	int color[3];
+
+	for (int led = 0; led < 2; led++) {
+		if (fadeDuration[led] == 0) {
+			continue;
+		}
+
+		unsigned long elapsed = now - fadeStart[led];
+		for (int i = 0; i < 3; i++) {
+			if (elapsed >= fadeDuration[led]) {
+				color[i] = fadeTo[led][i];
+			} else {
+				color[i] = fadeFrom[led][i] + (long) (fadeTo[led][i] - fadeFrom[led][i]) * (long) elapsed / (long) fadeDuration[led];
+			}
+		}
+
+		if (elapsed >= fadeDuration[led]) {
+			fadeDuration[led] = 0;
+		}
+
+		if (color[0] != ledColor[led][0] || color[1] != ledColor[led][1] || color[2] != ledColor[led][2]) {
+			writeLED(ledPositions[led], color[0], color[1], color[2]);
+		}
+	}
+}
+
+
+/*
+ledIndex returns the index of an LED in the colour and fade
+arrays, or -1 if it is not a valid LED.
+*/
+int ledIndex(char ledPos) {
+	switch(ledPos){
+		case TOP:
+			return 0;
+		case BOTTOM:
+			return 1;
+		default:
+			return -1;
+	}
+}
+
+
+/*
+writeLED writes the R, G & B values of the respective LED for PWM.
+*/
+void writeLED(char ledPos, int redfreq, int greenfreq, int bluefreq) {
+	int led = ledIndex(ledPos);
+	if (led >= 0) {
+		ledColor[led][0] = redfreq;
+		ledColor[led][1] = greenfreq;
+		ledColor[led][2] = bluefreq;
+	}
+
 	switch(ledPos){
 		case TOP:
 			analogWrite(TOPLED_RED, redfreq);
@@ -155,24 +483,24 @@ void LED() {
 			analogWrite(BOTTOMLED_BLUE, bluefreq);
 			break;    
 	}
-
 }
 
 
 /*
 EARMOV is called when receiving serial commands of the form:
 
-EARMOV [R|L] [0-17]
-|     |
-pos   pin
+EARMOV [R|L] [0-17] [0-65535]
+|     |      |
+pos   pin    ms (optional)
 
-It unpacks the parameters and calls moveEar with the relevant
-arguments.
+It unpacks the parameters and calls moveEarOver with the relevant
+arguments. Without ms, the ear moves at full speed.
 */
 void EARMOV(){
 	char *arg;
 	char earSide;
 	int targetPin;
+	unsigned int duration = 0;
 
 	arg = serialCommand.next();
 	if (arg != NULL) {
@@ -184,16 +512,97 @@ void EARMOV(){
 		targetPin = atoi(arg);
 	}
 
-	moveEar(earSide, targetPin);
+	arg = serialCommand.next();
+	if (arg != NULL) {
+		duration = atol(arg);
+	}
+
+	noInterrupts();
+	moveEarOver(earSide, targetPin, duration);
+	interrupts();
+}
+
+/*
+moveEar moves an individual ear to a position at full speed,
+stopping any timed movement in progress.
+*/
+void moveEar(char earSide, int targetPosition){
+	moveEarOver(earSide, targetPosition, 0);
+}
+
+
+/*
+moveEarOver moves an individual ear to a position over the given
+number of milliseconds. The motor only runs at one speed, so a
+slower movement is made one pin at a time, with stepEars starting
+each step once the interval for the previous one is up. Only the
+final position is reported. It is also called from interrupt
+routines, so callers in the main loop must disable interrupts.
+*/
+void moveEarOver(char earSide, int targetPosition, unsigned int duration){
+	int rotaryPin = (targetPosition + 2) % EAR_PINS;
+	int steps;
+	switch(earSide){
+		case LEFT:
+			steps = (rotaryPin - leftPinPosition % EAR_PINS + EAR_PINS) % EAR_PINS;
+			leftEarFinalPosition = rotaryPin;
+			leftStepInterval = steps > 1 ? duration / steps : 0;
+			if (leftStepInterval > 0) {
+				leftNextStepTime = millis() + leftStepInterval;
+				startEar(LEFT, (leftPinPosition + 1) % EAR_PINS);
+			} else {
+				startEar(LEFT, rotaryPin);
+			}
+			break;
+		case RIGHT:
+			steps = (rotaryPin - rightPinPosition % EAR_PINS + EAR_PINS) % EAR_PINS;
+			rightEarFinalPosition = rotaryPin;
+			rightStepInterval = steps > 1 ? duration / steps : 0;
+			if (rightStepInterval > 0) {
+				rightNextStepTime = millis() + rightStepInterval;
+				startEar(RIGHT, (rightPinPosition + 1) % EAR_PINS);
+			} else {
+				startEar(RIGHT, rotaryPin);
+			}
+			break;
+	}
 }
 
+
 /*
-moveEar controls movement of an individual ear.
+stepEars is called from the main loop, and starts the next step
+of any timed ear movement whose previous step has finished and
+whose interval is up. The interrupt routines can start a new
+movement at any time, so the step state is read and updated
+with interrupts disabled.
+*/
+void stepEars(){
+	unsigned long now = millis();
+
+	noInterrupts();
+
+	if (leftEarTargetPosition != leftEarFinalPosition && leftPinPosition == leftEarTargetPosition
+			&& (long) (now - leftNextStepTime) >= 0) {
+		leftNextStepTime += leftStepInterval;
+		startEar(LEFT, (leftEarTargetPosition + 1) % EAR_PINS);
+	}
+
+	if (rightEarTargetPosition != rightEarFinalPosition && rightPinPosition == rightEarTargetPosition
+			&& (long) (now - rightNextStepTime) >= 0) {
+		rightNextStepTime += rightStepInterval;
+		startEar(RIGHT, (rightEarTargetPosition + 1) % EAR_PINS);
+	}
+
+	interrupts();
+}
+
+
+/*
+startEar controls movement of an individual ear to a rotary pin.
 The correct interrupt for the ear is enabled, and
 variables for correct functioning of the interrupt are set.
 */
-void moveEar(char earSide, int targetPosition){
-	int rotaryPin = (targetPosition + 2) % 17;
+void startEar(char earSide, int rotaryPin){
 	switch(earSide){
 		case LEFT:
 			attachInterrupt(LEFTEAR_INTERRUPT, moveLeftEar, RISING);
@@ -232,8 +641,11 @@ void moveLeftEar(){
 
 	if(leftPinPosition == leftEarTargetPosition){
 		digitalWrite(LEFTEAR_MOTOR, LOW);
-		sendEarPosition(LEFT, leftPinPosition);
-		attachInterrupt(LEFTEAR_INTERRUPT, leftEarMoved, RISING); 
+		// Between the steps of a timed movement, keep counting pins.
+		if(leftEarTargetPosition == leftEarFinalPosition){
+			sendEarPosition(LEFT, leftPinPosition);
+			attachInterrupt(LEFTEAR_INTERRUPT, leftEarMoved, RISING); 
+		}
 	}
 }
 
@@ -257,8 +669,11 @@ void moveRightEar(){
 
 	if(rightPinPosition == rightEarTargetPosition){
 		digitalWrite(RIGHTEAR_MOTOR, LOW);
-		sendEarPosition(RIGHT, rightPinPosition);
-		attachInterrupt(RIGHTEAR_INTERRUPT, rightEarMoved, RISING); 
+		// Between the steps of a timed movement, keep counting pins.
+		if(rightEarTargetPosition == rightEarFinalPosition){
+			sendEarPosition(RIGHT, rightPinPosition);
+			attachInterrupt(RIGHTEAR_INTERRUPT, rightEarMoved, RISING); 
+		}
 	}
 }
 
@@ -269,9 +684,30 @@ the serial port upon successful positioning.
 */
 void sendEarPosition(char earSide, int rotaryPin){
 	int position = (rotaryPin - 2) % 17;
-	char message[32];
-	sprintf(message, "{\"ear\": \"%c\", \"pos\": %d}\n", earSide, position);
-	Serial.print(message);
+	if (binaryMode) {
+		byte payload[] = {(byte) earSide, (byte) position};
+		sendFrame(OP_EAR_POS, payload, 2);
+	} else {
+		char message[32];
+		sprintf(message, "{\"ear\": \"%c\", \"pos\": %d}\n", earSide, position);
+		Serial.print(message);
+	}
+}
+
+
+/*
+sendEarMoved is used to report that an ear has been moved
+manually over the serial port.
+*/
+void sendEarMoved(char earSide){
+	if (binaryMode) {
+		byte payload[] = {(byte) earSide};
+		sendFrame(OP_EAR_MOVED, payload, 1);
+	} else {
+		char message[32];
+		sprintf(message, "{\"ear\": \"%c\", \"moved\": 1}\n", earSide);
+		Serial.print(message);
+	}
 }
 
 
@@ -281,7 +717,7 @@ It sends a message over the serial connection to say the ear
 has been moved, then resets the ear to upright.
 */
 void leftEarMoved(){
-	Serial.print("{\"ear\": \"L\", \"moved\": 1}\n");
+	sendEarMoved(LEFT);
 	moveEar(LEFT, ZERO_EAR_POS);
 }
 
@@ -292,7 +728,7 @@ It sends a message over the serial connection to say the ear
 has been moved, then resets the ear to upright.
 */
 void rightEarMoved(){
-	Serial.print("{\"ear\": \"R\", \"moved\": 1}\n");
+	sendEarMoved(RIGHT);
 	moveEar(RIGHT, ZERO_EAR_POS);
 }
 
@@ -308,7 +744,11 @@ void buttonPress(byte changeKind) {
     static unsigned long last_interrupt_time = 0;
     unsigned long interrupt_time = millis();
     if (interrupt_time - last_interrupt_time > 200){
-        Serial.print("{\"button\": 1}\n");
+        if (binaryMode) {
+            sendFrame(OP_BUTTON, NULL, 0);
+        } else {
+            Serial.print("{\"button\": 1}\n");
+        }
         moveEar(LEFT, ZERO_EAR_POS);
         moveEar(RIGHT, ZERO_EAR_POS);
     }
@@ -318,8 +758,12 @@ void buttonPress(byte changeKind) {
 
 /*
 INVALID is called when the serial command given doesn't match 
-any available functions.
+any available functions, or a binary frame is not valid.
 */
 void INVALID(const char *command) {
-	Serial.print("{\"invalid\": 1}\n");
+	if (binaryMode) {
+		sendFrame(OP_INVALID, NULL, 0);
+	} else {
+		Serial.print("{\"invalid\": 1}\n");
+	}
 }
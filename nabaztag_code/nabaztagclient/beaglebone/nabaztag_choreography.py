@@ -0,0 +1,90 @@
+import time
+import logging
+import threading
+import collections
+
+
+class Choreographer(threading.Thread):
+
+    """A class which plays choreographies, timed sequences of serial commands, on the Nabaztag.
+
+    Instances of the class should be run as threads using start(). A choreography is given to play() as a
+    list of (seconds, serial command) steps, timed from when play() is called, and each command is placed
+    on the serial_queue queue for the SerialWriter thread when its time comes. Timing is kept on the
+    Nabaztag, so a choreography sent in a single websocket message plays smoothly however the network
+    behaves.
+
+    Playing a choreography replaces the one currently playing, and cancel() stops it.
+    """
+
+    def __init__(self, serial_queue, name):
+
+        """Create an instance of a Choreographer thread.
+
+        :param serial_queue: An instance of CoalescingQueue() or Queue.Queue() to place serial commands on.
+        :param name: The name for the Choreographer thread to identify it in the log.
+        """
+
+        threading.Thread.__init__(self, name=name)
+        self.serial_queue = serial_queue
+        self.steps = collections.deque()
+        self.condition = threading.Condition()
+        self.daemon = True
+
+    def play(self, steps):
+
+        """Start playing a choreography, replacing any which is playing.
+
+        :param steps: A list of (seconds, serial command) tuples, where seconds is the time from now
+        to write the command.
+        """
+
+        start = time.time()
+
+        with self.condition:
+            # Steps due at the same time keep their order.
+            self.steps = collections.deque(
+                sorted(((start + seconds, message) for seconds, message in steps), key=lambda step: step[0])
+            )
+            self.condition.notify()
+
+        logging.info(
+            "{threadname} - Playing {count} steps".format(
+                threadname=self.name,
+                count=len(steps)
+            )
+        )
+
+    def cancel(self):
+
+        """Stop the choreography which is playing, if any.
+        """
+
+        with self.condition:
+            self.steps = collections.deque()
+            self.condition.notify()
+
+    def run(self):
+
+        """Start the Choreographer thread.
+
+        Whilst running, the thread waits until the next step of the current choreography is due, then
+        places its command on the serial_queue queue. If the choreography is replaced or cancelled while
+        waiting, the thread waits for the new one instead.
+        """
+
+        while True:
+            with self.condition:
+                while not self.steps:
+                    self.condition.wait()
+
+                due, message = self.steps[0]
+                delay = due - time.time()
+
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                self.steps.popleft()
+
+            self.serial_queue.put(message)
@@ -5,7 +5,8 @@ import netifaces
 import serial as pyserial
 import Adafruit_BBIO.UART as UART
 
-from nabaztag_serial import SerialWriter, SerialReader
+from nabaztag_serial import SerialWriter, SerialReader, CoalescingQueue, AcknowledgementRelay, negotiate_framing
+from nabaztag_speech import create_speech_queue
 from nabaztag_update import UpdateThread
 from nabaztag_websocket import WSClient
 
@@ -19,11 +20,20 @@ PORT = config['server']['port']
 INTERFACE = config['interface']
 SERIAL = config['serial']['port']
 RATE = config['serial']['rate']
+FRAMING = config['serial'].get('framing', 'ascii')
 
 WS_URL = config['urls']['wsurl']
 POST_URL = config['urls']['posturl']
 
+# Updates are sent over the websocket unless configured to be POSTed.
+UPDATE_TRANSPORT = config.get('updates', {}).get('transport', 'websocket')
+
 LOGFILE = config['logs']['client']
+SPEECH_CACHE = config.get('cache', {}).get('speech', '/var/lib/nabaztag/speech')
+
+# This process owns the serial port, so if the REST API waits for ear positions, they are relayed to it.
+ACKNOWLEDGE = config.get('api', {}).get('acknowledge', False)
+ACK_PORT = config.get('api', {}).get('ack_port', 8001)
 
 # Set up application-wide logging
 logging.basicConfig(
@@ -55,8 +65,9 @@ def main():
     # Serial setup
     UART.setup("UART1")
     serial = pyserial.Serial(port=SERIAL, baudrate=RATE)
+    binary = negotiate_framing(serial, FRAMING)
 
-    serial_queue = Queue.Queue()
+    serial_queue = CoalescingQueue()
     update_queue = Queue.Queue()
 
     serial_write_thread = SerialWriter(
@@ -67,35 +78,39 @@ def main():
 
     serial_read_thread = SerialReader(
         serial,
-        update_queue,
-        name="serialread"
+        AcknowledgementRelay(update_queue, ACK_PORT) if ACKNOWLEDGE else update_queue,
+        name="serialread",
+        binary=binary
     )
 
-    update_thread = UpdateThread(
-        POST_URL.format(
+    websocket_thread = WSClient(
+        WS_URL.format(
             host=HOST,
             port=PORT,
             identifier=getid(INTERFACE)
         ),
+        serial_queue,
         update_queue,
-        name="postupdate"
+        name="websocket",
+        speech_queue=create_speech_queue(SPEECH_CACHE)
     )
+    websocket_thread.binary = binary
 
-    serial_write_thread.start()
-    serial_read_thread.start()
-    update_thread.start()
-
-    websocket_thread = WSClient(
-        WS_URL.format(
+    update_thread = UpdateThread(
+        POST_URL.format(
             host=HOST,
             port=PORT,
             identifier=getid(INTERFACE)
         ),
-        serial_queue,
         update_queue,
-        name="websocket"
+        name="postupdate",
+        websocket=websocket_thread if UPDATE_TRANSPORT == 'websocket' else None
     )
 
+    serial_write_thread.start()
+    serial_read_thread.start()
+    update_thread.start()
+
     websocket_thread.connect()
     websocket_thread.run_forever()
 
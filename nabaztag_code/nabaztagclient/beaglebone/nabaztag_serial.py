@@ -1,8 +1,163 @@
+import time
 import threading
 import logging
 import json
+import socket
+import collections
 import serial as pyserial
 
+# Serial commands which act on a single actuator, where only the latest pending command for it matters,
+# and the actuator they act on. A fade replaces a pending colour change of the same LED, and vice versa.
+COALESCING_COMMANDS = {"EARMOV": "EARMOV", "LED": "LED", "LEDFADE": "LED"}
+
+# Binary frames: [SYNC] [OPCODE] [PAYLOAD...] [CHECKSUM], where the checksum is the XOR of the
+# opcode and payload bytes. See nabaztag_avr.ino for the layout of each frame.
+FRAME_SYNC = 0xA5
+OP_EARMOV = 0x01
+OP_LED = 0x02
+OP_EARMOV_TIMED = 0x03
+OP_LEDFADE = 0x04
+OP_EAR_POS = 0x81
+OP_EAR_MOVED = 0x82
+OP_BUTTON = 0x83
+OP_INVALID = 0x84
+
+# The opcode of the untimed command for the same actuator, by opcode, for coalescing.
+ACTUATOR_OPCODES = {OP_EARMOV_TIMED: OP_EARMOV, OP_LEDFADE: OP_LED}
+
+# Longest duration, in milliseconds, of a timed ear movement or LED fade.
+MAX_DURATION = 65535
+
+# Total size of each message frame sent by the AVR, by opcode.
+MESSAGE_FRAME_SIZES = {OP_EAR_POS: 5, OP_EAR_MOVED: 4, OP_BUTTON: 3, OP_INVALID: 3}
+
+# Serial commands to choose how the AVR sends messages, and how long to wait for its reply.
+BINARY_COMMAND = "BINARY\r\n"
+ASCII_COMMAND = "ASCII\r\n"
+NEGOTIATION_TIMEOUT = 2
+
+# Address the REST API listens on for ear positions reported by the AVR, see AcknowledgementRelay.
+ACK_HOST = "127.0.0.1"
+
+
+class CoalescingQueue(object):
+
+    """A queue of serial commands which keeps only the latest pending command for each actuator.
+
+    It can be used in place of Queue.Queue() for the serial_queue of a SerialWriter. When a command for
+    an actuator (e.g. "LED T ...", "EARMOV L ...") is put while an earlier command for the same actuator
+    is still waiting, the earlier command is replaced in place, keeping its position in the queue.
+    Commands which can't be coalesced are queued as normal.
+    """
+
+    def __init__(self):
+
+        """Create an instance of CoalescingQueue.
+        """
+
+        self.slots = collections.deque()
+        self.pending = {}
+        self.condition = threading.Condition()
+
+    def put(self, message):
+
+        """Place a serial command on the queue, replacing any pending command for the same actuator.
+
+        :param message: The serial command, e.g. "LED T 255 255 255\r\n"
+        """
+
+        key = self.actuator_key(message)
+
+        with self.condition:
+            slot = self.pending.get(key)
+            if slot is not None:
+                slot[1] = message
+            else:
+                slot = [key, message]
+                self.slots.append(slot)
+                if key is not None:
+                    self.pending[key] = slot
+                self.condition.notify()
+
+    def get(self):
+
+        """Remove and return the next serial command, blocking until one is available.
+        """
+
+        with self.condition:
+            while not self.slots:
+                self.condition.wait()
+
+            slot = self.slots.popleft()
+            if self.pending.get(slot[0]) is slot:
+                del self.pending[slot[0]]
+
+            return slot[1]
+
+    def qsize(self):
+
+        """Return the number of serial commands waiting in the queue.
+        """
+
+        with self.condition:
+            return len(self.slots)
+
+    @staticmethod
+    def actuator_key(message):
+
+        """Return the actuator a serial command acts on, e.g. ("LED", "T"), or None if it can't be coalesced.
+
+        :param message: The serial command.
+        """
+
+        if is_frame(message):
+            return ACTUATOR_OPCODES.get(ord(message[1]), ord(message[1])), message[2]
+
+        parts = message.split()
+
+        if len(parts) >= 2 and parts[0] in COALESCING_COMMANDS:
+            return COALESCING_COMMANDS[parts[0]], parts[1]
+
+        return None
+
+
+class AcknowledgementRelay(object):
+
+    """A class which passes ear positions reported by the AVR on to the REST API.
+
+    Only one process can read the serial port, so the client owns it, and an instance is given to its
+    SerialReader thread in place of the update_queue queue. Every message is placed on the update_queue
+    queue as normal, and ear positions are also sent as a UDP datagram to the REST API, for requests
+    waiting to be acknowledged.
+    """
+
+    def __init__(self, update_queue, port):
+
+        """Create an instance of AcknowledgementRelay.
+
+        :param update_queue: An instance of Queue.Queue() to place every message on.
+        :param port: The local UDP port the REST API listens on for acknowledgements.
+        """
+
+        self.update_queue = update_queue
+        self.address = (ACK_HOST, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def put(self, message):
+
+        """Called by the SerialReader thread with each message read from the AVR.
+
+        :param message: The message Dict, e.g. {"ear": "L", "pos": 5}
+        """
+
+        if 'ear' in message and 'pos' in message:
+            try:
+                self.socket.sendto(json.dumps(message), self.address)
+            except socket.error as e:
+                logging.error("Acknowledgement not relayed to the REST API: {error}".format(error=e))
+
+        self.update_queue.put(message)
+
 
 class SerialWriter(threading.Thread):
 
@@ -18,7 +173,8 @@ class SerialWriter(threading.Thread):
         """Create an instance of a SerialWriter thread.
 
             :param port: The serial port to write to, e.g. /dev/ttyO1
-            :param serial_queue: An instance of Queue.Queue() for the SerialWriter thread to receive messages from.
+            :param serial_queue: An instance of CoalescingQueue() or Queue.Queue() for the SerialWriter thread to
+            receive messages from.
             :param name: The name for the SerialWriter thread to identify it in the log.
         """
 
@@ -41,8 +197,7 @@ class SerialWriter(threading.Thread):
                 logging.info(
                     "{threadname} - Message written: {message}".format(
                         threadname=self.name,
-                        # Remove the newline characters from the message or we get lots of blank lines in the logs.
-                        message=message.rstrip('\r\n')
+                        message=describe(message)
                     )
                 )
                 self.port.write(message)
@@ -59,33 +214,38 @@ class SerialReader(threading.Thread):
        the update_queue queue for access from other threads.
     """
 
-    def __init__(self, port, update_queue, name):
+    def __init__(self, port, update_queue, name, binary=False):
 
         """Creates and instance of a SerialReader thread.
 
         :param port: The serial port to write to, e.g. /dev/ttyO1
         :param update_queue: An instance of Queue.Queue() for the SerialReader thread to place messages on.
         :param name: The name for the SerialReader thread to identify it in the log.
+        :param binary: True if the AVR sends messages as binary frames, see negotiate_framing.
         """
 
         threading.Thread.__init__(self, name=name)
         self.port = port
         self.update_queue = update_queue
+        self.binary = binary
 
     def run(self):
 
         """Start the SerialReader thread.
 
-        Whilst running, the thread does a blocking readline from the serial port.
-        When a message is received it is parsed to JSON to confirm it is a valid message,
-        then places on the update_queue queue for access by other threads.
+        Whilst running, the thread does a blocking read from the serial port.
+        When a message is received it is decoded from a binary frame, or parsed from JSON,
+        to confirm it is a valid message, then places on the update_queue queue for access
+        by other threads.
         """
 
         while True:
             try:
-                # Serial messages are delimited by newlines, strip the newline so we don't get blank lines in the log.
-                read = self.port.readline().rstrip('\n')
-                read = json.loads(read)
+                if self.binary:
+                    read = self.read_frame()
+                else:
+                    # Serial messages are delimited by newlines, strip the newline so we don't get blank lines in the log.
+                    read = json.loads(self.port.readline().rstrip('\n'))
                 logging.info(
                     "{threadname} - Message read: {message}".format(
                         threadname=self.name,
@@ -98,10 +258,168 @@ class SerialReader(threading.Thread):
             except pyserial.SerialException as e:
                 log_serial_error(self, "Read from serial port failed.", e)
 
-            # If the serial message is not valid JSON, catch the error and log it, without
-            # passing the message onto the queue.
+            # If the serial message is not valid JSON, or not a valid frame, catch the error and log it,
+            # without passing the message onto the queue.
             except ValueError as e:
-                log_serial_error(self, "Message recieved was not valid JSON.", e)
+                log_serial_error(self, "Message recieved was not valid.", e)
+
+    def read_frame(self):
+
+        """Read a single binary frame from the serial port, and decode it.
+
+        Any bytes before the start of the frame are skipped.
+        """
+
+        while self.port.read(1) != chr(FRAME_SYNC):
+            pass
+
+        opcode = self.port.read(1)
+        if ord(opcode) not in MESSAGE_FRAME_SIZES:
+            raise ValueError("Unknown opcode {0:#04x}".format(ord(opcode)))
+
+        return decode_frame(chr(FRAME_SYNC) + opcode + self.port.read(MESSAGE_FRAME_SIZES[ord(opcode)] - 2))
+
+
+def negotiate_framing(port, framing):
+
+    """Asks the AVR to send messages as binary frames, or as JSON strings.
+
+    :param port: The serial port connected to the AVR. No other thread should be reading from it.
+    :param framing: 'binary' or 'ascii'.
+    :returns: True if the AVR will send binary frames, or False if it will send JSON strings.
+
+    Firmware which doesn't support binary frames replies {"invalid": 1}, in which case JSON strings are used.
+    Any other line read before the reply, e.g. a button press or a partly received message, is skipped.
+    """
+
+    timeout = port.timeout
+    deadline = time.time() + NEGOTIATION_TIMEOUT
+    binary = False
+
+    try:
+        port.flushInput()
+        port.write(BINARY_COMMAND if framing == 'binary' else ASCII_COMMAND)
+
+        while time.time() < deadline:
+            port.timeout = deadline - time.time()
+            try:
+                reply = json.loads(port.readline().rstrip('\n'))
+            except ValueError:
+                continue
+
+            if isinstance(reply, dict) and 'binary' in reply:
+                binary = reply['binary'] == 1
+                break
+            if isinstance(reply, dict) and 'invalid' in reply:
+                break
+        else:
+            logging.error("Serial framing negotiation timed out, using ASCII.")
+    except (AttributeError, pyserial.SerialException) as e:
+        logging.error("Serial framing negotiation failed, using ASCII. Detail: {error}".format(error=e))
+    finally:
+        port.timeout = timeout
+
+    logging.info("Serial framing: {framing}".format(framing='binary' if binary else 'ascii'))
+    return binary
+
+
+def checksum(data):
+
+    """Returns the checksum of a frame's opcode and payload, the XOR of all the bytes.
+
+    :param data: A list of integers.
+    """
+
+    result = 0
+    for byte in data:
+        result ^= byte
+
+    return result
+
+
+def build_frame(opcode, payload):
+
+    """Returns a binary frame as a string of bytes.
+
+    :param opcode: The opcode of the frame, e.g. OP_LED
+    :param payload: A list of integers 0-255.
+    """
+
+    data = [opcode] + payload
+    return ''.join(chr(byte) for byte in [FRAME_SYNC] + data + [checksum(data)])
+
+
+def ear_frame(ear, pos, ms=0):
+
+    """Returns the binary frame equivalent of "EARMOV {ear} {pos}", or "EARMOV {ear} {pos} {ms}" if ms is given.
+    """
+
+    if ms:
+        return build_frame(OP_EARMOV_TIMED, [ord(ear), pos, ms >> 8, ms & 0xFF])
+
+    return build_frame(OP_EARMOV, [ord(ear), pos])
+
+
+def led_frame(led, red, green, blue, ms=0):
+
+    """Returns the binary frame equivalent of "LED {led} {red} {green} {blue}",
+    or "LEDFADE {led} {red} {green} {blue} {ms}" if ms is given.
+    """
+
+    if ms:
+        return build_frame(OP_LEDFADE, [ord(led), red, green, blue, ms >> 8, ms & 0xFF])
+
+    return build_frame(OP_LED, [ord(led), red, green, blue])
+
+
+def is_frame(message):
+
+    """Returns True if the message is a binary frame, rather than an ASCII serial command.
+    """
+
+    return len(message) > 2 and ord(message[0]) == FRAME_SYNC
+
+
+def decode_frame(frame):
+
+    """Decodes a message frame from the AVR to the same Dict as its JSON equivalent.
+
+    :param frame: A string of bytes containing a single frame.
+
+    Raises a ValueError if the checksum doesn't match or the frame isn't a known message.
+    """
+
+    data = [ord(byte) for byte in frame[1:]]
+
+    if len(data) < 2 or checksum(data[:-1]) != data[-1]:
+        raise ValueError("Frame checksum does not match")
+
+    opcode = data[0]
+
+    if opcode == OP_EAR_POS:
+        return {"ear": chr(data[1]), "pos": data[2]}
+    elif opcode == OP_EAR_MOVED:
+        return {"ear": chr(data[1]), "moved": 1}
+    elif opcode == OP_BUTTON:
+        return {"button": 1}
+    elif opcode == OP_INVALID:
+        return {"invalid": 1}
+
+    raise ValueError("Unknown opcode {0:#04x}".format(opcode))
+
+
+def describe(message):
+
+    """Returns a serial command in a form suitable for the log.
+
+    Binary frames are shown as hex, newline characters are removed from ASCII commands
+    so we don't get lots of blank lines in the logs.
+    """
+
+    if is_frame(message):
+        return message.encode('hex')
+
+    return message.rstrip('\r\n')
 
 
 def log_serial_error(self, message, error):
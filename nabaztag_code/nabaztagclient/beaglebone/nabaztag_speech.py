@@ -0,0 +1,405 @@
+import os
+import time
+import uuid
+import Queue
+import select
+import hashlib
+import logging
+import threading
+import subprocess
+import requests
+
+# Commands for the persistent festival process, and for playing its audio. Neither is run through a shell.
+FESTIVAL_COMMAND = ["festival", "--pipe"]
+PLAYER_COMMAND = ["aplay", "-q"]
+
+# Festival is asked to print this after each utterance, so we know the audio file is complete.
+FESTIVAL_DONE = "nabaztag-speech-done"
+
+# Number of seconds to wait for festival to synthesise an utterance, after which it is restarted.
+SYNTHESIS_TIMEOUT = 30
+
+# Number of seconds to wait for audio rendered by the server to download.
+DOWNLOAD_TIMEOUT = 10
+
+# Number of utterances which may wait to be spoken, and the total size of the audio cache in bytes.
+QUEUE_SIZE = 10
+CACHE_SIZE = 20 * 1024 * 1024
+
+
+class SpeechThread(threading.Thread):
+
+    """A class which speaks text given to it through a queue, one utterance at a time.
+
+    Instances of the class should be run as threads using start(). Speech messages placed on the
+    speech_queue queue are downloaded if the server has rendered them, otherwise synthesised by a single,
+    long running festival process, unless the audio cache already has them, then played. The next
+    utterance is prepared while the current one plays, but never plays over it.
+    """
+
+    def __init__(self, speech_queue, cache, name):
+
+        """Create an instance of a SpeechThread.
+
+        :param speech_queue: An instance of Queue.Queue() for the SpeechThread to receive speech messages from,
+        e.g. {"text": "Hello"} or {"text": "Hello", "audio": "http://server/media/speech/<hash>.wav"}
+        :param cache: An instance of SpeechCache, for the synthesised audio.
+        :param name: The name for the SpeechThread to identify it in the log.
+        """
+
+        threading.Thread.__init__(self, name=name)
+        self.speech_queue = speech_queue
+        self.cache = cache
+        self.festival = Festival()
+        self.daemon = True
+
+    def run(self):
+
+        """Start the SpeechThread.
+
+        Whilst running, the thread does a blocking get from the speech_queue queue, then
+        speaks the message, logging any error, expected or not, without stopping the thread.
+        """
+
+        player = None
+
+        while True:
+            message = self.speech_queue.get()
+
+            try:
+                path = self.render(message)
+            except (SpeechError, OSError, IOError) as e:
+                logging.error(
+                    "{threadname} - Speech synthesis failed: {error}".format(
+                        threadname=self.name,
+                        error=e
+                    )
+                )
+                continue
+            except Exception as e:
+                logging.exception(
+                    "{threadname} - Unexpected speech synthesis error: {error}".format(
+                        threadname=self.name,
+                        error=repr(e)
+                    )
+                )
+                continue
+
+            try:
+                # Finish the previous utterance before starting the next.
+                if player is not None:
+                    player.wait()
+
+                player = subprocess.Popen(PLAYER_COMMAND + [path])
+            except OSError as e:
+                logging.error(
+                    "{threadname} - Speech playback failed: {error}".format(
+                        threadname=self.name,
+                        error=e
+                    )
+                )
+                player = None
+            except Exception as e:
+                logging.exception(
+                    "{threadname} - Unexpected speech playback error: {error}".format(
+                        threadname=self.name,
+                        error=repr(e)
+                    )
+                )
+                player = None
+
+    def render(self, message):
+
+        """Returns the path to an audio file of a speech message, downloading or synthesising it if it isn't cached.
+
+        :param message: The speech message Dict.
+        """
+
+        if 'audio' in message:
+            try:
+                return self.download(message['audio'])
+            except requests.exceptions.RequestException as e:
+                logging.error(
+                    "{threadname} - Speech download failed, synthesising instead: {error}".format(
+                        threadname=self.name,
+                        error=e
+                    )
+                )
+
+        text = message['text']
+        path = self.cache.get(text)
+
+        if path is not None:
+            logging.info(
+                u"{threadname} - Speaking from cache: {text}".format(
+                    threadname=self.name,
+                    text=text
+                )
+            )
+            return path
+
+        logging.info(
+            u"{threadname} - Synthesising: {text}".format(
+                threadname=self.name,
+                text=text
+            )
+        )
+
+        temporary_path = self.cache.temporary_path()
+        self.festival.synthesise(text, temporary_path)
+        return self.cache.store(text, temporary_path)
+
+    def download(self, url):
+
+        """Returns the path to audio rendered by the server, downloading it if it isn't cached.
+
+        :param url: The URL of the audio.
+        """
+
+        path = self.cache.get(url)
+
+        if path is not None:
+            return path
+
+        logging.info(
+            "{threadname} - Downloading speech: {url}".format(
+                threadname=self.name,
+                url=url
+            )
+        )
+
+        response = requests.get(url, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+
+        temporary_path = self.cache.temporary_path()
+        with open(temporary_path, 'wb') as audio:
+            audio.write(response.content)
+
+        return self.cache.store(url, temporary_path)
+
+
+class Festival(object):
+
+    """A class which keeps a single festival process running to synthesise speech.
+
+    Starting festival takes longer than synthesising most sentences, so the same process is used for
+    every utterance, and restarted only if it exits, or doesn't finish an utterance in time.
+    """
+
+    def __init__(self):
+
+        """Create an instance of Festival. The process is started when it is first used.
+        """
+
+        self.process = None
+
+    def synthesise(self, text, path):
+
+        """Synthesise speech to a WAV file.
+
+        :param text: The text to speak.
+        :param path: The path of the WAV file to write.
+
+        Raises a SpeechError if festival exits, takes longer than SYNTHESIS_TIMEOUT, or doesn't write the file.
+        """
+
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(FESTIVAL_COMMAND, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        command = u"(utt.save.wave (utt.synth (Utterance Text {text})) {path} 'riff)\n(print {done})\n".format(
+            text=scheme_string(text),
+            path=scheme_string(path),
+            done=scheme_string(FESTIVAL_DONE)
+        )
+
+        try:
+            self.process.stdin.write(command.encode('utf-8'))
+            self.process.stdin.flush()
+            self.wait_until_done()
+        except (IOError, OSError) as e:
+            self.stop()
+            raise SpeechError("Festival stopped: {error}".format(error=e))
+
+        if not os.path.exists(path):
+            raise SpeechError("Festival did not write {path}".format(path=path))
+
+    def wait_until_done(self):
+
+        """Read festival's output until it prints FESTIVAL_DONE.
+
+        The output is read directly from the pipe as it arrives, so a hung festival can't block the
+        SpeechThread for longer than SYNTHESIS_TIMEOUT.
+
+        Raises a SpeechError, having stopped festival, if it exits or doesn't finish in time.
+        """
+
+        stdout = self.process.stdout.fileno()
+        deadline = time.time() + SYNTHESIS_TIMEOUT
+        output = ""
+
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.stop()
+                raise SpeechError("Festival did not finish within {0}s, restarting it".format(SYNTHESIS_TIMEOUT))
+
+            ready, _, _ = select.select([stdout], [], [], remaining)
+            if not ready:
+                continue
+
+            chunk = os.read(stdout, 4096)
+            if not chunk:
+                code = self.process.wait()
+                self.process = None
+                raise SpeechError("Festival exited with code {code}".format(code=code))
+
+            output += chunk
+            if FESTIVAL_DONE in output:
+                return
+
+            # Only the end of the output can hold the start of the marker.
+            output = output[-len(FESTIVAL_DONE):]
+
+    def stop(self):
+
+        """Kill the festival process, if it is running, so the next utterance starts a new one.
+        """
+
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+        self.process = None
+
+
+class SpeechCache(object):
+
+    """A class which keeps synthesised audio on disk, evicting the least recently spoken when it grows too large.
+
+    Files are named by a hash of their key, the text synthesised or the URL downloaded, and their
+    modification time is updated each time they are spoken, so it survives restarts.
+    """
+
+    def __init__(self, directory, max_size=CACHE_SIZE):
+
+        """Create an instance of SpeechCache, creating its directory if needed.
+
+        :param directory: The directory to keep the audio files in.
+        :param max_size: The maximum total size of the audio files, in bytes.
+        """
+
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+
+        """Returns the path of the cached audio for the key, or None if it isn't cached.
+
+        :param key: The text spoken, or the URL of audio rendered by the server.
+        """
+
+        path = self.path(key)
+
+        with self.lock:
+            try:
+                os.utime(path, None)
+            except OSError:
+                return None
+
+        return path
+
+    def store(self, key, temporary_path):
+
+        """Move new audio into the cache, returning its path.
+
+        :param key: The text spoken, or the URL of audio rendered by the server.
+        :param temporary_path: The path the audio was written to, from temporary_path()
+        """
+
+        path = self.path(key)
+
+        with self.lock:
+            os.rename(temporary_path, path)
+            self.evict(keep=path)
+
+        return path
+
+    def evict(self, keep=None):
+
+        """Delete the least recently spoken audio files until the cache is within its maximum size.
+
+        :param keep: The path of a file not to delete, e.g. the one about to be played.
+        """
+
+        entries = []
+
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.wav'):
+                path = os.path.join(self.directory, filename)
+                status = os.stat(path)
+                entries.append((status.st_mtime, status.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+
+    def path(self, key):
+
+        """Returns the path of the audio file for the key.
+        """
+
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.wav')
+
+    def temporary_path(self):
+
+        """Returns a unique path in the cache directory to synthesise audio to.
+        """
+
+        return os.path.join(self.directory, uuid.uuid4().hex + '.tmp')
+
+
+class SpeechError(Exception):
+
+    """Raised when speech can't be synthesised.
+    """
+
+    pass
+
+
+def create_speech_queue(cache_directory, name="speech"):
+
+    """Start a SpeechThread, returning the queue to place speech messages on.
+
+    :param cache_directory: The directory to cache synthesised audio in.
+    :param name: The name for the SpeechThread to identify it in the log.
+    """
+
+    speech_queue = Queue.Queue(maxsize=QUEUE_SIZE)
+    SpeechThread(speech_queue, SpeechCache(cache_directory), name=name).start()
+
+    return speech_queue
+
+
+def scheme_string(text):
+
+    """Returns text as a quoted, unicode Scheme string for festival, so it can't be read as a command.
+
+    :param text: The text to quote, either unicode or a UTF-8 encoded str.
+    """
+
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+
+    return u'"' + text.replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u' ') + u'"'
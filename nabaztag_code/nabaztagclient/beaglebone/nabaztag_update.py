@@ -1,54 +1,120 @@
 import threading
 import json
 import logging
+import socket
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Seconds to wait for the server to accept the connection, and to respond.
+TIMEOUT = (5, 10)
+
+# Retry failed connections with an exponential backoff of 0.5s, 1s, 2s...
+RETRIES = 3
+BACKOFF = 0.5
 
 
 class UpdateThread(threading.Thread):
 
     """A class enabling updates from interactions with the Nabaztag to be sent to the server.
 
-    Messages to be sent to the server are read from the update_queue queue, and posted
-    to the corresponding URL on the server. Due to limitations with django-websocket-redis,
-    it was decided that POSTing was the simplest way to implement communication back to the server.
-    Ideally, the websocket would be used correctly (bi-directionally) and updates would be sent to
-    the server over the same websocket connection as commands are received from.
+    Messages to be sent to the server are read from the update_queue queue. If a websocket is given,
+    they are sent to the server over the same websocket connection as commands are received from.
+    Otherwise, or if the websocket isn't connected, they are posted to the corresponding URL on the server.
     """
 
-    def __init__(self, url, update_queue, name):
+    def __init__(self, url, update_queue, name, websocket=None):
 
         """Create an instance of the UpdateThread class
 
         :param url: The base portion of the URL to post updates to.
         :param name: The name of the thread to identify it in the logs.
+        :param websocket: An instance of WSClient to send updates over, or None to always POST updates.
         """
 
         threading.Thread.__init__(self, name=name)
         self.update_queue = update_queue
         self.post_url = url
+        self.websocket = websocket
+        self.session = create_session()
 
     def run(self):
 
         """Start the UpdateThread thread.
 
         Whilst running, the UpdateThread does a blocking get from the update_queue queue
-        and posts the message as the JSON body of the request, logging the message sent
-        and the response received.
+        and sends each update to the server.
         """
 
         # Tell the server to expect JSON content in the body of the request.
-        headers = {'content-type': 'application/json'}
+        self.session.headers.update({'content-type': 'application/json'})
 
         while True:
             update = self.update_queue.get()
             url = self.generate_url(update, self.post_url)
-            if url is not None:
-                response = requests.post(
-                    url,
-                    data=json.dumps(update),
-                    headers=headers
+            if url is not None and not self.send_over_websocket(update):
+                self.post_update(update, url)
+
+    def send_over_websocket(self, update):
+
+        """Send an update to the server over the websocket, logging the message sent.
+
+        :param update: The update message to send.
+        :returns: True if the update was sent, or False if it must be POSTed instead.
+        """
+
+        if self.websocket is None or self.websocket.terminated:
+            return False
+
+        try:
+            self.websocket.send(json.dumps(update))
+        except (socket.error, RuntimeError) as e:
+            logging.error(
+                "{threadname} - Failed to send {update} over websocket, POSTing instead. Detail: {error}".format(
+                    threadname=self.name,
+                    update=json.dumps(update),
+                    error=e
+                )
+            )
+            return False
+
+        logging.info(
+            "{threadname} - Sent {update} over websocket".format(
+                threadname=self.name,
+                update=json.dumps(update)
+            )
+        )
+        return True
+
+    def post_update(self, update, url):
+
+        """POST an update to the server as the JSON body of the request, logging the message sent
+        and the response received.
+
+        Updates are posted using a long-lived session, so the connection to the server is
+        kept alive between updates rather than being re-established each time.
+
+        :param update: The update message to send.
+        :param url: The URL to POST the update to.
+        """
+
+        try:
+            response = self.session.post(
+                url,
+                data=json.dumps(update),
+                timeout=TIMEOUT
+            )
+            self.log_update_reponse(update, response.json(), url)
+        # If the server can't be reached, or its response isn't valid JSON, log it and carry on.
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error(
+                "{threadname} - Failed to POST {update} to {url}. Detail: {error}".format(
+                    threadname=self.name,
+                    update=json.dumps(update),
+                    url=url,
+                    error=e
                 )
-                self.log_update_reponse(update, response.json(), url)
+            )
 
     @staticmethod
     def generate_url(update, baseurl):
@@ -90,4 +156,19 @@ class UpdateThread(threading.Thread):
                 threadname=self.name,
                 response=json.dumps(response)
             )
-        )
\ No newline at end of file
+        )
+
+
+def create_session():
+
+    """Create a requests Session for posting updates to the server.
+
+    The session pools and reuses connections, and retries connections which fail with an exponential backoff.
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=Retry(total=RETRIES, read=0, backoff_factor=BACKOFF))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
@@ -1,18 +1,39 @@
 import json
+import Queue
 import logging
-import subprocess
-import time
+import urlparse
+import threading
 import requests
 
 from ws4py.client.threadedclient import WebSocketClient
+from nabaztag_serial import MAX_DURATION, ear_frame, led_frame
+from nabaztag_choreography import Choreographer
 
 
 # String templates for serial commands
 EAR_SERIAL_STRING = "EARMOV {ear} {pos:d}\r\n"
 LED_SERIAL_STRING = "LED {led} {red:d} {green:d} {blue:d}\r\n"
 
-# Location API
+# String templates for ear movements and LED changes made over a number of milliseconds by the AVR
+EAR_TIMED_SERIAL_STRING = "EARMOV {ear} {pos:d} {ms:d}\r\n"
+LED_FADE_SERIAL_STRING = "LEDFADE {led} {red:d} {green:d} {blue:d} {ms:d}\r\n"
+
+# Location API, and the number of seconds to wait for it to respond
 LOCATION_API = "http://localhost/nabaztag/api/location"
+LOCATION_TIMEOUT = 30
+
+# Maximum number of steps in a choreography
+MAX_CHOREOGRAPHY_STEPS = 500
+
+# Choreography played when the connection is first opened: reset the ears, with the LEDs green until they have
+INITIALISE_CHOREOGRAPHY = [
+    {'at': 0, 'ear': 'L', 'pos': 0},
+    {'at': 0, 'ear': 'R', 'pos': 0},
+    {'at': 0, 'led': 'T', 'red': 0, 'green': 255, 'blue': 0},
+    {'at': 0, 'led': 'B', 'red': 0, 'green': 255, 'blue': 0},
+    {'at': 5200, 'led': 'T', 'red': 0, 'green': 0, 'blue': 0},
+    {'at': 5200, 'led': 'B', 'red': 0, 'green': 0, 'blue': 0},
+]
 
 
 class WSClient(WebSocketClient):
@@ -30,27 +51,39 @@ class WSClient(WebSocketClient):
     3. The connection is closed.
     """
 
-    def __init__(self, url, serial_queue, update_queue, name):
+    def __init__(self, url, serial_queue, update_queue, name, speech_queue=None):
 
         """Create an instance of a WSClient
 
         :param url: The url of the websocket server, e.g. ws://echo.websocket.org
-        :param serial_queue: An instance of Queue.Queue(), messages for the AVR are placed in this queue.
+        :param serial_queue: An instance of CoalescingQueue(), messages for the AVR are placed in this queue.
         :param update_queue: An instance of Queue.Queue(), messages to be sent to the server are placed in this queue.
         :param name: The name of the thread for identification in the logs.
+        :param speech_queue: An instance of Queue.Queue(), speech messages for a SpeechThread are placed in this queue.
         """
 
         super(WSClient, self).__init__(url)
         self.serial_queue = serial_queue
         self.update_queue = update_queue
+        self.speech_queue = speech_queue
         self.name = name
 
+        # Set to True once the AVR has agreed to binary framing, see nabaztag_serial.negotiate_framing
+        self.binary = False
+
+        # Background tasks scheduled for the current connection, cancelled when it closes
+        self.tasks = []
+
+        # Plays timed sequences of commands, see choreograph()
+        self.choreographer = Choreographer(serial_queue, name="choreography")
+        self.choreographer.start()
+
     def opened(self):
 
         """Called once when the websocket connection is first opened.
 
-        Creates and starts an instance of InitThread to initialise the Nabaztag,
-        and logs the websocket connection details.
+        Initialises the Nabaztag and schedules an update of its location on the server, and logs
+        the websocket connection details. Neither blocks, so messages can be received immediately.
         """
 
         logging.info(
@@ -60,8 +93,9 @@ class WSClient(WebSocketClient):
             )
         )
 
+        self.cancel_tasks()
         self.initialise()
-        self.update_server_location()
+        self.schedule(0, self.update_server_location)
 
     def received_message(self, message):
 
@@ -69,7 +103,11 @@ class WSClient(WebSocketClient):
 
         The message is logged, then, if it is intended for the ears or leds it is converted
         to a serial command and sent to the AVR via the SerialWriter thread, or if it is a
-        text-to-speech command, the festival text-to-speech service is called as a subprocess
+        text-to-speech command, the text is passed to the SpeechThread via the speech_queue queue.
+
+        A batch message, e.g. {"batch": [{"ear": "L", "pos": 0}, {"ear": "R", "pos": 0}]}, is
+        unpacked and each of the commands it contains is handled in order. A choreography message
+        is played by the Choreographer thread, see choreograph().
         """
 
         message = message.data
@@ -80,18 +118,77 @@ class WSClient(WebSocketClient):
             )
         )
 
+        # If the message received can't be parsed to JSON, or isn't a command or batch, log it.
         try:
             message = json.loads(message)
-            if 'speak' in message:
-                subprocess.Popen('echo '+message['text']+'|festival --tts', shell=True)
-            else:
-                self.serial_queue.put(self.json_to_serial(message))
-        # If the message received can't be parsed to JSON, log it.
-        except ValueError as e:
+            commands = message.get('batch', [message])
+            if not isinstance(commands, list):
+                raise ValueError("batch must be a list of commands")
+        except (ValueError, AttributeError) as e:
+            self.log_error(e)
+            return
+
+        # Each command in a batch is handled on its own, so one invalid command doesn't stop the rest.
+        for command in commands:
+            try:
+                self.handle_command(command)
+            except (ValueError, TypeError, AttributeError, KeyError, InvalidSerialCommandError) as e:
+                self.log_error(e)
+
+    def handle_command(self, command):
+
+        """Act on a single command received on the websocket connection.
+
+        :param command: The command Dict, e.g. {"ear": "L", "pos": 0}
+
+        Raises an InvalidSerialCommandError, or a ValueError, TypeError, AttributeError or KeyError if the
+        command is not valid.
+        """
+
+        if 'speak' in command:
+            self.speak(command)
+        elif 'choreography' in command:
+            self.choreograph(command['choreography'])
+        else:
+            self.serial_queue.put(self.json_to_serial(command, self.binary))
+
+    def log_error(self, error):
+
+        """Log an invalid message received on the websocket connection.
+
+        :param error: The Exception raised by the message.
+        """
+
+        logging.error(
+            "{threadname} - Error: {error}".format(
+                threadname=self.name,
+                error=error
+            )
+        )
+
+    def speak(self, command):
+
+        """Queue a speech message to be spoken, dropping it if too much speech is already waiting.
+
+        :param command: The speech message, e.g. {"speak": 1, "text": "Hello"}. If the server has rendered the
+        speech, the message also contains the path of the audio, e.g. "/media/speech/<hash>.wav"
+        """
+
+        message = {'text': command['text']}
+
+        # Audio is served over HTTP by the same host as the websocket.
+        if 'audio' in command:
+            message['audio'] = urlparse.urljoin(self.url.replace('ws', 'http', 1), command['audio'])
+
+        try:
+            if self.speech_queue is None:
+                raise Queue.Full()
+            self.speech_queue.put_nowait(message)
+        except Queue.Full:
             logging.error(
-                "{threadname} - Error: {error}".format(
+                u"{threadname} - Speech dropped: {text}".format(
                     threadname=self.name,
-                    error=e.message
+                    text=message['text']
                 )
             )
 
@@ -110,24 +207,77 @@ class WSClient(WebSocketClient):
             )
         )
 
+        self.cancel_tasks()
+        self.choreographer.cancel()
+
+    def choreograph(self, frames):
+
+        """Play a choreography, replacing any which is playing.
+
+        :param frames: A list of ear and LED commands, each with the number of milliseconds from the start
+        of the choreography to run it at, e.g. [{"at": 0, "ear": "L", "pos": 5}, {"at": 500, "ear": "L", "pos": 0}]
+        An empty list cancels the choreography which is playing.
+
+        Every frame is converted to a serial command before any is played, so an invalid choreography
+        is logged and doesn't play at all.
+        """
+
+        try:
+            if len(frames) > MAX_CHOREOGRAPHY_STEPS:
+                raise ValueError("More than {0} steps".format(MAX_CHOREOGRAPHY_STEPS))
+            steps = [(frame['at'] / 1000.0, self.json_to_serial(frame, self.binary)) for frame in frames]
+        except (KeyError, TypeError, ValueError, InvalidSerialCommandError) as e:
+            logging.error(
+                "{threadname} - Invalid choreography: {error}".format(
+                    threadname=self.name,
+                    error=e
+                )
+            )
+            return
+
+        if steps:
+            self.choreographer.play(steps)
+        else:
+            self.choreographer.cancel()
+
+    def schedule(self, delay, function):
+
+        """Run a function in the background after a delay, unless the connection closes first.
+
+        :param delay: The number of seconds to wait before running the function.
+        :param function: The function to run.
+        :returns: The threading.Timer running the function.
+        """
+
+        task = threading.Timer(delay, function)
+        task.daemon = True
+        self.tasks = [t for t in self.tasks if t.is_alive()] + [task]
+        task.start()
+
+        return task
+
+    def cancel_tasks(self):
+
+        """Cancel any background tasks which haven't run yet.
+        """
+
+        for task in self.tasks:
+            task.cancel()
+
+        self.tasks = []
+
     def initialise(self):
         """Defines the behaviour of the Nabaztag when the websocket connection is first established.
 
-        The initialisation procedure is:
+        The initialisation procedure, INITIALISE_CHOREOGRAPHY, is:
         1. Reset the ears to their zero position.
         2. Set both LEDs to green while the ears are resetting.
-        """
+        3. Turn the LEDs off once the ears have reset.
 
-        # Zero Ears
-        self.serial_queue.put(EAR_SERIAL_STRING.format(ear='L', pos=0))
-        self.serial_queue.put(EAR_SERIAL_STRING.format(ear='R', pos=0))
+        It is played as a choreography, so nothing waits for it.
+        """
 
-        # Green lights for duration of ear movements
-        self.serial_queue.put(LED_SERIAL_STRING.format(led='T', red=0, green=255, blue=0))
-        self.serial_queue.put(LED_SERIAL_STRING.format(led='B', red=0, green=255, blue=0))
-        time.sleep(5.2)
-        self.serial_queue.put(LED_SERIAL_STRING.format(led='T', red=0, green=0, blue=0))
-        self.serial_queue.put(LED_SERIAL_STRING.format(led='B', red=0, green=0, blue=0))
+        self.choreograph(INITIALISE_CHOREOGRAPHY)
 
     def update_server_location(self):
 
@@ -135,7 +285,16 @@ class WSClient(WebSocketClient):
         """
 
         # Send location to the server
-        location = requests.get(LOCATION_API).json()
+        try:
+            location = requests.get(LOCATION_API, timeout=LOCATION_TIMEOUT).json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error(
+                "{threadname} - Location API unavailable: {error}".format(
+                    threadname=self.name,
+                    error=e
+                )
+            )
+            location = {"status": 503}
 
         # If the location API is unavailable, tell the server the location is unavailable
         if 'status' in location and location['status'] == 503:
@@ -145,26 +304,45 @@ class WSClient(WebSocketClient):
         self.update_queue.put(location)
 
     @staticmethod
-    def json_to_serial(json_message):
+    def json_to_serial(json_message, binary=False):
 
         """Helper function to convert the JSON commands to Serial commands.
 
-        :param json_message: A valid JSON object.
+        :param json_message: A valid JSON object. Ear and LED commands may include "ms", the number of
+        milliseconds the AVR should take to move the ear or fade the LED, e.g. {"led": "T", ..., "ms": 1000}
+        :param binary: True to return a binary frame rather than an ASCII serial command.
 
         Raises an InvalidSerialCommandError if the JSON object is not a valid command format.
         """
 
-        if 'ear' in json_message:
-            serial_message = EAR_SERIAL_STRING.format(
+        ms = json_message.get('ms', 0)
+
+        if not isinstance(ms, int) or ms < 0 or ms > MAX_DURATION:
+            raise InvalidSerialCommandError("Value of ms not in range 0-{0}".format(MAX_DURATION))
+
+        if 'ear' in json_message and binary:
+            serial_message = ear_frame(json_message['ear'], json_message['pos'], ms)
+        elif 'ear' in json_message:
+            serial_message = (EAR_TIMED_SERIAL_STRING if ms else EAR_SERIAL_STRING).format(
                 ear=json_message['ear'],
-                pos=json_message['pos']
+                pos=json_message['pos'],
+                ms=ms
+            )
+        elif 'led' in json_message and binary:
+            serial_message = led_frame(
+                json_message['led'],
+                json_message['red'],
+                json_message['green'],
+                json_message['blue'],
+                ms
             )
         elif 'led' in json_message:
-            serial_message = LED_SERIAL_STRING.format(
+            serial_message = (LED_FADE_SERIAL_STRING if ms else LED_SERIAL_STRING).format(
                 led=json_message['led'],
                 red=json_message['red'],
                 green=json_message['green'],
-                blue=json_message['blue']
+                blue=json_message['blue'],
+                ms=ms
             )
         else:
             raise InvalidSerialCommandError("Invalid JSON command, can't convert to serial command")
@@ -1,39 +1,147 @@
 import threading
-import json
+import logging
+import Queue
 import RPi.GPIO as GPIO
 import time
 
 PRESSED = 1
 BUTTON_PIN = 7
 
+# Number of seconds the button must settle for after an edge before its level is read.
+DEBOUNCE = 0.05
+
+# Number of seconds the button must be held for a long press, or 0 to report every press as a single press.
+LONG_PRESS = 1.0
+
+# Number of seconds after a press in which a second press makes a double press, or 0 to disable double presses,
+# in which case single presses are reported as soon as the button is released.
+DOUBLE_PRESS = 0
+
+# Updates for each kind of press, "press" says which it was. The server (views.button_pressed) doesn't read
+# "press" yet, so double and long presses currently act the same as a single press.
+SINGLE_PRESS_UPDATE = {"button": 1}
+DOUBLE_PRESS_UPDATE = {"button": 1, "press": "double"}
+LONG_PRESS_UPDATE = {"button": 1, "press": "long"}
+
 
 class ButtonThread(threading.Thread):
 
     """A class to monitor the status of the button on the pi.
 
-    Enables access to button status without blocking update thread.
+    Enables access to button status without blocking update thread. The button is watched with edge
+    detection, so the thread sleeps until the button changes, rather than polling it.
     """
 
-    def __init__(self, update_queue, name):
+    def __init__(self, update_queue, name, debounce=DEBOUNCE, long_press=LONG_PRESS, double_press=DOUBLE_PRESS):
 
         """Create an instance of the ButtonThread class.
 
         :params update_queue: An instance of Queue.Queue() to place button press updates onto.
         :params name: The name of the thread for identification in the logs.
+        :params debounce: The number of seconds to let the button settle after each edge.
+        :params long_press: The number of seconds the button must be held for a long press, or 0 to disable them.
+        :params double_press: The number of seconds to wait for a second press, or 0 to disable double presses.
         """
 
         threading.Thread.__init__(self, name=name)
         self.update_queue = update_queue
-        
+        self.debounce = debounce
+        self.long_press = long_press
+        self.double_press = double_press
+        self.edges = Queue.Queue()
+        self.daemon = True
+
     def run(self):
 
         """Start the ButtonThread thread.
 
-        Polls the button input pin for high state, waits half a second after detecting a button press to debounce.
+        Edges on the button input pin are passed to this thread by the GPIO library's own thread. Whilst
+        running, the thread sleeps until an edge arrives, or until a long press or double press window is up,
+        then reads the settled level of the button and places an update on the update_queue queue for
+        each completed press.
+        """
+
+        GPIO.add_event_detect(BUTTON_PIN, GPIO.BOTH, callback=self.edges.put)
+
+        pressed = False
+        pressed_at = None
+        long_sent = False
+        clicks = 0
+        released_at = None
+
+        while True:
+            try:
+                self.edges.get(timeout=self.next_deadline(pressed, pressed_at, long_sent, clicks, released_at))
+            except Queue.Empty:
+                now = time.time()
+                if pressed and not long_sent and self.long_press and now - pressed_at >= self.long_press:
+                    self.send(LONG_PRESS_UPDATE)
+                    long_sent = True
+                    clicks = 0
+                elif not pressed and clicks and now - released_at >= self.double_press:
+                    self.send(SINGLE_PRESS_UPDATE)
+                    clicks = 0
+                continue
+
+            if self.settled_level() == pressed:
+                continue
+
+            pressed = not pressed
+            now = time.time()
+
+            if pressed:
+                pressed_at = now
+                long_sent = False
+            elif not long_sent:
+                clicks += 1
+                released_at = now
+                if not self.double_press:
+                    self.send(SINGLE_PRESS_UPDATE)
+                    clicks = 0
+                elif clicks == 2:
+                    self.send(DOUBLE_PRESS_UPDATE)
+                    clicks = 0
+
+    def next_deadline(self, pressed, pressed_at, long_sent, clicks, released_at):
+
+        """Returns the number of seconds until a press needs to be reported without another edge, or None to wait
+        for the next edge indefinitely.
+        """
+
+        if pressed and not long_sent and self.long_press:
+            return max(pressed_at + self.long_press - time.time(), 0)
+
+        if not pressed and clicks:
+            return max(released_at + self.double_press - time.time(), 0)
+
+        return None
+
+    def settled_level(self):
+
+        """Returns True if the button is pressed once it has settled, discarding the edges caused by bouncing.
         """
 
+        time.sleep(self.debounce)
+
         while True:
-            if GPIO.input(BUTTON_PIN) == PRESSED:
-                press = json.loads('{"button": 1}')
-                self.update_queue.put(press)
-                time.sleep(0.5)
\ No newline at end of file
+            try:
+                self.edges.get_nowait()
+            except Queue.Empty:
+                break
+
+        return GPIO.input(BUTTON_PIN) == PRESSED
+
+    def send(self, update):
+
+        """Place a button press update on the update_queue queue, and log it.
+
+        :param update: The update Dict, e.g. {"button": 1}
+        """
+
+        logging.info(
+            "{threadname} - Button pressed: {update}".format(
+                threadname=self.name,
+                update=update
+            )
+        )
+        self.update_queue.put(dict(update))
@@ -7,7 +7,7 @@ import atexit
 
 from pi_update import UpdateThread
 from pi_websocket import WSClient
-from pi_button import ButtonThread
+from pi_button import ButtonThread, BUTTON_PIN, DEBOUNCE, LONG_PRESS, DOUBLE_PRESS
 
 # Load settings from configuration file
 config_file = open('/etc/nabaztag/nabaztagconfig.yaml', 'r')
@@ -20,8 +20,16 @@ INTERFACE = config['interface']
 WS_URL = config['urls']['wsurl']
 POST_URL = config['urls']['posturl']
 
+# Updates are sent over the websocket unless configured to be POSTed.
+UPDATE_TRANSPORT = config.get('updates', {}).get('transport', 'websocket')
+
 LOGFILE = config['logs']['client']
 
+# Timings used to tell single, double and long presses of the button apart, in seconds.
+BUTTON_DEBOUNCE = config.get('button', {}).get('debounce', DEBOUNCE)
+BUTTON_LONG_PRESS = config.get('button', {}).get('long_press', LONG_PRESS)
+BUTTON_DOUBLE_PRESS = config.get('button', {}).get('double_press', DOUBLE_PRESS)
+
 # Set up logging
 logging.basicConfig(
     filename=LOGFILE,
@@ -59,9 +67,18 @@ def main():
         GPIO.output(LEDS[x], False)
 
     # Setup Button input
-    GPIO.setup(7, GPIO.IN)
+    GPIO.setup(BUTTON_PIN, GPIO.IN)
     post_queue = Queue.Queue()
 
+    websocket_thread = WSClient(
+        WS_URL.format(
+            host=HOST,
+            port=PORT,
+            identifier=getid(INTERFACE)
+        ),
+        name="websocket"
+    )
+
     update_thread = UpdateThread(
         POST_URL.format(
             host=HOST,
@@ -69,26 +86,21 @@ def main():
             identifier=getid(INTERFACE)
         ),
         post_queue,
-        name="postupdate"
+        name="postupdate",
+        websocket=websocket_thread if UPDATE_TRANSPORT == 'websocket' else None
     )
                                  
     button_thread = ButtonThread(
         post_queue,
-        name="button"
+        name="button",
+        debounce=BUTTON_DEBOUNCE,
+        long_press=BUTTON_LONG_PRESS,
+        double_press=BUTTON_DOUBLE_PRESS
     )
 
     update_thread.start()
     button_thread.start()
 
-    websocket_thread = WSClient(
-        WS_URL.format(
-            host=HOST,
-            port=PORT,
-            identifier=getid(INTERFACE)
-        ),
-        name="websocket"
-    )
-
     websocket_thread.connect()
     websocket_thread.run_forever()
 
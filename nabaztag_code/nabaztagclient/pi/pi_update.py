@@ -1,31 +1,42 @@
 import threading
 import json
 import logging
+import socket
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Seconds to wait for the server to accept the connection, and to respond.
+TIMEOUT = (5, 10)
+
+# Retry failed connections with an exponential backoff of 0.5s, 1s, 2s...
+RETRIES = 3
+BACKOFF = 0.5
 
 
 class UpdateThread(threading.Thread):
 
     """A class enabling updates from interactions with the Nabaztag to be sent to the server.
 
-    Messages to be sent to the server are read from the update_queue queue, and posted
-    to the corresponding URL on the server. Due to restrictions with django-websocket-redis,
-    it was decided that POSTing was the simplest way to implement communication back to the server.
-    Ideally, the websocket would be used correctly (bi-directionally) and updates would be sent to
-    the server over the same websocket connection as commands are received from.
+    Messages to be sent to the server are read from the update_queue queue. If a websocket is given,
+    they are sent to the server over the same websocket connection as commands are received from.
+    Otherwise, or if the websocket isn't connected, they are posted to the corresponding URL on the server.
     """
 
-    def __init__(self, url, update_queue, name):
+    def __init__(self, url, update_queue, name, websocket=None):
 
         """Create an instance of the UpdateThread class
 
         :param url: The base portion of the URL to post updates to.
         :param name: The name of the thread to identify it in the logs.
+        :param websocket: An instance of WSClient to send updates over, or None to always POST updates.
         """
 
         threading.Thread.__init__(self, name=name)
         self.update_queue = update_queue
         self.post_url = url
+        self.websocket = websocket
+        self.session = create_session()
 
     def run(self):
 
@@ -34,35 +45,49 @@ class UpdateThread(threading.Thread):
         Whilst running, the UpdateThread does a blocking get from the update_queue queue, determines
         the URL suffix that messages should be posted to, and posts the message as the JSON body of
         the request, logging the message sent and the response received.
+
+        Updates are posted using a long-lived session, so the connection to the server is
+        kept alive between updates rather than being re-established each time.
         """
 
         # Tell the server to expect JSON content in the body of the request.
-        headers = {'content-type': 'application/json'}
+        self.session.headers.update({'content-type': 'application/json'})
 
         while True:
             update = self.update_queue.get()
 
             if "moved" in update:
-                r = requests.post(
-                    self.post_url + 'ear',
-                    data=json.dumps(update),
-                    headers=headers
-                )
-                self.log(json.dumps(update), r.text)
+                self.post(self.post_url + 'ear', update)
             if "button" in update:
-                r = requests.post(
-                    self.post_url + 'button',
-                    data=json.dumps(update),
-                    headers=headers
-                )
-                self.log(json.dumps(update), r.text)
+                self.post(self.post_url + 'button', update)
             if "location" in update:
-                r = requests.post(
-                    self.post_url + 'location',
-                    data=json.dumps(update),
-                    headers=headers
-                )
-                self.log(json.dumps(update), r.text)
+                self.post(self.post_url + 'location', update)
+
+    def post(self, url, update):
+
+        """Send an update to the server, logging the response.
+
+        The update is sent over the websocket if there is one, otherwise it is posted using the
+        UpdateThread's session. If the server can't be reached, the error is logged instead.
+        """
+
+        if self.websocket is not None and not self.websocket.terminated:
+            try:
+                self.websocket.send(json.dumps(update))
+                self.log(json.dumps(update), "Sent over websocket")
+                return
+            except (socket.error, RuntimeError) as e:
+                self.log(json.dumps(update), e)
+
+        try:
+            r = self.session.post(
+                url,
+                data=json.dumps(update),
+                timeout=TIMEOUT
+            )
+            self.log(json.dumps(update), r.text)
+        except requests.exceptions.RequestException as e:
+            self.log(json.dumps(update), e)
 
     def log(self, message, response):
 
@@ -80,4 +105,19 @@ class UpdateThread(threading.Thread):
                 threadname=self.name,
                 response=response
             )
-        )
\ No newline at end of file
+        )
+
+
+def create_session():
+
+    """Create a requests Session for posting updates to the server.
+
+    The session pools and reuses connections, and retries connections which fail with an exponential backoff.
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=Retry(total=RETRIES, read=0, backoff_factor=BACKOFF))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
@@ -37,6 +37,7 @@ class WSClient(WebSocketClient):
         """Called each time a message is received on the websocket connection.
 
         The message is logged, then a LEDBlinkThread is created to illuminate the relevant LEDs.
+        A batch message is unpacked and each of the commands it contains is handled in order.
         """
 
         try:
@@ -44,13 +45,14 @@ class WSClient(WebSocketClient):
             logging.info(threading.current_thread().name + " - " + json.dumps(message))
             LEDS = [4, 17, 22, 10, 9, 11]
 
-            if 'ear' in message:
-                if message['ear'] == "L":
-                    blinker = LEDThread(LEDS[0:3], 5, "leftledblinker")
-                    blinker.start()
-                elif message['ear'] == "R":
-                    blinker = LEDThread(LEDS[3:6], 5, "rightledblinker")
-                    blinker.start()
+            for command in message.get('batch', [message]):
+                if 'ear' in command:
+                    if command['ear'] == "L":
+                        blinker = LEDThread(LEDS[0:3], 5, "leftledblinker")
+                        blinker.start()
+                    elif command['ear'] == "R":
+                        blinker = LEDThread(LEDS[3:6], 5, "rightledblinker")
+                        blinker.start()
         except ValueError as e:
             logging.error(
                 "{threadname} - Error: {error}".format(
@@ -1,10 +1,26 @@
 from wifi import Cell
 import json
+import logging
+import os
+import threading
+import time
 import requests
 
 GOOGLE_LOCATION_URL = 'https://www.googleapis.com/geolocation/v1/geolocate?key={0}'
 GOOGLE_API_KEY = ''
 JSON_REQUEST_HEADERS = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+REQUEST_TIMEOUT = 10
+
+# A cached location is returned without scanning for SCAN_TTL seconds. After that, a new scan is done,
+# but Google is only asked again if the cached location is older than LOCATION_TTL seconds, or if less
+# than SIMILARITY_THRESHOLD of the access points visible now were also visible then.
+SCAN_TTL = 300
+LOCATION_TTL = 24 * 60 * 60
+SIMILARITY_THRESHOLD = 0.5
+
+# Cached locations, shared between GeoLocate instances, by cache file.
+_caches = {}
+_caches_lock = threading.Lock()
 
 
 class GeoLocate():
@@ -13,16 +29,20 @@ class GeoLocate():
 
     The MAC addresses of nearby Wi-Fi access points are passed to Google's
     Geolocation API, which returns a reasonably accurate latitude and longitude.
+    The location is cached, along with the access points it was found from, so that
+    Google is only asked again once the Nabaztag has moved.
     """
 
-    def __init__(self, interface):
+    def __init__(self, interface, cache_file=None):
 
         """Create an instance of the GeoLocate class.
 
         :params interface: The Wi-Fi interface to use for scanning, e.g. 'wlan0'
+        :params cache_file: The file to persist the cached location to, or None to only cache it in memory.
         """
 
         self.interface = interface
+        self.cache = get_cache(cache_file)
 
     def get_location(self):
 
@@ -35,19 +55,38 @@ class GeoLocate():
         or another error occurs, a LocationError is raised.
         """
 
-        # Get full information for all visible access points
-        networks = Cell.all(self.interface)
-        addresses = []
+        location = self.cache.recent()
+        if location is not None:
+            return location
+
+        # Get full information for all visible access points, and extract just the MAC addresses
+        addresses = set(network.address for network in Cell.all(self.interface))
+
+        location = self.cache.match(addresses)
+        if location is None:
+            location = self.lookup(addresses)
+            self.cache.store(addresses, location)
+
+        return location
+
+    @staticmethod
+    def lookup(addresses):
+
+        """Asks Google's Geolocation API for the location of a set of access points.
 
-        # Extract just the MAC addresses
-        for network in networks:
-            addresses.append({'macAddress': network.address})
+        :params addresses: A set of access point MAC addresses.
+        :returns: a Dict containing the lat & lon for the location.
+        """
 
-        json_response = requests.post(
-            GOOGLE_LOCATION_URL.format(GOOGLE_API_KEY),
-            data=json.dumps({'wifiAccessPoints': addresses}),
-            headers=JSON_REQUEST_HEADERS
-        ).json()
+        try:
+            json_response = requests.post(
+                GOOGLE_LOCATION_URL.format(GOOGLE_API_KEY),
+                data=json.dumps({'wifiAccessPoints': [{'macAddress': address} for address in addresses]}),
+                headers=JSON_REQUEST_HEADERS,
+                timeout=REQUEST_TIMEOUT
+            ).json()
+        except (requests.exceptions.RequestException, ValueError):
+            raise LocationError("Unable to determine location")
 
         # Handle Google returning an error.
         if "error" in json_response:
@@ -59,5 +98,110 @@ class GeoLocate():
             }
 
 
+class LocationCache():
+
+    """A class holding the last known location, and the access points visible when it was found.
+
+    The cache is persisted as JSON to a file, if one is given, so it survives restarts.
+    """
+
+    def __init__(self, path):
+
+        """Create an instance of the LocationCache class, loading the cached location from path if it exists.
+
+        :params path: The file to persist the cache to, or None.
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.entry = None
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    self.entry = json.load(cache_file)
+            except (IOError, ValueError) as e:
+                logging.error("Could not load location cache {path}: {error}".format(path=path, error=e))
+
+    def recent(self):
+
+        """Returns the cached location if the access points were scanned in the last SCAN_TTL seconds, or None.
+        """
+
+        with self.lock:
+            if self.entry is not None and time.time() - self.entry['scanned'] < SCAN_TTL:
+                return self.entry['location']
+
+    def match(self, addresses):
+
+        """Returns the cached location if it is still valid for the given access points, or None.
+
+        :params addresses: A set of the access point MAC addresses visible now.
+        """
+
+        with self.lock:
+            if self.entry is None or time.time() - self.entry['located'] > LOCATION_TTL:
+                return None
+
+            if similarity(addresses, set(self.entry['addresses'])) < SIMILARITY_THRESHOLD:
+                return None
+
+            self.entry['scanned'] = time.time()
+            self.save()
+            return self.entry['location']
+
+    def store(self, addresses, location):
+
+        """Caches a new location, and the access points it was found from.
+
+        :params addresses: A set of access point MAC addresses.
+        :params location: A Dict containing the lat & lon for the location.
+        """
+
+        with self.lock:
+            now = time.time()
+            self.entry = {'addresses': sorted(addresses), 'location': location, 'scanned': now, 'located': now}
+            self.save()
+
+    def save(self):
+
+        """Writes the cache to its file. Failures are logged, as the in-memory cache is still usable.
+        """
+
+        if self.path is None:
+            return
+
+        try:
+            with open(self.path + '.tmp', 'w') as cache_file:
+                json.dump(self.entry, cache_file)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as e:
+            logging.error("Could not save location cache {path}: {error}".format(path=self.path, error=e))
+
+
 class LocationError(Exception):
     pass
+
+
+def get_cache(path):
+
+    """Returns the LocationCache for the given file, shared by all GeoLocate instances using it.
+
+    :params path: The file to persist the cache to, or None.
+    """
+
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = LocationCache(path)
+        return _caches[path]
+
+
+def similarity(first, second):
+
+    """Returns the proportion of access points in either set which are in both, between 0 and 1.
+    """
+
+    if not first and not second:
+        return 1.0
+
+    return len(first & second) / float(len(first | second))
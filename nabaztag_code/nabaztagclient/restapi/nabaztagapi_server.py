@@ -1,24 +1,33 @@
-# Flask imports
+# Tornado server imports
 import re
-from flask import Flask, jsonify
-from flask.ext.restful import Api, Resource, reqparse
-import flask_restful
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler
 
 
 # Serial imports for AVR communication
+import os
+import sys
+import Queue
+import errno
+import socket
+import threading
+import collections
 import Adafruit_BBIO.UART as UART
-import subprocess
 import serial as pyserial
 
+# The serial threads are shared with the Beaglebone client.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from beaglebone.nabaztag_serial import ACK_HOST, MAX_DURATION, SerialWriter
+from beaglebone.nabaztag_speech import create_speech_queue
+
 # API imports
 from nabaztagapi_geolocate import GeoLocate, LocationError
 from nabaztagapi_weather import Weather, WeatherError
 
-# Tornado server imports
-from tornado.wsgi import WSGIContainer
-from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
-
 # Other imports
 import logging
 import json
@@ -27,6 +36,8 @@ import yaml
 # Templates for serial commands
 EAR_SERIAL_STRING = "EARMOV {ear} {pos}\r\n"
 LED_SERIAL_STRING = "LED {led} {red} {green} {blue}\r\n"
+EAR_TIMED_SERIAL_STRING = "EARMOV {ear} {pos} {ms}\r\n"
+LED_FADE_SERIAL_STRING = "LEDFADE {led} {red} {green} {blue} {ms}\r\n"
 
 # Dicts to convert URL slugs to serial parameters
 ears = {"left": "L", "right": "R"}
@@ -40,6 +51,26 @@ INTERFACE = config['interface']
 SERIAL = config['serial']['port']
 RATE = config['serial']['rate']
 LOGFILE = config['logs']['api']
+LOCATION_CACHE = config.get('cache', {}).get('location')
+SPEECH_CACHE = config.get('cache', {}).get('speech', '/var/lib/nabaztag/speech')
+
+# Serial commands waiting to be written to the AVR, beyond which requests are refused with a 429.
+QUEUE_SIZE = config.get('api', {}).get('queue_size', 16)
+
+# If set, ear requests are only answered once the AVR reports the ear has reached its position,
+# or with a 504 after ACK_TIMEOUT seconds. The client owns the serial port for reading, and relays
+# the positions to ACK_PORT.
+ACKNOWLEDGE = config.get('api', {}).get('acknowledge', False)
+ACK_TIMEOUT = config.get('api', {}).get('ack_timeout', 5)
+ACK_PORT = config.get('api', {}).get('ack_port', 8001)
+
+# Every serial command is written by a single SerialWriter thread, so concurrent requests can't
+# interleave their bytes on the UART.
+serial_queue = Queue.Queue(maxsize=QUEUE_SIZE)
+
+# Slow work (Wi-Fi scans, requests to Google and openweathermap) is run on this pool of threads,
+# so that the IOLoop is free to handle other requests in the meantime.
+executor = ThreadPoolExecutor(max_workers=4)
 
 # Set up logging
 logging.basicConfig(
@@ -51,39 +82,209 @@ logging.basicConfig(
 )
 
 
-############ REST API Resource Classes ############
+############ Serial Acknowledgements ############
+
+class Acknowledgements(object):
+
+    """A class which matches ear positions reported by the AVR to the requests waiting for them.
+
+    The serial port is only read by the client, which relays ear positions as UDP datagrams, see
+    AcknowledgementRelay. listen() passes each of them to put() on the IOLoop.
+    """
+
+    def __init__(self):
+
+        """Create an instance of Acknowledgements.
+        """
+
+        self.waiting = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def expect(self, ear):
+
+        """Returns a Future which is resolved with the position the ear next reports.
+
+        :param ear: The ear, e.g. "L"
+        """
+
+        future = Future()
+        with self.lock:
+            self.waiting[ear].append(future)
+
+        return future
+
+    def discard(self, ear, future):
+
+        """Stop waiting for an ear, e.g. if the request timed out.
+
+        :param ear: The ear passed to expect.
+        :param future: The Future returned by expect.
+        """
+
+        with self.lock:
+            if future in self.waiting[ear]:
+                self.waiting[ear].remove(future)
+
+    def listen(self, port, io_loop):
+
+        """Start receiving ear positions relayed by the client.
+
+        :param port: The local UDP port to listen on.
+        :param io_loop: The IOLoop to receive them on.
+        """
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+        self.socket.bind((ACK_HOST, port))
+        io_loop.add_handler(self.socket.fileno(), self.receive, io_loop.READ)
+
+    def receive(self, fd, events):
+
+        """Called by the IOLoop when relayed ear positions are waiting to be read.
+        """
+
+        while True:
+            try:
+                datagram = self.socket.recv(4096)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.error("Acknowledgement not received: {error}".format(error=e))
+                return
+
+            try:
+                self.put(json.loads(datagram))
+            except (ValueError, TypeError) as e:
+                logging.error("Acknowledgement not valid: {error}".format(error=e))
+
+    def put(self, message):
+
+        """Called with each ear position relayed by the client.
+
+        :param message: The message Dict, e.g. {"ear": "L", "pos": 5}
+        """
+
+        if 'ear' not in message or 'pos' not in message:
+            return
+
+        with self.lock:
+            futures = self.waiting.pop(message['ear'], [])
+
+        for future in futures:
+            future.set_result(message['pos'])
+
+
+acknowledgements = Acknowledgements()
+
+
+############ REST API Request Handler Classes ############
+
+class NabaztagHandler(RequestHandler):
+
+    """A base class for the API's request handlers, which all respond with JSON.
+    """
 
-class NabaztagEar(Resource):
+    def respond(self, body, status):
+
+        """Write a JSON response.
+
+        :param body: A Dict to send as the JSON body of the response.
+        :param status: The HTTP status code of the response.
+        """
+
+        self.set_status(status)
+        self.write(body)
+
+    def send_command(self, command):
+
+        """Queue a serial command to be written to the AVR.
+
+        :param command: The serial command, e.g. "LED T 255 255 255\r\n"
+        :returns: True if the command was queued, or False if a 429 response has been written.
+        """
+
+        try:
+            serial_queue.put_nowait(command)
+        except Queue.Full:
+            logging.warning("Serial queue full, refused: {command}".format(command=command.rstrip('\r\n')))
+            self.set_header('Retry-After', '1')
+            self.respond({"status": 429, "message": "Too many commands waiting, try again later."}, 429)
+            return False
+
+        logging.info(command.rstrip('\r\n'))
+        return True
+
+    def parse_args(self, arguments):
+
+        """Extract arguments from the JSON body of the request, or from its form values.
+
+        :param arguments: A list of (name, type, help) tuples, where help is the error message
+        returned if the argument is missing or not of the right type. An optional argument is
+        given as a (name, type, help, default) tuple.
+        :returns: A Dict of the arguments, or None if a 400 response has been written.
+        """
+
+        try:
+            body = json.loads(self.request.body) if self.request.body else {}
+        except ValueError:
+            body = {}
+
+        if not isinstance(body, dict):
+            body = {}
+
+        args = {}
+
+        for argument in arguments:
+            name, argument_type, help_message = argument[:3]
+            value = body.get(name, self.get_argument(name, None))
+            try:
+                if value is None and len(argument) > 3:
+                    args[name] = argument[3]
+                    continue
+                if value is None:
+                    raise ValueError(name)
+                args[name] = argument_type(value)
+            except (TypeError, ValueError):
+                self.respond({"status": 400, "message": help_message}, 400)
+                return None
+
+        return args
+
+
+class NabaztagEar(NabaztagHandler):
 
     """A class to make the Nabaztag's ears available through a RESTful API.
     """
 
-    parser = reqparse.RequestParser()
-    parser.add_argument('pos', type=int, required=True, help="Invalid or no position specified for ear")
+    arguments = [
+        ('pos', int, "Invalid or no position specified for ear"),
+        ('ms', int, "Invalid value specified for ms", 0),
+    ]
 
+    @gen.coroutine
     def put(self, ear):
 
         """Called when a PUT request is made to /nabaztag/api/ear/<string:ear>
 
         :param ear: The ear to move.
-        :returns: An HTTP response.
 
         The value given in the body is extracted and checked that is is both an int
-        (done automatically by RequestParser), and in the range 0-17. The request
-        is logged, and the serial command is sent to the AVR
+        (done by parse_args), and in the range 0-17. If ms is given, the AVR takes that
+        many milliseconds to move the ear. The request is logged, and the serial command
+        is queued for the AVR. If ACKNOWLEDGE is set, the response waits until the AVR
+        reports the ear's new position.
         """
 
-        args = self.parser.parse_args()
+        args = self.parse_args(self.arguments)
+        if args is None:
+            return
 
         if args['pos'] < 0 or args['pos'] > 17:
-            return {"status": 400, "message": "Value of pos not in range 0-17."}, 400
+            self.respond({"status": 400, "message": "Value of pos not in range 0-17."}, 400)
+            return
 
-        serial.write(
-            EAR_SERIAL_STRING.format(
-                ear=ears[ear],
-                pos=str(args['pos'])
-            )
-        )
+        if args['ms'] < 0 or args['ms'] > MAX_DURATION:
+            self.respond({"status": 400, "message": "Value of ms not in range 0-{0}.".format(MAX_DURATION)}, 400)
+            return
 
         logging.info(
             "Parameters: {body}".format(
@@ -91,39 +292,60 @@ class NabaztagEar(Resource):
             )
         )
 
-        logging.info(
-            EAR_SERIAL_STRING.format(
-                ear=ears[ear],
-                pos=str(args['pos'])
-            ).rstrip('\r\n')
-        )
+        # Start waiting for the position before queueing the command, so that the report can't be missed.
+        acknowledgement = acknowledgements.expect(ears[ear]) if ACKNOWLEDGE else None
 
-        return {"status": 201, "message": "Success"}, 201
+        if args['ms']:
+            command = EAR_TIMED_SERIAL_STRING.format(ear=ears[ear], pos=args['pos'], ms=args['ms'])
+        else:
+            command = EAR_SERIAL_STRING.format(ear=ears[ear], pos=str(args['pos']))
 
+        if not self.send_command(command):
+            if acknowledgement is not None:
+                acknowledgements.discard(ears[ear], acknowledgement)
+            return
 
-class NabaztagLED(Resource):
+        if acknowledgement is None:
+            self.respond({"status": 201, "message": "Success"}, 201)
+            return
+
+        try:
+            # A timed movement is only reported once it has finished.
+            timeout = timedelta(seconds=ACK_TIMEOUT, milliseconds=args['ms'])
+            pos = yield gen.with_timeout(timeout, acknowledgement)
+            self.respond({"status": 201, "message": "Success", "pos": pos}, 201)
+        except gen.TimeoutError:
+            acknowledgements.discard(ears[ear], acknowledgement)
+            self.respond({"status": 504, "message": "Ear did not report its position in time."}, 504)
+
+
+class NabaztagLED(NabaztagHandler):
 
     """A class to make the Nabaztag's LEDs available through a RESTful API.
     """
 
-    parser = reqparse.RequestParser()
-    parser.add_argument('red', type=int, required=True, help="Invalid or no value specified for red")
-    parser.add_argument('green', type=int, required=True, help="Invalid or no value specified for green")
-    parser.add_argument('blue', type=int, required=True, help="Invalid or no value specified for blue")
+    arguments = [
+        ('red', int, "Invalid or no value specified for red"),
+        ('green', int, "Invalid or no value specified for green"),
+        ('blue', int, "Invalid or no value specified for blue"),
+        ('ms', int, "Invalid value specified for ms", 0),
+    ]
 
     def put(self, led):
 
         """Called when a PUT request is made to /nabaztag/api/led/<string:led>
 
         :param led: The LED to control.
-        :returns: An HTTP response.
 
         The value for red, green and blue in the body are extracted and checked that
-        are integers (done automatically by RequestParser), and in the range 0-255.
-        The request is logged, and the serial command is sent to the AVR.
+        are integers (done by parse_args), and in the range 0-255. If ms is given, the AVR
+        fades the LED to the colour over that many milliseconds, rather than streaming each step.
+        The request is logged, and the serial command is queued for the AVR.
         """
 
-        args = self.parser.parse_args()
+        args = self.parse_args(self.arguments)
+        if args is None:
+            return
 
         message = ""
         send_400 = False
@@ -140,18 +362,13 @@ class NabaztagLED(Resource):
             message += "Value of blue not in range 0-255."
             send_400 = True
 
+        if args['ms'] < 0 or args['ms'] > MAX_DURATION:
+            message += "Value of ms not in range 0-{0}.".format(MAX_DURATION)
+            send_400 = True
+
         if send_400:
             # Return a sentence for each error (regex separates them with full stops and spaces).
-            return {"status": 400, "message": re.sub(r'\.([a-zA-Z])', r'. \1', message)}, 400
-
-        serial.write(
-            LED_SERIAL_STRING.format(
-                led=leds[led],
-                red=args['red'],
-                green=args['green'],
-                blue=args['blue']
-            )
-        )
+            return self.respond({"status": 400, "message": re.sub(r'\.([a-zA-Z])', r'. \1', message)}, 400)
 
         logging.info(
             "Parameters: {body}".format(
@@ -159,89 +376,99 @@ class NabaztagLED(Resource):
             )
         )
 
-        logging.info(
-            LED_SERIAL_STRING.format(
-                led=leds[led],
-                red=args['red'],
-                green=args['green'],
-                blue=args['blue']
-            ).rstrip('\r\n')
+        command = (LED_FADE_SERIAL_STRING if args['ms'] else LED_SERIAL_STRING).format(
+            led=leds[led],
+            red=args['red'],
+            green=args['green'],
+            blue=args['blue'],
+            ms=args['ms']
         )
 
-        return {"status": 201, "message": "Success"}, 201
+        if self.send_command(command):
+            self.respond({"status": 201, "message": "Success"}, 201)
 
 
-class NabaztagLocation(Resource):
+class NabaztagLocation(NabaztagHandler):
 
     """A class to make the Nabaztag's weather information available through a RESTful API.
     """
 
+    @gen.coroutine
     def get(self):
 
         """Called when a GET request is made to /nabaztag/api/location
 
-        :returns: An HTTP response.
-
         An attempt is made to obtain the Nabaztag's physical location from an
-        instance of the GeoLocate class. If successful, the location is returned
-        as JSON, if not, an error is returned.
+        instance of the GeoLocate class, on the executor. If successful, the
+        location is returned as JSON, if not, an error is returned.
         """
 
-        locator = GeoLocate(INTERFACE)
+        locator = GeoLocate(INTERFACE, LOCATION_CACHE)
         try:
-            location = locator.get_location()
-            return location, 200
+            location = yield executor.submit(locator.get_location)
+            self.respond(location, 200)
         except LocationError:
-            return {"status": 503, "message": "Location service temporarily unavailable"}, 503
+            self.respond({"status": 503, "message": "Location service temporarily unavailable"}, 503)
 
 
-class NabaztagWeather(Resource):
+class NabaztagWeather(NabaztagHandler):
 
     """A class to make the Nabaztag's weather information available through a RESTful API.
     """
 
+    @gen.coroutine
     def get(self):
 
         """Called when a GET request is made to /nabaztag/api/weather
 
-        :returns: An HTTP response.
-
         An attempt is made to obtain the weather for the Nabaztag's location from an
-        instance of the Weather class. If successful, the weather is returned
-        as JSON, if not (due to either the location or weather APIs being unavailable),
-        an error is returned.
+        instance of the Weather class, on the executor. If successful, the weather is
+        returned as JSON, if not (due to either the location or weather APIs being
+        unavailable), an error is returned.
         """
 
-        locator = GeoLocate(INTERFACE)
+        locator = GeoLocate(INTERFACE, LOCATION_CACHE)
         try:
-            location = locator.get_location()
+            location = yield executor.submit(locator.get_location)
             weather = Weather(location)
-            return weather.get_weather(), 200
+            result = yield executor.submit(weather.get_weather)
+            self.respond(result, 200)
         except LocationError:
-            return {"status": 503, "message": "Could not determine location. Weather service temporarily unavailable."}, 503
+            self.respond(
+                {"status": 503, "message": "Could not determine location. Weather service temporarily unavailable."},
+                503
+            )
         except WeatherError:
-            return {"status": 503, "message": "Weather service temporarily unavailable."}, 503
+            self.respond({"status": 503, "message": "Weather service temporarily unavailable."}, 503)
 
 
-class NabaztagSpeech(Resource):
+class NabaztagSpeech(NabaztagHandler):
 
     """A class to make the Nabaztag's text-to-speech service available through a RESTful API.
     """
 
-    parser = reqparse.RequestParser()
-    parser.add_argument('text', type=str, required=True)
+    arguments = [('text', unicode, "Bad Request")]
+
+    def initialize(self, speech_queue):
+
+        """Called by Tornado with the keyword arguments given for the handler in make_app.
+
+        :param speech_queue: An instance of Queue.Queue() for the SpeechThread, from create_speech_queue.
+        """
+
+        self.speech_queue = speech_queue
 
     def put(self):
 
         """Called when a PUT request is made to /nabaztag/api/speech
 
-        :returns: An HTTP response.
-
-        The body of the request is checked by RequestParser for valid text, then
-        the text is passed an instance of the SpeechThread.
+        The body of the request is checked by parse_args for valid text, then
+        the text is queued to be spoken by the SpeechThread.
         """
 
-        args = self.parser.parse_args()
+        args = self.parse_args(self.arguments)
+        if args is None:
+            return
 
         logging.info(
             "Parameters: {body}".format(
@@ -249,8 +476,29 @@ class NabaztagSpeech(Resource):
             )
         )
 
-        subprocess.Popen('echo '+self.text+'|festival --tts', shell=True)
-        return {"status": 201, "message": "Success"}, 201
+        try:
+            self.speech_queue.put_nowait({'text': args['text']})
+        except Queue.Full:
+            self.set_header('Retry-After', '1')
+            return self.respond({"status": 429, "message": "Too much speech waiting, try again later."}, 429)
+
+        self.respond({"status": 201, "message": "Success"}, 201)
+
+
+def make_app(speech_queue):
+
+    """Returns the Tornado Application serving the API.
+
+    :param speech_queue: An instance of Queue.Queue() to place speech messages on.
+    """
+
+    return Application([
+        (r'/nabaztag/api/ear/(left|right)', NabaztagEar),
+        (r'/nabaztag/api/led/(top|bottom)', NabaztagLED),
+        (r'/nabaztag/api/location', NabaztagLocation),
+        (r'/nabaztag/api/speech', NabaztagSpeech, dict(speech_queue=speech_queue)),
+        (r'/nabaztag/api/weather', NabaztagWeather),
+    ])
 
 
 if __name__ == '__main__':
@@ -258,17 +506,16 @@ if __name__ == '__main__':
     UART.setup("UART1")
     serial = pyserial.Serial(port=SERIAL, baudrate=RATE)
 
-    # Set up Flask endpoints
-    app = Flask('NabaztagAPIServer')
-    api = Api(app)
+    # Ear positions are read from the AVR by the client, which relays them here if requests wait for them.
+    if ACKNOWLEDGE:
+        acknowledgements.listen(ACK_PORT, IOLoop.instance())
+
+    SerialWriter(serial, serial_queue, name="serialwrite").start()
 
-    api.add_resource(NabaztagEar, '/nabaztag/api/ear/<string:ear>')
-    api.add_resource(NabaztagLED, '/nabaztag/api/led/<string:led>')
-    api.add_resource(NabaztagLocation, '/nabaztag/api/location')
-    api.add_resource(NabaztagSpeech, '/nabaztag/api/speech')
-    api.add_resource(NabaztagWeather, '/nabaztag/api/weather')
+    # Speech is synthesised and played one utterance at a time, by a single SpeechThread.
+    app = make_app(create_speech_queue(SPEECH_CACHE))
 
     # Run REST API server
-    http_server = HTTPServer(WSGIContainer(app))
+    http_server = HTTPServer(app)
     http_server.listen(8000, address='127.0.0.1')
-    IOLoop.instance().start()
\ No newline at end of file
+    IOLoop.instance().start()
@@ -1,8 +1,18 @@
+import threading
+import time
 import requests
 
 JSON_REQUEST_HEADERS = {'Content-type': 'application/json', 'Accept': 'text/plain'}
 WEATHER_URL = "http://api.openweathermap.org/data/2.5/weather"
 WEATHER_API_KEY = {'APPID': ""}
+REQUEST_TIMEOUT = 10
+
+# Cached weather is returned for WEATHER_TTL seconds. After that, and up to WEATHER_STALE_TTL seconds,
+# it is still returned while a refresh is made in the background. Locations are rounded to
+# COORDINATE_PRECISION decimal places (roughly 1km), so nearby requests share the same cached weather.
+WEATHER_TTL = 10 * 60
+WEATHER_STALE_TTL = 60 * 60
+COORDINATE_PRECISION = 2
 
 
 class Weather():
@@ -32,7 +42,23 @@ class Weather():
 
         :returns: A Dict containing weather information.
 
-        If the information returned by the openweather API is incorrect, a WeatherError is raised.
+        The weather is served from the shared WeatherCache where possible. If the information
+        returned by the openweather API is incorrect, a WeatherError is raised.
+        """
+
+        key = (
+            round(self.lat_lon['lat'], COORDINATE_PRECISION),
+            round(self.lat_lon['lon'], COORDINATE_PRECISION),
+            self.units['units']
+        )
+
+        return _cache.get(key, self.fetch_weather)
+
+    def fetch_weather(self):
+
+        """Obtain the weather information from the openweather API, bypassing the cache.
+
+        :returns: A Dict containing weather information.
         """
 
         # Package parameters for the request to openweather API.
@@ -41,7 +67,10 @@ class Weather():
         params.update(WEATHER_API_KEY)
         params.update(self.units)
 
-        response = requests.get(WEATHER_URL, params=params).json()
+        try:
+            response = requests.get(WEATHER_URL, params=params, timeout=REQUEST_TIMEOUT).json()
+        except (requests.exceptions.RequestException, ValueError):
+            raise WeatherError("Weather service temporarily unavilable")
 
         weather = {}
 
@@ -62,5 +91,94 @@ class Weather():
             raise WeatherError("Weather service temporarily unavilable")
 
 
+class WeatherCache():
+
+    """A class caching weather by location and units, shared by all Weather instances.
+
+    Stale weather is served while it is refreshed in the background, and concurrent requests
+    for the same weather wait for a single call to the openweather API, rather than each making one.
+    """
+
+    def __init__(self):
+
+        """Create an instance of the WeatherCache class.
+        """
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.pending = {}
+
+    def get(self, key, fetch):
+
+        """Returns the weather for a key, fetching it if it isn't cached.
+
+        :params key: A tuple of the rounded lat, lon and units.
+        :params fetch: A function which fetches the weather from the openweather API.
+
+        Raises a WeatherError if the weather isn't cached and can't be fetched.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            age = time.time() - entry[1] if entry is not None else None
+
+            if age is not None and age < WEATHER_TTL:
+                return entry[0]
+
+            if age is not None and age < WEATHER_STALE_TTL:
+                if key not in self.pending:
+                    self.pending[key] = PendingFetch()
+                    refresh = threading.Thread(target=self.fetch, args=(key, fetch), name="weatherrefresh")
+                    refresh.daemon = True
+                    refresh.start()
+                return entry[0]
+
+            pending = self.pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self.pending[key] = PendingFetch()
+
+        if leader:
+            self.fetch(key, fetch)
+
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+        return pending.weather
+
+    def fetch(self, key, fetch):
+
+        """Fetches the weather for a key, caches it, and passes it to any requests waiting for it.
+        """
+
+        pending = self.pending[key]
+
+        try:
+            pending.weather = fetch()
+            with self.lock:
+                self.entries[key] = (pending.weather, time.time())
+        except WeatherError as e:
+            pending.error = e
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.done.set()
+
+
+class PendingFetch():
+
+    """A call to the openweather API which is in progress, and the requests waiting for its result.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.weather = None
+        self.error = None
+
+
 class WeatherError(Exception):
     pass
+
+
+_cache = WeatherCache()
@@ -1,5 +1,11 @@
+import os
+import sys
 import json
 import Queue
+import shutil
+import socket
+import tempfile
+import time
 import httpretty
 import unittest
 from testfixtures import LogCapture
@@ -7,9 +13,21 @@ from ws4py.framing import OPCODE_TEXT
 from ws4py.messaging import Message
 from mock import MagicMock, patch
 
+from beaglebone.nabaztag_choreography import Choreographer
+from beaglebone.nabaztag_serial import AcknowledgementRelay, CoalescingQueue, decode_frame, ear_frame, led_frame, \
+    negotiate_framing
+from beaglebone.nabaztag_speech import Festival, SpeechCache, SpeechError, SpeechThread, scheme_string
 from beaglebone.nabaztag_update import UpdateThread
 from beaglebone.nabaztag_websocket import WSClient, InvalidSerialCommandError
 
+# The Pi modules import each other by name, and RPi.GPIO is only available on a Pi.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pi'))
+# The mocks stay in sys.modules, as pi_button's globals are cleared if it is removed from there.
+sys.modules.setdefault('RPi.GPIO', MagicMock(name='GPIO'))
+sys.modules.setdefault('RPi', MagicMock(GPIO=sys.modules['RPi.GPIO']))
+from pi_button import ButtonThread, SINGLE_PRESS_UPDATE, DOUBLE_PRESS_UPDATE, LONG_PRESS_UPDATE
+gpio = sys.modules['RPi.GPIO']
+
 
 class TestJSONtoSerial(unittest.TestCase):
     def test_ear_message(self):
@@ -24,16 +42,222 @@ class TestJSONtoSerial(unittest.TestCase):
         serial = WSClient.json_to_serial(led_json)
         self.assertEquals(serial, led_serial)
 
+    def test_timed_ear_message(self):
+        ear_json = json.loads('{"ear": "L", "pos": 10, "ms": 800}')
+        self.assertEquals(WSClient.json_to_serial(ear_json), "EARMOV L 10 800\r\n")
+
+    def test_led_fade_message(self):
+        led_json = json.loads('{"led": "T", "red": 75, "green": 150, "blue": 225, "ms": 1000}')
+        self.assertEquals(WSClient.json_to_serial(led_json), "LEDFADE T 75 150 225 1000\r\n")
+
+    def test_invalid_duration(self):
+        led_json = json.loads('{"led": "T", "red": 75, "green": 150, "blue": 225, "ms": 65536}')
+        self.assertRaises(InvalidSerialCommandError, WSClient.json_to_serial, led_json)
+
     def test_invalid_message(self):
         invalid_json = json.loads('{"invalid": 1}')
         self.assertRaises(InvalidSerialCommandError, WSClient.json_to_serial, invalid_json)
 
 
+class TestBinaryFraming(unittest.TestCase):
+    def test_ear_frame(self):
+        self.assertEquals(ear_frame("L", 10), "\xa5\x01\x4c\x0a\x47")
+
+    def test_led_frame(self):
+        self.assertEquals(led_frame("T", 75, 150, 225), "\xa5\x02\x54\x4b\x96\xe1\x6a")
+
+    def test_timed_frames(self):
+        self.assertEquals(ear_frame("L", 10, 800), "\xa5\x03\x4c\x0a\x03\x20\x66")
+        self.assertEquals(led_frame("T", 75, 150, 225, 1000), "\xa5\x04\x54\x4b\x96\xe1\x03\xe8\x87")
+
+    def test_binary_json_to_serial(self):
+        ear_json = json.loads('{"ear": "L", "pos": 10}')
+        self.assertEquals(WSClient.json_to_serial(ear_json, binary=True), ear_frame("L", 10))
+
+    def test_decode_messages(self):
+        self.assertEquals(decode_frame("\xa5\x81\x52\x05\xd6"), {"ear": "R", "pos": 5})
+        self.assertEquals(decode_frame("\xa5\x82\x4c\xce"), {"ear": "L", "moved": 1})
+        self.assertEquals(decode_frame("\xa5\x83\x83"), {"button": 1})
+
+    def test_negotiation_skips_other_messages(self):
+        port = MagicMock(timeout=None)
+        port.readline.side_effect = ['{"butt', '{"button": 1}\n', '{"binary": 1}\n']
+        with LogCapture():
+            self.assertTrue(negotiate_framing(port, 'binary'))
+        self.assertIsNone(port.timeout)
+
+    def test_negotiation_with_old_firmware(self):
+        port = MagicMock(timeout=None)
+        port.readline.side_effect = ['{"invalid": 1}\n']
+        with LogCapture():
+            self.assertFalse(negotiate_framing(port, 'binary'))
+
+    def test_decode_bad_checksum(self):
+        self.assertRaises(ValueError, decode_frame, "\xa5\x83\x00")
+
+
+class TestCoalescingQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = CoalescingQueue()
+
+    def test_latest_command_kept(self):
+        self.queue.put("LED T 255 0 0\r\n")
+        self.queue.put("EARMOV L 5\r\n")
+        self.queue.put("LED T 0 0 255\r\n")
+        self.assertEquals(self.queue.qsize(), 2)
+        self.assertEquals(self.queue.get(), "LED T 0 0 255\r\n")
+        self.assertEquals(self.queue.get(), "EARMOV L 5\r\n")
+
+    def test_different_actuators_kept(self):
+        self.queue.put("LED T 255 0 0\r\n")
+        self.queue.put("LED B 255 0 0\r\n")
+        self.queue.put("EARMOV L 5\r\n")
+        self.queue.put("EARMOV R 5\r\n")
+        self.assertEquals(self.queue.qsize(), 4)
+
+    def test_frames_coalesced_by_actuator(self):
+        self.queue.put(led_frame("T", 255, 0, 0))
+        self.queue.put(led_frame("B", 255, 0, 0))
+        self.queue.put(led_frame("T", 0, 0, 255))
+        self.assertEquals(self.queue.qsize(), 2)
+        self.assertEquals(self.queue.get(), led_frame("T", 0, 0, 255))
+
+    def test_fade_coalesced_with_led(self):
+        self.queue.put("LED T 255 0 0\r\n")
+        self.queue.put("LEDFADE T 0 0 255 1000\r\n")
+        self.queue.put(led_frame("B", 255, 0, 0))
+        self.queue.put(led_frame("B", 0, 0, 255, 1000))
+        self.assertEquals(self.queue.qsize(), 2)
+        self.assertEquals(self.queue.get(), "LEDFADE T 0 0 255 1000\r\n")
+        self.assertEquals(self.queue.get(), led_frame("B", 0, 0, 255, 1000))
+
+    def test_written_command_not_replaced(self):
+        self.queue.put("LED T 255 0 0\r\n")
+        self.assertEquals(self.queue.get(), "LED T 255 0 0\r\n")
+        self.queue.put("LED T 0 0 255\r\n")
+        self.assertEquals(self.queue.get(), "LED T 0 0 255\r\n")
+
+
+class TestAcknowledgementRelay(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.settimeout(1)
+        self.queue = Queue.Queue()
+        self.relay = AcknowledgementRelay(self.queue, self.listener.getsockname()[1])
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_ear_position_relayed(self):
+        self.relay.put({"ear": "L", "pos": 5})
+        self.assertEquals(json.loads(self.listener.recv(4096)), {"ear": "L", "pos": 5})
+        self.assertEquals(self.queue.get_nowait(), {"ear": "L", "pos": 5})
+
+    def test_other_messages_not_relayed(self):
+        self.relay.put({"button": 1})
+        self.assertEquals(self.queue.get_nowait(), {"button": 1})
+        self.assertRaises(socket.timeout, self.listener.recv, 4096)
+
+
+class TestChoreographer(unittest.TestCase):
+    def setUp(self):
+        self.queue = Queue.Queue()
+        self.choreographer = Choreographer(self.queue, name="choreographytest")
+        self.choreographer.start()
+
+    def test_steps_played_in_time_order(self):
+        started = time.time()
+        self.choreographer.play([(0.2, "EARMOV L 0\r\n"), (0, "EARMOV L 5\r\n"), (0, "EARMOV R 5\r\n")])
+        self.assertEquals(self.queue.get(timeout=1), "EARMOV L 5\r\n")
+        self.assertEquals(self.queue.get(timeout=1), "EARMOV R 5\r\n")
+        self.assertEquals(self.queue.get(timeout=1), "EARMOV L 0\r\n")
+        self.assertGreaterEqual(time.time() - started, 0.2)
+
+    def test_play_replaces_choreography(self):
+        self.choreographer.play([(0.2, "LED T 255 0 0\r\n")])
+        self.choreographer.play([(0, "LED T 0 0 255\r\n")])
+        self.assertEquals(self.queue.get(timeout=1), "LED T 0 0 255\r\n")
+        self.assertRaises(Queue.Empty, self.queue.get, timeout=0.4)
+
+    def test_cancel(self):
+        self.choreographer.play([(0.2, "LED T 255 0 0\r\n")])
+        self.choreographer.cancel()
+        self.assertRaises(Queue.Empty, self.queue.get, timeout=0.4)
+
+
+class TestSpeechCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = SpeechCache(self.directory, max_size=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def synthesise(self, text, size):
+        path = self.cache.temporary_path()
+        with open(path, 'wb') as audio:
+            audio.write('x' * size)
+        return self.cache.store(text, path)
+
+    def test_miss_then_hit(self):
+        self.assertIsNone(self.cache.get("Hello"))
+        path = self.synthesise("Hello", 4)
+        self.assertEquals(self.cache.get("Hello"), path)
+
+    def test_least_recently_spoken_evicted(self):
+        first = self.synthesise("First", 4)
+        second = self.synthesise("Second", 4)
+        os.utime(first, (1, 1))
+        os.utime(second, (2, 2))
+        self.synthesise("Third", 4)
+        self.assertIsNone(self.cache.get("First"))
+        self.assertEquals(self.cache.get("Second"), second)
+
+    def test_scheme_string_escaped(self):
+        self.assertEquals(scheme_string('Say "hi")\\'), '"Say \\"hi\\")\\\\"')
+
+    def test_non_ascii_synthesised(self):
+        thread = SpeechThread(Queue.Queue(), self.cache, name="speechtest")
+        thread.festival = MagicMock()
+        thread.festival.synthesise.side_effect = lambda text, path: open(path, 'wb').close()
+        with LogCapture() as l:
+            path = thread.render({"text": u"Caf\xe9"})
+            l.check(('root', 'INFO', u'speechtest - Synthesising: Caf\xe9'),)
+        self.assertEquals(self.cache.get(u"Caf\xe9"), path)
+
+
+class TestFestival(unittest.TestCase):
+    def setUp(self):
+        self.festival = Festival()
+
+    def tearDown(self):
+        self.festival.stop()
+
+    @patch('beaglebone.nabaztag_speech.SYNTHESIS_TIMEOUT', 0.2)
+    @patch('beaglebone.nabaztag_speech.FESTIVAL_COMMAND', ["sleep", "5"])
+    def test_hung_festival_restarted(self):
+        self.assertRaises(SpeechError, self.festival.synthesise, "Hello", "/nonexistent.wav")
+        self.assertIsNone(self.festival.process)
+
+    @patch('beaglebone.nabaztag_speech.FESTIVAL_COMMAND', ["true"])
+    def test_exited_festival(self):
+        self.assertRaises(SpeechError, self.festival.synthesise, "Hello", "/nonexistent.wav")
+
+    @patch('beaglebone.nabaztag_speech.FESTIVAL_COMMAND', ["cat"])
+    def test_non_ascii_sent_as_utf8(self):
+        # cat echoes the done marker back, so only the missing file is reported.
+        self.assertRaises(SpeechError, self.festival.synthesise, u"Caf\xe9", "/nonexistent.wav")
+        self.assertIsNotNone(self.festival.process)
+
+
 class TestUpdateServerLocation(unittest.TestCase):
     def setUp(self):
         self.serial_queue = Queue.Queue()
         self.update_queue = Queue.Queue()
-        self.websocket = WSClient("ws://echo.websocket.org", self.serial_queue, self.update_queue, "websockettest")
+        self.speech_queue = Queue.Queue(maxsize=1)
+        self.websocket = WSClient("ws://echo.websocket.org", self.serial_queue, self.update_queue, "websockettest",
+                                  speech_queue=self.speech_queue)
         self.websocket.connect()
         httpretty.enable()
 
@@ -78,7 +302,9 @@ class TestWebsocketCallbacks(unittest.TestCase):
     def setUp(self):
         self.serial_queue = Queue.Queue()
         self.update_queue = Queue.Queue()
-        self.websocket = WSClient("ws://echo.websocket.org", self.serial_queue, self.update_queue, "websockettest")
+        self.speech_queue = Queue.Queue(maxsize=1)
+        self.websocket = WSClient("ws://echo.websocket.org", self.serial_queue, self.update_queue, "websockettest",
+                                  speech_queue=self.speech_queue)
         self.websocket.connect()
 
     def tearDown(self):
@@ -90,9 +316,19 @@ class TestWebsocketCallbacks(unittest.TestCase):
         with LogCapture() as l:
             self.websocket.opened()
             l.check(('root', 'INFO', "websockettest - Connection opened: ws://echo.websocket.org"),)
+            for task in self.websocket.tasks:
+                task.join()
             self.assertTrue(WSClient.initialise.called)
             self.assertTrue(WSClient.update_server_location.called)
 
+    def test_closed_cancels_tasks(self):
+        task = self.websocket.schedule(60, MagicMock('mock_task'))
+        with LogCapture():
+            self.websocket.closed(1006)
+        task.join(1)
+        self.assertFalse(task.is_alive())
+        self.assertEquals(self.websocket.tasks, [])
+
     def test_received_valid_serial_message(self):
         ear_serial = "EARMOV L 10\r\n"
         WSClient.json_to_serial = MagicMock('mock_json_to_serial', return_value=ear_serial)
@@ -103,13 +339,76 @@ class TestWebsocketCallbacks(unittest.TestCase):
             self.assertTrue(WSClient.json_to_serial.called)
             self.assertEquals(self.serial_queue.get(), ear_serial)
 
-    @patch('subprocess.Popen')
-    def test_received_valid_speech_message(self, mock_popen):
+    def test_received_batch_message(self):
+        WSClient.json_to_serial = MagicMock('mock_json_to_serial', side_effect=["EARMOV L 0\r\n", "EARMOV R 0\r\n"])
+        batch = json.dumps({"batch": [{"ear": "L", "pos": 0}, {"ear": "R", "pos": 0}]})
+        batch_message = Message(OPCODE_TEXT, data=batch)
+        with LogCapture() as l:
+            self.websocket.received_message(batch_message)
+            l.check(('root', 'INFO', 'websockettest - Message received: ' + batch),)
+            self.assertEquals(WSClient.json_to_serial.call_count, 2)
+            self.assertEquals(self.serial_queue.get(), "EARMOV L 0\r\n")
+            self.assertEquals(self.serial_queue.get(), "EARMOV R 0\r\n")
+
+    def test_received_choreography_message(self):
+        WSClient.json_to_serial = MagicMock('mock_json_to_serial', side_effect=["EARMOV L 5\r\n", "EARMOV L 0\r\n"])
+        self.websocket.choreographer = MagicMock(name='mock_choreographer')
+        choreography = json.dumps({"choreography": [{"at": 0, "ear": "L", "pos": 5}, {"at": 500, "ear": "L", "pos": 0}]})
+        with LogCapture():
+            self.websocket.received_message(Message(OPCODE_TEXT, data=choreography))
+        self.websocket.choreographer.play.assert_called_once_with([(0, "EARMOV L 5\r\n"), (0.5, "EARMOV L 0\r\n")])
+
+    def test_invalid_choreography_not_played(self):
+        WSClient.json_to_serial = MagicMock('mock_json_to_serial', return_value="EARMOV L 5\r\n")
+        self.websocket.choreographer = MagicMock(name='mock_choreographer')
+        with LogCapture() as l:
+            self.websocket.choreograph([{"at": 0, "ear": "L", "pos": 5}, {"ear": "L", "pos": 0}])
+            l.check(('root', 'ERROR', "websockettest - Invalid choreography: 'at'"),)
+        self.assertFalse(self.websocket.choreographer.play.called)
+
+    def test_empty_choreography_cancels(self):
+        self.websocket.choreographer = MagicMock(name='mock_choreographer')
+        self.websocket.choreograph([])
+        self.assertTrue(self.websocket.choreographer.cancel.called)
+
+    def test_invalid_batch_entry_skipped(self):
+        WSClient.json_to_serial = MagicMock('mock_json_to_serial', side_effect=[KeyError('pos'), "EARMOV R 0\r\n"])
+        batch = json.dumps({"batch": [{"ear": "L"}, {"ear": "R", "pos": 0}]})
+        with LogCapture() as l:
+            self.websocket.received_message(Message(OPCODE_TEXT, data=batch))
+            l.check(('root', 'INFO', 'websockettest - Message received: ' + batch),
+                    ('root', 'ERROR', "websockettest - Error: 'pos'"))
+        self.assertEquals(self.serial_queue.get_nowait(), "EARMOV R 0\r\n")
+
+    def test_received_non_object_message(self):
+        with LogCapture() as l:
+            self.websocket.received_message(Message(OPCODE_TEXT, data='[1, 2]'))
+            l.check(('root', 'INFO', 'websockettest - Message received: [1, 2]'),
+                    ('root', 'ERROR', "websockettest - Error: 'list' object has no attribute 'get'"))
+
+    def test_received_valid_speech_message(self):
         ear_message = Message(OPCODE_TEXT, data=json.dumps({"text": "String to speak", "speak": 1}))
         with LogCapture() as l:
             self.websocket.received_message(ear_message)
             l.check(('root', 'INFO', 'websockettest - Message received: {"text": "String to speak", "speak": 1}'),)
-            self.assertTrue(mock_popen.called)
+            self.assertEquals(self.speech_queue.get_nowait(), {"text": "String to speak"})
+
+    def test_received_rendered_speech_message(self):
+        self.websocket.speak({"speak": 1, "text": "String to speak", "audio": "/media/speech/abc.wav"})
+        self.assertEquals(self.speech_queue.get_nowait(),
+                          {"text": "String to speak", "audio": "http://echo.websocket.org/media/speech/abc.wav"})
+
+    def test_speech_dropped_when_queue_full(self):
+        self.speech_queue.put("Already speaking")
+        with LogCapture() as l:
+            self.websocket.speak({"speak": 1, "text": "String to speak"})
+            l.check(('root', 'ERROR', 'websockettest - Speech dropped: String to speak'),)
+
+    def test_non_ascii_speech_dropped(self):
+        self.speech_queue.put("Already speaking")
+        with LogCapture() as l:
+            self.websocket.speak({"speak": 1, "text": u"Caf\xe9"})
+            l.check(('root', 'ERROR', u'websockettest - Speech dropped: Caf\xe9'),)
 
     def test_received_invalid_message(self):
         ear_serial = "EARMOV L 10\r\n"
@@ -150,6 +449,53 @@ class TestGenerateUpdateURL(unittest.TestCase):
         self.assertIsNone(url)
 
 
+class TestUpdateSession(unittest.TestCase):
+    def setUp(self):
+        self.url = "http://localhost:80/update/00:0f:54:18:10:35/"
+        self.update = UpdateThread(
+            self.url,
+            Queue.Queue(),
+            "updatetest"
+        )
+
+    def test_session_reused(self):
+        self.assertIs(self.update.session.get_adapter(self.url + 'ear'),
+                      self.update.session.get_adapter(self.url + 'button'))
+
+    def test_session_retries(self):
+        retries = self.update.session.get_adapter(self.url).max_retries
+        self.assertEquals(retries.total, 3)
+        self.assertEquals(retries.read, 0)
+
+
+class TestSendUpdate(unittest.TestCase):
+    def setUp(self):
+        self.url = "http://localhost:80/update/00:0f:54:18:10:35/"
+        self.websocket = MagicMock(terminated=False)
+        self.update = UpdateThread(
+            self.url,
+            Queue.Queue(),
+            "updatetest",
+            websocket=self.websocket
+        )
+
+    def test_sent_over_websocket(self):
+        update = {"button": 1}
+        with LogCapture() as l:
+            self.assertTrue(self.update.send_over_websocket(update))
+            l.check(('root', 'INFO', 'updatetest - Sent ' + json.dumps(update) + ' over websocket'),)
+        self.websocket.send.assert_called_once_with(json.dumps(update))
+
+    def test_websocket_closed(self):
+        self.websocket.terminated = True
+        self.assertFalse(self.update.send_over_websocket({"button": 1}))
+        self.assertFalse(self.websocket.send.called)
+
+    def test_no_websocket(self):
+        self.update.websocket = None
+        self.assertFalse(self.update.send_over_websocket({"button": 1}))
+
+
 class TestLogResponse(unittest.TestCase):
     def setUp(self):
         self.url = "http://localhost:80/update/00:0f:54:18:10:35/"
@@ -168,5 +514,70 @@ class TestLogResponse(unittest.TestCase):
             l.check(('root', 'INFO', 'updatetest - POSTed ' + json.dumps(update) + ' to ' + url),
                     ('root', 'INFO', 'updatetest - Response: ' + json.dumps(response)))
 
+
+class TestButtonThread(unittest.TestCase):
+    def setUp(self):
+        self.level = 0
+        gpio.input.side_effect = lambda pin: self.level
+        self.update_queue = Queue.Queue()
+
+    def start(self, double_press):
+        button = ButtonThread(self.update_queue, "buttontest", debounce=0.01, long_press=0.3, double_press=double_press)
+        button.start()
+        self.button = button
+
+    def edge(self, level, hold):
+        self.level = level
+        self.button.edges.put(7)
+        self.button.edges.put(7)
+        time.sleep(hold)
+
+    def updates(self):
+        updates = []
+        while not self.update_queue.empty():
+            updates.append(self.update_queue.get_nowait())
+        return updates
+
+    def test_bounce_without_change_ignored(self):
+        self.start(double_press=0)
+        with LogCapture():
+            self.edge(0, 0.1)
+        self.assertEquals(self.updates(), [])
+
+    def test_single_press_on_release(self):
+        self.start(double_press=0)
+        with LogCapture():
+            self.edge(1, 0.05)
+            self.assertEquals(self.updates(), [])
+            self.edge(0, 0.05)
+        self.assertEquals(self.updates(), [SINGLE_PRESS_UPDATE])
+
+    def test_long_press(self):
+        self.start(double_press=0.2)
+        with LogCapture():
+            self.edge(1, 0.5)
+            self.assertEquals(self.updates(), [LONG_PRESS_UPDATE])
+            self.edge(0, 0.4)
+        self.assertEquals(self.updates(), [])
+
+    def test_double_press_inside_window(self):
+        self.start(double_press=0.2)
+        with LogCapture():
+            self.edge(1, 0.03)
+            self.edge(0, 0.03)
+            self.edge(1, 0.03)
+            self.edge(0, 0.4)
+        self.assertEquals(self.updates(), [DOUBLE_PRESS_UPDATE])
+
+    def test_presses_outside_window(self):
+        self.start(double_press=0.2)
+        with LogCapture():
+            self.edge(1, 0.03)
+            self.edge(0, 0.4)
+            self.edge(1, 0.03)
+            self.edge(0, 0.4)
+        self.assertEquals(self.updates(), [SINGLE_PRESS_UPDATE, SINGLE_PRESS_UPDATE])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
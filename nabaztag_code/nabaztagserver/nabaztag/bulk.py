@@ -0,0 +1,258 @@
+import json
+import re
+from django.conf import settings
+
+from nabaztag import state
+from nabaztag.models import Nabaztag, batch_message, choreography_message, ear_message, led_message, speech_message
+from nabaztag.publisher import publish_each
+from nabaztag.writebehind import get_writer, save_changes
+
+
+# Maximum number of commands, after expanding any selector, accepted in a single request.
+MAX_COMMANDS = getattr(settings, 'NABAZTAG_BULK_MAX_COMMANDS', 1000)
+
+EAR_FIELDS = {'L': 'left_ear_pos', 'R': 'right_ear_pos'}
+LED_FIELDS = {'T': 'top_led_color', 'B': 'bottom_led_color'}
+COLOR_PATTERN = re.compile(r'^#[0-9a-fA-F]{6}$')
+
+# Maximum number of frames in a choreography, the same limit the Nabaztag applies.
+MAX_CHOREOGRAPHY_FRAMES = 500
+
+# Longest duration, in milliseconds, of an ear movement or LED fade made by the Nabaztag.
+MAX_DURATION = 65535
+
+
+class BulkCommandError(Exception):
+
+    """Raised when a bulk request is not valid, in which case none of its commands are run.
+    """
+
+    def __init__(self, errors):
+
+        """Create an instance of BulkCommandError.
+
+        :param errors: A List of error messages, e.g. ["Command 3: Value of pos not in range 0-17."]
+        """
+
+        super(BulkCommandError, self).__init__("; ".join(errors))
+        self.errors = errors
+
+
+def run(request):
+
+    """Validates and runs a bulk request, sending every Nabaztag its commands in a single message.
+
+    The request is either a list of commands, each for a Nabaztag:
+    {"commands": [{"nabaztag": "00:00:00:00:00:01", "ear": "L", "pos": 5},
+                  {"nabaztag": "00:00:00:00:00:02", "led": "T", "color": "#ff0000"}]}
+
+    or a single command for every Nabaztag chosen by a selector, either all followers of a Nabaztag or
+    all Nabaztags:
+    {"selector": {"followers": "00:00:00:00:00:01"}, "command": {"speak": 1, "text": "Hello"}}
+    {"selector": {"all": 1}, "command": {"led": "B", "color": "#00ff00"}}
+
+    Every command is validated before any is run. The new state of all the Nabaztags is saved in one
+    transaction (or deferred, if write-behind is enabled), and the messages are published in one pipelined
+    round-trip to Redis.
+
+    :param request: The request Dict.
+    :returns: A Dict summarising the request, e.g. {"nabaztags": 2, "commands": 2}
+
+    Raises a BulkCommandError if the request or any of its commands is not valid.
+    """
+
+    commands = expand(request)
+    messages, changes = validate(commands)
+
+    if changes:
+        writer = get_writer()
+        if writer is not None:
+            for pk, fields in changes.items():
+                writer.defer([pk], fields)
+                state.update([pk], fields)
+        else:
+            save_changes(changes)
+            state.invalidate(*changes.keys())
+
+    publish_each(dict(
+        (pk, json.dumps(nabaztag_messages[0] if len(nabaztag_messages) == 1 else batch_message(nabaztag_messages)))
+        for pk, nabaztag_messages in messages.items()
+    ))
+
+    return {"nabaztags": len(messages), "commands": len(commands)}
+
+
+def expand(request):
+
+    """Returns a List of (Nabaztag identifier, command Dict) tuples for a bulk request.
+
+    :param request: The request Dict, see run()
+    """
+
+    if not isinstance(request, dict):
+        raise BulkCommandError(["Request must be a JSON object"])
+
+    if 'commands' in request:
+        commands = request['commands']
+        if not isinstance(commands, list) or not all(isinstance(command, dict) for command in commands):
+            raise BulkCommandError(["commands must be a list of objects"])
+        commands = [(command.get('nabaztag'), command) for command in commands]
+
+    elif 'selector' in request and isinstance(request.get('command'), dict):
+        selector = request['selector']
+        if isinstance(selector, dict) and 'followers' in selector:
+            nabaztags = Nabaztag(id=selector['followers']).get_followers()
+        elif isinstance(selector, dict) and selector.get('all') == 1:
+            nabaztags = Nabaztag.objects.all()
+        else:
+            raise BulkCommandError(["selector must be {\"followers\": <identifier>} or {\"all\": 1}"])
+        commands = [(pk, request['command']) for pk in nabaztags.values_list('id', flat=True)[:MAX_COMMANDS + 1]]
+
+    else:
+        raise BulkCommandError(["Request must contain commands, or a selector and a command"])
+
+    if len(commands) > MAX_COMMANDS:
+        raise BulkCommandError(["Too many commands, the limit is {limit}".format(limit=MAX_COMMANDS)])
+
+    return commands
+
+
+def validate(commands):
+
+    """Validates a List of commands in one pass, returning the messages to send and the state to save.
+
+    The Nabaztags named by the commands are checked in a single query.
+
+    :param commands: A List of (Nabaztag identifier, command Dict) tuples, from expand()
+    :returns: A tuple of a Dict of the List of messages for each Nabaztag, and a Dict of the field values
+    to save for each Nabaztag.
+
+    Raises a BulkCommandError listing every invalid command.
+    """
+
+    identifiers = set(pk for pk, _ in commands if isinstance(pk, basestring))
+    existing = set(Nabaztag.objects.filter(id__in=identifiers).values_list('id', flat=True))
+
+    errors = []
+    messages = {}
+    changes = {}
+    speech = {}
+
+    for number, (pk, command) in enumerate(commands):
+        try:
+            if not isinstance(pk, basestring):
+                raise ValueError("nabaztag must be a Nabaztag identifier")
+            if pk not in existing:
+                raise ValueError("Nabaztag {pk} doesn't exist".format(pk=pk))
+            message, fields = command_message(command, speech)
+        except ValueError as e:
+            errors.append("Command {number}: {error}".format(number=number, error=e))
+            continue
+
+        messages.setdefault(pk, []).append(message)
+        changes.setdefault(pk, {}).update(fields)
+
+    if errors:
+        raise BulkCommandError(errors)
+
+    return messages, dict((pk, fields) for pk, fields in changes.items() if fields)
+
+
+def command_message(command, speech):
+
+    """Returns the message to send, and the field values to save, for a single command.
+
+    :param command: The command Dict, e.g. {"ear": "L", "pos": 5}, {"led": "T", "color": "#ff0000", "ms": 1000},
+    {"speak": 1, "text": "Hello"} or {"choreography": [{"at": 0, "ear": "L", "pos": 5}, ...]}
+    :param speech: A Dict of speech messages already made, by text, so each text is only rendered once.
+
+    Raises a ValueError if the command is not valid.
+    """
+
+    if 'ear' in command:
+        ear, position = command.get('ear'), command.get('pos')
+        if ear not in EAR_FIELDS:
+            raise ValueError("ear must be L or R")
+        if not is_integer(position) or position < 0 or position > 17:
+            raise ValueError("Value of pos not in range 0-17.")
+        return ear_message(ear, position, duration(command)), {EAR_FIELDS[ear]: position}
+
+    elif 'led' in command:
+        led, color = command.get('led'), command.get('color')
+        if led not in LED_FIELDS:
+            raise ValueError("led must be T or B")
+        if not isinstance(color, basestring) or not COLOR_PATTERN.match(color):
+            raise ValueError("color must be a hex colour, e.g. #ff0000")
+        rgb = tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+        return led_message(led, rgb, duration(command)), {LED_FIELDS[led]: color}
+
+    elif 'speak' in command:
+        text = command.get('text')
+        if not isinstance(text, basestring) or not text.strip():
+            raise ValueError("text must not be empty")
+        if text not in speech:
+            speech[text] = speech_message(text)
+        return speech[text], {}
+
+    elif 'choreography' in command:
+        return choreography_command_message(command.get('choreography'))
+
+    raise ValueError("Unknown command")
+
+
+def duration(command):
+
+    """Returns the number of milliseconds an ear or LED command should take, 0 if it doesn't say.
+
+    :param command: The command Dict.
+
+    Raises a ValueError if the duration is not valid.
+    """
+
+    ms = command.get('ms', 0)
+
+    if not is_integer(ms) or ms < 0 or ms > MAX_DURATION:
+        raise ValueError("Value of ms not in range 0-{limit}.".format(limit=MAX_DURATION))
+
+    return ms
+
+
+def choreography_command_message(frames):
+
+    """Returns the message to send, and the field values to save, for a choreography command.
+
+    Each frame is an ear or LED command with an 'at' key, the number of milliseconds from the start of the
+    choreography to run it at. The field values saved are those the Nabaztag is left with once it has finished.
+
+    :param frames: The List of frame Dicts.
+
+    Raises a ValueError if the choreography is not valid.
+    """
+
+    if not isinstance(frames, list) or len(frames) > MAX_CHOREOGRAPHY_FRAMES:
+        raise ValueError("choreography must be a list of at most {limit} frames".format(limit=MAX_CHOREOGRAPHY_FRAMES))
+
+    timed = []
+
+    for frame in frames:
+        if not isinstance(frame, dict) or not ('ear' in frame or 'led' in frame):
+            raise ValueError("choreography frames must be ear or led commands")
+        at = frame.get('at')
+        if not is_integer(at) or at < 0:
+            raise ValueError("at must be a number of milliseconds, 0 or more")
+        message, fields = command_message(frame, {})
+        timed.append((at, dict(message, at=at), fields))
+
+    changes = {}
+    for _, _, fields in sorted(timed, key=lambda frame: frame[0]):
+        changes.update(fields)
+
+    return choreography_message([message for _, message, _ in timed]), changes
+
+
+def is_integer(value):
+
+    """Returns True if a value from a JSON request is an integer, which JSON true and false are not.
+    """
+
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
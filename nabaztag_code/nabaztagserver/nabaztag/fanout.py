@@ -0,0 +1,152 @@
+import json
+import logging
+import threading
+import time
+import Queue
+from django.conf import settings
+from django.db import close_old_connections
+
+from nabaztag import state
+from nabaztag.models import Nabaztag
+from nabaztag.publisher import publish_many
+from nabaztag.writebehind import get_writer
+
+
+# Number of worker threads, and the number of events which may wait for them, in each server process.
+WORKERS = getattr(settings, 'NABAZTAG_FANOUT_WORKERS', 4)
+QUEUE_SIZE = getattr(settings, 'NABAZTAG_FANOUT_QUEUE_SIZE', 1000)
+
+logger = logging.getLogger(__name__)
+
+_engine = None
+_lock = threading.Lock()
+
+
+class FanoutEngine(object):
+
+    """A class which relays events from a Nabaztag to all of its followers in the background.
+
+    Events are submitted by the views handling updates from a Nabaztag, which can then respond
+    immediately. A pool of worker threads looks up the followers, publishes the message to all of
+    them in one pipelined Redis round-trip, and updates their stored state in bulk.
+    """
+
+    def __init__(self, workers, queue_size):
+
+        """Create an instance of FanoutEngine and start its worker threads.
+
+        :param workers: The number of worker threads to start.
+        :param queue_size: The maximum number of events waiting to be handled.
+        """
+
+        self.event_queue = Queue.Queue(maxsize=queue_size)
+
+        for number in range(workers):
+            worker = threading.Thread(target=self.run, name="fanout-{0}".format(number))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, nabaztag, message, fields):
+
+        """Queues an event from a Nabaztag to be relayed to its followers.
+
+        :param nabaztag: The Nabaztag the event came from.
+        :param message: The message Dict to publish to each follower.
+        :param fields: A Dict of field values to set on the Nabaztag and each of its followers.
+
+        Raises a FanoutBusyError if too many events are already waiting.
+        """
+
+        try:
+            self.event_queue.put_nowait((nabaztag, message, fields, time.time()))
+        except Queue.Full:
+            raise FanoutBusyError("Too many events waiting to be relayed to followers")
+
+    def run(self):
+
+        """Started by each worker thread.
+
+        Whilst running, the worker does a blocking get from the event_queue queue and relays each
+        event, logging any error without stopping the thread.
+        """
+
+        while True:
+            event = self.event_queue.get()
+            try:
+                relay(*event)
+            except Exception:
+                logger.exception("Failed to relay event from {nabaztag}".format(nabaztag=event[0].id))
+            finally:
+                # Worker threads are long lived, so close their database connection once it passes CONN_MAX_AGE.
+                close_old_connections()
+
+
+class FanoutBusyError(Exception):
+
+    """Raised when an event can't be queued because the fan-out engine is overloaded.
+    """
+
+    pass
+
+
+def relay(nabaztag, message, fields, submitted=None):
+
+    """Publishes a message to all followers of a Nabaztag and updates their state, deferring the
+    database writes if write-behind is enabled.
+
+    The latency from submission to completion and the number of followers are logged for each event.
+
+    :param nabaztag: The Nabaztag the event came from.
+    :param message: The message Dict to publish to each follower.
+    :param fields: A Dict of field values to set on the Nabaztag and each of its followers.
+    :param submitted: The time the event was submitted, defaults to now.
+    """
+
+    started = time.time()
+    if submitted is None:
+        submitted = started
+
+    followers = nabaztag.get_followers()
+    follower_ids = list(followers.values_list('id', flat=True))
+
+    if follower_ids:
+        publish_many(follower_ids, json.dumps(message))
+
+    writer = get_writer()
+
+    if writer is not None:
+        # Saved in the next batch, the cached state is changed now.
+        writer.defer([nabaztag.pk] + follower_ids, fields)
+        state.update([nabaztag.pk] + follower_ids, fields)
+    else:
+        if follower_ids:
+            followers.update(**fields)
+        Nabaztag.objects.filter(pk=nabaztag.pk).update(**fields)
+
+        # Bulk updates don't send post_save, so remove the cached state of every Nabaztag updated.
+        state.invalidate(nabaztag.pk, *follower_ids)
+
+    finished = time.time()
+    logger.info(
+        "Relayed event from {nabaztag} to {count} followers in {total:.1f}ms ({waiting:.1f}ms queued)".format(
+            nabaztag=nabaztag.id,
+            count=len(follower_ids),
+            total=(finished - submitted) * 1000,
+            waiting=(started - submitted) * 1000
+        )
+    )
+
+
+def get_engine():
+
+    """Returns the FanoutEngine for this process, starting it on first use.
+    """
+
+    global _engine
+
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                _engine = FanoutEngine(WORKERS, QUEUE_SIZE)
+
+    return _engine
@@ -88,26 +88,42 @@ class CreatePairingForm(forms.Form):
     These two pairings are distinct.
     """
     def __init__(self, *args, **kwargs):
-        global nabaztag
-        nabaztag = kwargs.pop('nabaztag')
+        self.nabaztag = kwargs.pop('nabaztag')
         super(CreatePairingForm, self).__init__(*args, **kwargs)
 
-    def pairingvalidator(value):
+    def clean_create_pairing_identifier(self):
         """Several validations are required.
 
-        1. A Nabaztag with the specified ID must exist.
-        2. The id provided for pairing cannot be your own.
+        1. The id provided for pairing cannot be your own.
+        2. A Nabaztag with the specified ID must exist.
         3. The pairing cannot already exist.
+
+        The Nabaztag and whether it is already paired are read in a single query. The Nabaztag is
+        kept in cleaned_data['nabaztag_to_pair'], so it doesn't need to be read again.
         """
-        if not Nabaztag.objects.filter(id=value).exists():
-            raise ValidationError('That Nabaztag doesn\'t exist')
-        elif nabaztag.id == value:
+        value = self.cleaned_data['create_pairing_identifier']
+
+        if self.nabaztag.id == value:
             raise ValidationError('You can\'t pair with yourself')
-        else:
-            nabaztag_to_pair = Nabaztag.objects.get(id=value)
-            qs = PairedNabaztags.objects.filter(nabaztag=nabaztag, paired_nabaztag=nabaztag_to_pair)
-            if qs.count() > 0:
-                raise ValidationError('This pairing already exists')
+
+        already_paired = "EXISTS (SELECT 1 FROM {pairings} WHERE nabaztag_id = %s AND paired_nabaztag_id = {nabaztags}.id)"
+        candidates = Nabaztag.objects.filter(id=value).extra(
+            select={'already_paired': already_paired.format(
+                pairings=PairedNabaztags._meta.db_table,
+                nabaztags=Nabaztag._meta.db_table
+            )},
+            select_params=[self.nabaztag.id]
+        )
+
+        nabaztag_to_pair = next(iter(candidates), None)
+
+        if nabaztag_to_pair is None:
+            raise ValidationError('That Nabaztag doesn\'t exist')
+        elif nabaztag_to_pair.already_paired:
+            raise ValidationError('This pairing already exists')
+
+        self.cleaned_data['nabaztag_to_pair'] = nabaztag_to_pair
+        return value
 
     create_pairing_identifier = forms.CharField(
         max_length=17,
@@ -117,11 +133,13 @@ class CreatePairingForm(forms.Form):
                 'Not a valid Identifier',
                 'Invalid Identifier'
             ),
-            pairingvalidator,
         ],
     )
+    # Suggestions are fetched from /control/<pk>/pairing-candidates as the user types, see control.html
     create_pairing_identifier.widget = forms.TextInput(attrs={'size': 17, 'maxlength': 17,
-                                                              'placeholder': "00:00:00:00:00:00"})
+                                                              'placeholder': "00:00:00:00:00:00",
+                                                              'list': "pairing_candidates",
+                                                              'autocomplete': "off"})
     create_pairing_identifier.label = "Pair With: "
 
 
@@ -134,8 +152,11 @@ class UserModelChoiceField(forms.ModelChoiceField):
 
 class DeletePairingForm(forms.Form):
     """This class represents a form for deleting the pairing from one Nabaztag to another.
+
+    Only the pairings of the Nabaztag being controlled are loaded, along with the paired Nabaztags for
+    their labels, in a single query.
     """
-    delete_pairing_identifier = UserModelChoiceField(queryset=PairedNabaztags.objects.all())
+    delete_pairing_identifier = UserModelChoiceField(queryset=PairedNabaztags.objects.none())
     delete_pairing_identifier.label = "Remove Pairing: "
     delete_pairing_identifier.empty_label = None
 
@@ -143,4 +164,6 @@ class DeletePairingForm(forms.Form):
         nabaztag = kwargs.pop('nabaztag')
         super(DeletePairingForm, self).__init__(*args, **kwargs)
 
-        self.fields['delete_pairing_identifier'].queryset = PairedNabaztags.objects.filter(nabaztag=nabaztag.id)
\ No newline at end of file
+        self.fields['delete_pairing_identifier'].queryset = PairedNabaztags.objects.filter(
+            nabaztag=nabaztag.id
+        ).select_related('paired_nabaztag')
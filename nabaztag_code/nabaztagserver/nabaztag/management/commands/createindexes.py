@@ -0,0 +1,73 @@
+import re
+from django.core.management.base import CommandError, NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import get_app, get_models
+
+
+# Matches the index and table names in the statements from sqlindexes, e.g. CREATE INDEX "index" ON "table" (...)
+CREATE_INDEX_PATTERN = re.compile(r'CREATE (?:UNIQUE )?INDEX [`"]?(\w+)[`"]? ON [`"]?(\w+)[`"]?')
+
+# Queries for whether an index exists, by database vendor, for backends without introspection.get_constraints
+INDEX_EXISTS_QUERIES = {
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s",
+    'postgresql': "SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s",
+    'mysql': "SELECT 1 FROM information_schema.statistics "
+             "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+}
+
+
+class Command(NoArgsCommand):
+
+    """Creates any indexes on the nabaztag models which are missing from an existing database.
+
+    syncdb only creates indexes along with their table, so indexes added to the models later (e.g. the
+    index_together on PairedNabaztags) are created by running: python manage.py createindexes
+    """
+
+    help = "Creates indexes on the nabaztag models which are missing from an existing database."
+
+    def handle_noargs(self, **options):
+
+        """Runs each CREATE INDEX statement from sqlindexes, skipping indexes which already exist.
+
+        Any error creating an index, e.g. a permission error or a locked database, stops the command.
+        """
+
+        cursor = connection.cursor()
+
+        for model in get_models(get_app('nabaztag')):
+            for statement in connection.creation.sql_indexes_for_model(model, no_style()):
+                match = CREATE_INDEX_PATTERN.search(statement)
+                if match is None:
+                    raise CommandError("Can't find the index name in: {statement}".format(statement=statement))
+
+                index, table = match.groups()
+
+                if index_exists(cursor, table, index):
+                    self.stdout.write("Exists: {statement}".format(statement=statement))
+                    continue
+
+                with transaction.atomic():
+                    connection.cursor().execute(statement)
+                self.stdout.write("Created: {statement}".format(statement=statement))
+
+
+def index_exists(cursor, table, index):
+
+    """Returns True if the database already has the named index on the table.
+
+    :param cursor: A cursor for the database.
+    :param table: The name of the table.
+    :param index: The name of the index.
+    """
+
+    if hasattr(connection.introspection, 'get_constraints'):
+        return index in connection.introspection.get_constraints(cursor, table)
+
+    query = INDEX_EXISTS_QUERIES.get(connection.vendor)
+    if query is None:
+        raise CommandError("Can't check for existing indexes on {vendor}".format(vendor=connection.vendor))
+
+    cursor.execute(query, [table, index])
+    return cursor.fetchone() is not None
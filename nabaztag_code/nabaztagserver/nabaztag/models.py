@@ -1,9 +1,16 @@
 import json
+import logging
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.core.validators import MaxValueValidator, MinValueValidator
-from ws4redis.publisher import RedisPublisher
 
 from colorful.fields import RGBColorField
+from nabaztag import speech, state
+from nabaztag.writebehind import get_writer
+from nabaztag.publisher import get_publisher
+
+logger = logging.getLogger(__name__)
 
 
 class Nabaztag(models.Model):
@@ -13,7 +20,7 @@ class Nabaztag(models.Model):
 
     # Identification
     id = models.CharField(max_length=17, primary_key=True)
-    name = models.CharField(max_length=255, blank=True)
+    name = models.CharField(max_length=255, blank=True, db_index=True)
 
     #Ear Positions
     left_ear_pos = models.PositiveIntegerField(
@@ -45,52 +52,166 @@ class Nabaztag(models.Model):
     latitude = models.DecimalField(max_digits=10, decimal_places=7, blank=True, null=True)
     longitude = models.DecimalField(max_digits=10, decimal_places=7, blank=True, null=True)
 
+    # Fields held in the state cache, see nabaztag.state
+    STATE_FIELDS = ('name', 'left_ear_pos', 'right_ear_pos', 'top_led_color', 'bottom_led_color', 'latitude', 'longitude')
+
+    @classmethod
+    def from_state(cls, pk, values):
+
+        """Returns a Nabaztag built from its cached state, without reading the database.
+
+        :param pk: The primary key of the Nabaztag.
+        :param values: A Dict of field values, from get_state()
+        """
+
+        fields = dict((name, cls._meta.get_field(name).to_python(values[name])) for name in cls.STATE_FIELDS)
+        nabaztag = cls(id=pk, **fields)
+
+        # The Nabaztag exists in the database, so saving it must update rather than insert.
+        nabaztag._state.adding = False
+        nabaztag._state.db = 'default'
+
+        return nabaztag
+
+    def get_state(self):
+
+        """Returns a Dict of the field values held in the state cache.
+        """
+
+        return dict((name, getattr(self, name)) for name in self.STATE_FIELDS)
+
+    def update_state(self, **fields):
+
+        """Sets some of this Nabaztag's fields, and updates its cached state.
+
+        If write-behind is enabled (NABAZTAG_WRITE_BEHIND_INTERVAL), the fields are saved to the database
+        in the next batch, otherwise only those fields are saved straight away.
+
+        :param fields: The field values to set, e.g. left_ear_pos=5
+        """
+
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+        writer = get_writer()
+
+        if writer is not None:
+            writer.defer([self.id], fields)
+        else:
+            self.save(update_fields=fields.keys())
+
+        state.store(self.id, self.get_state())
+
     def get_pairings(self):
 
         """Returns a Dict of all Nabaztags which this Nabaztag is paired to.
         """
 
-        pairing_list = {}
+        pairings = PairedNabaztags.objects.filter(nabaztag=self.id)
+
+        return dict(pairings.values_list('paired_nabaztag__id', 'paired_nabaztag__name'))
+
+    def get_followers(self):
+
+        """Returns a QuerySet of all Nabaztags which are paired to this Nabaztag, i.e. receive its updates.
+
+        The followers are selected in a single query, which can also be used for bulk updates.
+        """
+
+        pairings = PairedNabaztags.objects.filter(paired_nabaztag=self.id)
+
+        return Nabaztag.objects.filter(id__in=pairings.values('nabaztag'))
+
+    def publish(self, message):
+
+        """Places a message in the redis pub-sub message queue identified by this Nabaztag's identifier.
+
+        Messages are sent through the shared publisher for this Nabaztag, rather than a new connection each time.
+
+        :param message: A Dict containing the message, which is serialised to JSON.
+        """
+
+        get_publisher(self.id).publish_message(json.dumps(message))
 
-        for pairing in PairedNabaztags.objects.all().filter(nabaztag=self.id):
-            pairing_list.update({pairing.paired_nabaztag.id: pairing.paired_nabaztag.name})
+    def publish_batch(self, messages):
 
-        return pairing_list
+        """Places several messages in the redis pub-sub message queue as one batch message.
 
-    def move_ear(self, ear, position):
+        The Nabaztag unpacks the batch and acts on each message in order, so several commands
+        cost a single publish and a single websocket frame.
+
+        :param messages: A List of message Dicts.
+        """
+
+        self.publish(batch_message(messages))
+
+    def move_ear(self, ear, position, ms=0):
 
         """Places an ear message in the redis pub-sub message queue identified by this Nabaztag's identifier.
 
         :param ear: The ear to move.
         :param position: The position to move it to.
+        :param ms: The number of milliseconds the movement should take, or 0 to move at full speed.
+        """
+
+        self.publish(ear_message(ear, position, ms))
+
+    def move_ears(self, left_position, right_position):
+
+        """Places a single batch message moving both ears in the redis pub-sub message queue.
+
+        :param left_position: The position to move the left ear to.
+        :param right_position: The position to move the right ear to.
         """
 
-        connection = RedisPublisher(facility=self.id, broadcast=True)
-        message = {"ear": ear, "pos": position}
-        connection.publish_message(json.dumps(message))
+        self.publish_batch([ear_message('L', left_position), ear_message('R', right_position)])
 
-    def change_led(self, led, color):
+    def change_led(self, led, color, ms=0):
 
         """Places an LED message in the redis pub-sub message queue identified by this Nabaztag's identifier.
 
         :param led: The led to change.
         :param color: A tuple containing RGB values for the colour to set, e.g. (255, 255, 255)
+        :param ms: The number of milliseconds to fade to the colour over, or 0 to change it straight away.
+        The fade is carried out by the Nabaztag itself, so it costs a single message.
         """
 
-        connection = RedisPublisher(facility=self.id, broadcast=True)
-        message = {'led': led, 'red': color[0], 'green': color[1], 'blue': color[2]}
-        connection.publish_message(json.dumps(message))
+        self.publish(led_message(led, color, ms))
+
+    def change_leds(self, top_color, bottom_color):
+
+        """Places a single batch message changing both LEDs in the redis pub-sub message queue.
+
+        :param top_color: A tuple containing RGB values for the top LED.
+        :param bottom_color: A tuple containing RGB values for the bottom LED.
+        """
+
+        self.publish_batch([led_message('T', top_color), led_message('B', bottom_color)])
 
     def speak_message(self, text):
 
         """Places a speech in the redis pub-sub message queue identified by this Nabaztag's identifier.
 
         :param text: The text to send to the text-to-speech service.
+
+        If server-side speech is enabled, the speech is rendered once on the server and the message also
+        contains the URL of the audio, for the Nabaztag to play rather than synthesise. The text is always
+        sent, so the Nabaztag can still speak if the audio can't be rendered or fetched.
+        """
+
+        self.publish(speech_message(text))
+
+    def play_choreography(self, frames):
+
+        """Places a choreography message in the redis pub-sub message queue identified by this Nabaztag's identifier.
+
+        The Nabaztag plays the choreography to its own clock, so the timing doesn't depend on the network.
+
+        :param frames: A List of ear and LED message Dicts, each with an 'at' key giving the number of
+        milliseconds from the start of the choreography to act on it, e.g. dict(ear_message('L', 5), at=500)
         """
 
-        connection = RedisPublisher(facility=self.id, broadcast=True)
-        message = {'speak': 1, 'text': text}
-        connection.publish_message(json.dumps(message))
+        self.publish(choreography_message(frames))
 
 
 class PairedNabaztags(models.Model):
@@ -107,5 +228,134 @@ class PairedNabaztags(models.Model):
 
     class Meta:
         """Ensure that a particular pairing between from one Nabaztag to another is unique.
+
+        Followers are looked up by paired_nabaztag, so it also has an index leading with paired_nabaztag,
+        which covers the follower lookup without reading the table.
         """
-        unique_together = (("nabaztag", "paired_nabaztag"),)
\ No newline at end of file
+        unique_together = (("nabaztag", "paired_nabaztag"),)
+        index_together = (("paired_nabaztag", "nabaztag"),)
+
+
+@receiver(post_save, sender=Nabaztag)
+@receiver(post_delete, sender=Nabaztag)
+def invalidate_state(sender, instance, **kwargs):
+
+    """Removes a Nabaztag's cached state whenever it is saved or deleted, e.g. through the admin site.
+    """
+
+    state.invalidate(instance.id)
+
+
+@receiver(post_save, sender=Nabaztag)
+@receiver(post_delete, sender=Nabaztag)
+def invalidate_index(sender, instance, created=False, update_fields=None, **kwargs):
+
+    """Invalidates the cached index pages whenever a Nabaztag is created, deleted, or may have been renamed.
+    """
+
+    if created or update_fields is None or 'name' in update_fields:
+        state.invalidate_index()
+
+
+def get_nabaztag(pk):
+
+    """Returns the Nabaztag identified by pk, from the state cache if possible.
+
+    On a cache miss the Nabaztag is read from the database, and its state cached for next time. Any
+    changes this process hasn't yet saved to the database are applied on top.
+
+    :param pk: The primary key of the Nabaztag.
+
+    Raises a Nabaztag.DoesNotExist if there is no such Nabaztag.
+    """
+
+    values = state.get(pk)
+
+    if values is not None:
+        nabaztag = Nabaztag.from_state(pk, values)
+    else:
+        nabaztag = Nabaztag.objects.get(pk=pk)
+
+    writer = get_writer()
+    pending = writer.get_pending(pk) if writer is not None else {}
+
+    for name, value in pending.items():
+        setattr(nabaztag, name, value)
+
+    if values is None:
+        state.store(pk, nabaztag.get_state())
+
+    return nabaztag
+
+
+def ear_message(ear, position, ms=0):
+
+    """Returns the message Dict for moving an ear.
+
+    :param ear: The ear to move.
+    :param position: The position to move it to.
+    :param ms: The number of milliseconds the movement should take, or 0 to move at full speed.
+    """
+
+    message = {'ear': ear, 'pos': position}
+
+    if ms:
+        message['ms'] = ms
+
+    return message
+
+
+def led_message(led, color, ms=0):
+
+    """Returns the message Dict for changing an LED.
+
+    :param led: The led to change.
+    :param color: A tuple containing RGB values for the colour to set, e.g. (255, 255, 255)
+    :param ms: The number of milliseconds to fade to the colour over, or 0 to change it straight away.
+    """
+
+    message = {'led': led, 'red': color[0], 'green': color[1], 'blue': color[2]}
+
+    if ms:
+        message['ms'] = ms
+
+    return message
+
+
+def speech_message(text):
+
+    """Returns the message Dict for speaking text, rendering the audio on the server if enabled.
+
+    :param text: The text to speak.
+    """
+
+    message = {'speak': 1, 'text': text}
+
+    if speech.ENABLED:
+        try:
+            message['audio'] = speech.render(text)
+        except speech.SpeechError as e:
+            logger.error("Server-side speech failed, Nabaztags will synthesise it: {error}".format(error=e))
+
+    return message
+
+
+def choreography_message(frames):
+
+    """Returns the message Dict for playing a choreography, which replaces any the Nabaztag is playing.
+
+    :param frames: A List of timed ear and LED message Dicts, see Nabaztag.play_choreography()
+    An empty List stops the choreography the Nabaztag is playing.
+    """
+
+    return {'choreography': frames}
+
+
+def batch_message(messages):
+
+    """Returns a batch message Dict containing several messages, to be acted on in order.
+
+    :param messages: A List of message Dicts.
+    """
+
+    return {'batch': messages}
@@ -0,0 +1,122 @@
+import threading
+from django.conf import settings
+from redis import BlockingConnectionPool, StrictRedis
+from ws4redis import settings as ws4redis_settings
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisStore
+
+
+# Upper bound on the number of Redis connections opened by a single server process.
+MAX_CONNECTIONS = getattr(settings, 'NABAZTAG_REDIS_MAX_CONNECTIONS', 20)
+
+# Number of seconds to wait for a free connection once MAX_CONNECTIONS are in use, before giving up.
+CONNECTION_TIMEOUT = getattr(settings, 'NABAZTAG_REDIS_CONNECTION_TIMEOUT', 5)
+
+# Process-wide state, created lazily on first use.
+_connection = None
+_publishers = {}
+_lock = threading.RLock()
+
+
+class PooledRedisPublisher(RedisPublisher):
+
+    """A RedisPublisher which publishes over the shared, process-wide connection pool.
+
+    The standard RedisPublisher opens a new Redis connection every time it is created, instances
+    of this class are created once per facility and reused for every message.
+    """
+
+    def __init__(self, **kwargs):
+
+        """Create an instance of PooledRedisPublisher.
+
+        Takes the same keyword arguments as RedisPublisher, e.g. facility and broadcast.
+        """
+
+        RedisStore.__init__(self, get_connection())
+        for key in self._get_message_channels(**kwargs):
+            self._publishers.add(key)
+
+    def publish_to_pipeline(self, pipeline, message):
+
+        """Adds the commands to publish a message to a Redis pipeline, rather than sending them immediately.
+
+        :param pipeline: A Redis pipeline, e.g. from get_connection().pipeline()
+        :param message: The message to publish.
+        """
+
+        for channel in self._publishers:
+            pipeline.publish(channel, message)
+            if ws4redis_settings.WS4REDIS_EXPIRE > 0:
+                pipeline.setex(channel, ws4redis_settings.WS4REDIS_EXPIRE, message)
+
+
+def get_connection():
+
+    """Returns the StrictRedis connection shared by every publisher in this process.
+
+    Once every connection in the pool is in use, callers wait for one to be returned rather than failing.
+    """
+
+    global _connection
+
+    if _connection is None:
+        with _lock:
+            if _connection is None:
+                pool = BlockingConnectionPool(
+                    max_connections=MAX_CONNECTIONS,
+                    timeout=CONNECTION_TIMEOUT,
+                    **ws4redis_settings.WS4REDIS_CONNECTION
+                )
+                _connection = StrictRedis(connection_pool=pool)
+
+    return _connection
+
+
+def get_publisher(facility):
+
+    """Returns the broadcast publisher for the given facility, creating it on first use.
+
+    :param facility: The facility to publish to, i.e. the identifier of a Nabaztag.
+    """
+
+    publisher = _publishers.get(facility)
+
+    if publisher is None:
+        with _lock:
+            publisher = _publishers.get(facility)
+            if publisher is None:
+                publisher = _publishers[facility] = PooledRedisPublisher(facility=facility, broadcast=True)
+
+    return publisher
+
+
+def publish_many(facilities, message):
+
+    """Publishes the same message to several facilities in a single pipelined round-trip to Redis.
+
+    :param facilities: An iterable of facilities to publish to, i.e. Nabaztag identifiers.
+    :param message: The message to publish.
+    """
+
+    pipeline = get_connection().pipeline(transaction=False)
+
+    for facility in facilities:
+        get_publisher(facility).publish_to_pipeline(pipeline, message)
+
+    pipeline.execute()
+
+
+def publish_each(messages):
+
+    """Publishes a different message to each of several facilities in a single pipelined round-trip to Redis.
+
+    :param messages: A Dict of the message for each facility, e.g. {'00:00:00:00:00:01': '{"ear": "L", "pos": 0}'}
+    """
+
+    pipeline = get_connection().pipeline(transaction=False)
+
+    for facility, message in messages.items():
+        get_publisher(facility).publish_to_pipeline(pipeline, message)
+
+    pipeline.execute()
@@ -0,0 +1,100 @@
+import os
+import uuid
+import hashlib
+import logging
+import threading
+import subprocess
+from django.conf import settings
+
+
+# Whether speech is rendered on the server rather than by each Nabaztag, and the festival voice to render it with.
+ENABLED = getattr(settings, 'NABAZTAG_TTS_ENABLED', False)
+VOICE = getattr(settings, 'NABAZTAG_TTS_VOICE', 'kal_diphone')
+
+# Rendered speech is kept in MEDIA_ROOT, which is served by Nginx.
+SPEECH_ROOT = os.path.join(settings.MEDIA_ROOT, 'speech')
+SPEECH_URL = settings.MEDIA_URL + 'speech/'
+
+logger = logging.getLogger(__name__)
+
+_locks = {}
+_lock = threading.Lock()
+
+
+class SpeechError(Exception):
+
+    """Raised when speech can't be rendered.
+    """
+
+    pass
+
+
+def render(text, voice=VOICE):
+
+    """Returns the URL of a WAV file of the text being spoken, rendering it if it hasn't been before.
+
+    Files are named by a hash of the voice and text, so each is only rendered once, however many
+    Nabaztags it is sent to. Requests rendering the same text at the same time wait for one rendering.
+
+    :param text: The text to speak.
+    :param voice: The festival voice to speak with, e.g. 'kal_diphone'
+
+    Raises a SpeechError if festival fails.
+    """
+
+    filename = audio_filename(text, voice)
+    path = os.path.join(SPEECH_ROOT, filename)
+
+    if not os.path.exists(path):
+        with _lock:
+            lock = _locks.setdefault(filename, threading.Lock())
+
+        with lock:
+            if not os.path.exists(path):
+                synthesise(text, voice, path)
+
+        with _lock:
+            _locks.pop(filename, None)
+
+    return SPEECH_URL + filename
+
+
+def synthesise(text, voice, path):
+
+    """Renders speech to a WAV file with festival's text2wave.
+
+    The text is written to text2wave's input rather than its command line, and no shell is used. The
+    file is written under a temporary name and then renamed, so it is never served half written.
+
+    :param text: The text to speak.
+    :param voice: The festival voice to speak with.
+    :param path: The path of the WAV file to write.
+    """
+
+    if not os.path.isdir(SPEECH_ROOT):
+        os.makedirs(SPEECH_ROOT)
+
+    temporary_path = os.path.join(SPEECH_ROOT, uuid.uuid4().hex + '.tmp')
+    command = ['text2wave', '-eval', '(voice_{voice})'.format(voice=voice), '-o', temporary_path]
+
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, error = process.communicate(text.encode('utf-8'))
+    except OSError as e:
+        raise SpeechError("Could not run text2wave: {error}".format(error=e))
+
+    if process.returncode != 0 or not os.path.exists(temporary_path):
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise SpeechError("text2wave failed: {error}".format(error=error))
+
+    os.rename(temporary_path, path)
+    logger.info("Rendered speech {path}".format(path=path))
+
+
+def audio_filename(text, voice):
+
+    """Returns the name of the WAV file for the text spoken in the voice.
+    """
+
+    return hashlib.sha1(voice.encode('utf-8') + '\0' + text.encode('utf-8')).hexdigest() + '.wav'
@@ -0,0 +1,122 @@
+import json
+import logging
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from redis import RedisError
+
+from nabaztag.publisher import get_connection
+
+
+# Number of seconds a Nabaztag's state is cached for, which bounds how stale it can become if an
+# invalidation is missed.
+STATE_TTL = getattr(settings, 'NABAZTAG_STATE_TTL', 300)
+
+STATE_KEY = 'nabaztag:state:{pk}'
+
+# Incremented whenever a Nabaztag is created, renamed or deleted, so rendered index pages from earlier versions
+# are no longer used by any server process.
+INDEX_VERSION_KEY = 'nabaztag:index:version'
+
+logger = logging.getLogger(__name__)
+
+
+def get(pk):
+
+    """Returns the cached state of a Nabaztag as a Dict of field values, or None if it isn't cached.
+
+    The cache is held in Redis, so it is shared by every server process. If Redis is unavailable,
+    None is returned and the Nabaztag is read from the database as normal.
+
+    :param pk: The primary key of the Nabaztag.
+    """
+
+    try:
+        state = get_connection().get(STATE_KEY.format(pk=pk))
+    except RedisError as e:
+        logger.error("State cache unavailable: {error}".format(error=e))
+        return None
+
+    return json.loads(state) if state is not None else None
+
+
+def store(pk, state):
+
+    """Caches the state of a Nabaztag.
+
+    :param pk: The primary key of the Nabaztag.
+    :param state: A Dict of field values, from Nabaztag.get_state()
+    """
+
+    try:
+        get_connection().setex(STATE_KEY.format(pk=pk), STATE_TTL, json.dumps(state, cls=DjangoJSONEncoder))
+    except RedisError as e:
+        logger.error("State cache unavailable: {error}".format(error=e))
+
+
+def invalidate(*pks):
+
+    """Removes the cached state of one or more Nabaztags, e.g. after they are updated in bulk.
+
+    :param pks: The primary keys of the Nabaztags.
+    """
+
+    if not pks:
+        return
+
+    try:
+        get_connection().delete(*[STATE_KEY.format(pk=pk) for pk in pks])
+    except RedisError as e:
+        logger.error("State cache unavailable, entries expire in {ttl}s: {error}".format(ttl=STATE_TTL, error=e))
+
+
+def update(pks, fields):
+
+    """Changes some field values in the cached state of one or more Nabaztags.
+
+    Nabaztags which aren't cached are left alone, they are read from the database when next needed.
+
+    :param pks: The primary keys of the Nabaztags.
+    :param fields: A Dict of field values, e.g. {'left_ear_pos': 0}
+    """
+
+    keys = [STATE_KEY.format(pk=pk) for pk in pks]
+
+    if not keys:
+        return
+
+    try:
+        redis = get_connection()
+        pipeline = redis.pipeline(transaction=False)
+
+        for key, state in zip(keys, redis.mget(keys)):
+            if state is not None:
+                state = json.loads(state)
+                state.update(fields)
+                pipeline.setex(key, STATE_TTL, json.dumps(state, cls=DjangoJSONEncoder))
+
+        pipeline.execute()
+    except RedisError as e:
+        logger.error("State cache unavailable: {error}".format(error=e))
+
+
+def get_index_version():
+
+    """Returns the current version of the list of Nabaztags, or None if Redis is unavailable.
+    """
+
+    try:
+        return int(get_connection().get(INDEX_VERSION_KEY) or 0)
+    except RedisError as e:
+        logger.error("State cache unavailable: {error}".format(error=e))
+        return None
+
+
+def invalidate_index():
+
+    """Moves the list of Nabaztags on to a new version, so that cached index pages are rendered again.
+    """
+
+    try:
+        get_connection().incr(INDEX_VERSION_KEY)
+    except RedisError as e:
+        logger.error("State cache unavailable: {error}".format(error=e))
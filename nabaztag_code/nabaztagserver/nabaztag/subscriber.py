@@ -0,0 +1,79 @@
+import json
+import logging
+from django.conf import settings
+from django.db import close_old_connections
+from ws4redis.subscriber import RedisSubscriber
+
+from nabaztag.fanout import relay
+from nabaztag.models import Nabaztag, get_nabaztag
+from nabaztag.views import ear_moved, button_pressed, set_location
+
+logger = logging.getLogger(__name__)
+
+
+class NabaztagSubscriber(RedisSubscriber):
+
+    """A RedisSubscriber which accepts updates sent by a Nabaztag over its websocket connection.
+
+    The websocket server passes every message received from a client to publish_message. Updates
+    ('moved', 'button' and 'location' messages) are handled in the same way as those POSTed to
+    /update/<pk>/ear, /update/<pk>/button and /update/<pk>/location. Any other message is published
+    as normal.
+    """
+
+    def set_pubsub_channels(self, request, channels):
+
+        """Called by the websocket server when a client connects.
+
+        The identifier of the connected Nabaztag is taken from the websocket URL, e.g. /ws/<identifier>
+        """
+
+        self.facility = request.path_info.replace(settings.WEBSOCKET_URL, '', 1)
+        super(NabaztagSubscriber, self).set_pubsub_channels(request, channels)
+
+    def publish_message(self, message, expire=None):
+
+        """Called by the websocket server for each message received from the connected client.
+
+        :param message: The message received.
+        :param expire: The number of seconds to keep the message for, if it is published.
+        """
+
+        try:
+            update = json.loads(message)
+        except ValueError:
+            update = None
+
+        if isinstance(update, dict) and ('moved' in update or 'button' in update or 'location' in update):
+            self.handle_update(update)
+        else:
+            super(NabaztagSubscriber, self).publish_message(message, expire)
+
+    def handle_update(self, update):
+
+        """Acts on an update from the connected Nabaztag, logging any update which isn't valid.
+
+        :param update: The update Dict, e.g. {"button": 1}
+        """
+
+        try:
+            nabaztag = get_nabaztag(self.facility)
+
+            if 'moved' in update:
+                event = ear_moved(update)
+            elif 'button' in update:
+                event = button_pressed(update)
+            else:
+                set_location(nabaztag, update)
+                event = None
+
+            if event is not None:
+                relay(nabaztag, *event)
+        except Nabaztag.DoesNotExist:
+            logger.error("Update from unknown Nabaztag {nabaztag}".format(nabaztag=self.facility))
+        except KeyError:
+            logger.error("Invalid update from {nabaztag}: {update}".format(nabaztag=self.facility,
+                                                                         update=json.dumps(update)))
+        finally:
+            # Websocket connections are long lived, so close the database connection once it passes CONN_MAX_AGE.
+            close_old_connections()
@@ -0,0 +1,202 @@
+import json
+from StringIO import StringIO
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.utils.unittest import skipUnless
+from mock import patch
+
+from nabaztag.forms import CreatePairingForm, DeletePairingForm
+from nabaztag.models import Nabaztag, PairedNabaztags
+from nabaztag.views import INDEX_PAGE_SIZE, get_pairing_candidates
+from nabaztag.writebehind import StateWriter
+
+
+class TestFollowerLookup(TestCase):
+    def setUp(self):
+        self.broadcaster = Nabaztag.objects.create(id="00:00:00:00:00:01", name="broadcaster")
+        for number in range(2, 6):
+            follower = Nabaztag.objects.create(id="00:00:00:00:00:0{0}".format(number), name="follower")
+            PairedNabaztags.objects.create(nabaztag=follower, paired_nabaztag=self.broadcaster)
+
+    def test_followers(self):
+        self.assertEquals(self.broadcaster.get_followers().count(), 4)
+
+    @skipUnless(connection.vendor == 'sqlite', "Query plans are checked on SQLite")
+    def test_followers_use_index(self):
+        sql, params = self.broadcaster.get_followers().query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        details = [row[-1] for row in cursor.fetchall()]
+        pairing_steps = [detail for detail in details if PairedNabaztags._meta.db_table in detail]
+        self.assertTrue(pairing_steps, details)
+        for detail in pairing_steps:
+            self.assertIn("USING COVERING INDEX", detail)
+            self.assertIn("paired_nabaztag_id=?", detail)
+
+
+class TestStateWriter(TestCase):
+    def setUp(self):
+        self.nabaztag = Nabaztag.objects.create(id="00:00:00:00:00:01", name="first")
+
+    @patch('nabaztag.writebehind.state.invalidate')
+    def test_flush_saves_and_invalidates(self, invalidate):
+        writer = StateWriter(interval=60, max_pending=500)
+        writer.defer([self.nabaztag.id], {'left_ear_pos': 5})
+        writer.flush()
+        self.assertEquals(Nabaztag.objects.get(pk=self.nabaztag.id).left_ear_pos, 5)
+        invalidate.assert_called_once_with(self.nabaztag.id)
+        self.assertEquals(writer.get_pending(self.nabaztag.id), {})
+
+
+class TestCreateIndexes(TestCase):
+    def test_existing_indexes_skipped(self):
+        output = StringIO()
+        call_command('createindexes', stdout=output)
+        self.assertTrue(output.getvalue())
+        self.assertNotIn("Created:", output.getvalue())
+
+
+class TestIndexView(TestCase):
+    def setUp(self):
+        for number in range(INDEX_PAGE_SIZE + 1):
+            Nabaztag.objects.create(id="00:00:00:00:{0:02x}:{1:02x}".format(number // 256, number % 256))
+
+    def test_paginated(self):
+        response = self.client.get('/')
+        self.assertEquals(len(response.context['nabaztag_list']), INDEX_PAGE_SIZE)
+        response = self.client.get('/?page=2')
+        self.assertEquals(len(response.context['nabaztag_list']), 1)
+
+
+class TestControlView(TestCase):
+    def setUp(self):
+        self.nabaztag = Nabaztag.objects.create(id="00:00:00:00:00:01", name="rabbit")
+        self.url = '/control/' + self.nabaztag.id
+
+    @patch.object(Nabaztag, 'publish')
+    def test_ajax_post_returns_changes(self, publish):
+        response = self.client.post(self.url, {'left_ear_pos': 5}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.content)['changes'], {'left_ear_pos': 5})
+        self.assertTrue(publish.called)
+
+    def test_ajax_post_returns_errors(self):
+        response = self.client.post(self.url, {'left_ear_pos': 18}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEquals(response.status_code, 400)
+        self.assertIn('left_ear_pos', json.loads(response.content)['errors'])
+
+
+class TestPairing(TestCase):
+    def setUp(self):
+        self.nabaztag = Nabaztag.objects.create(id="00:00:00:00:00:01", name="rabbit")
+        self.paired = Nabaztag.objects.create(id="00:00:00:00:00:02", name="rabbit paired")
+        self.unpaired = Nabaztag.objects.create(id="00:00:00:00:00:03", name="rabbit unpaired")
+        PairedNabaztags.objects.create(nabaztag=self.nabaztag, paired_nabaztag=self.paired)
+
+    def test_candidates_exclude_self_and_paired(self):
+        response = self.client.get('/control/' + self.nabaztag.id + '/pairing-candidates', {'q': 'rabbit'})
+        self.assertEquals(json.loads(response.content),
+                          {"candidates": [{"id": self.unpaired.id, "name": self.unpaired.name}]})
+
+    @skipUnless(connection.vendor == 'sqlite', "Query plans are checked on SQLite")
+    def test_candidates_use_index(self):
+        sql, params = get_pairing_candidates(self.nabaztag.id, u'rab').query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        details = [row[-1] for row in cursor.fetchall()]
+        nabaztag_steps = [detail for detail in details if Nabaztag._meta.db_table in detail]
+        self.assertTrue(nabaztag_steps, details)
+        for detail in nabaztag_steps:
+            self.assertTrue(detail.startswith("SEARCH"), details)
+            self.assertIn("USING", detail)
+
+    def test_create_pairing_validation(self):
+        form = CreatePairingForm({'create_pairing_identifier': self.unpaired.id}, nabaztag=self.nabaztag)
+        self.assertTrue(form.is_valid())
+        self.assertEquals(form.cleaned_data['nabaztag_to_pair'], self.unpaired)
+
+        form = CreatePairingForm({'create_pairing_identifier': self.paired.id}, nabaztag=self.nabaztag)
+        self.assertFalse(form.is_valid())
+
+        form = CreatePairingForm({'create_pairing_identifier': "00:00:00:00:00:09"}, nabaztag=self.nabaztag)
+        self.assertFalse(form.is_valid())
+
+    def test_delete_pairing_choices_scoped(self):
+        PairedNabaztags.objects.create(nabaztag=self.unpaired, paired_nabaztag=self.nabaztag)
+        form = DeletePairingForm(nabaztag=self.nabaztag)
+        self.assertEquals(list(form.fields['delete_pairing_identifier'].queryset.values_list('paired_nabaztag', flat=True)),
+                          [self.paired.id])
+
+
+class TestBulkCommand(TestCase):
+    def setUp(self):
+        self.first = Nabaztag.objects.create(id="00:00:00:00:00:01", name="first")
+        self.second = Nabaztag.objects.create(id="00:00:00:00:00:02", name="second")
+        PairedNabaztags.objects.create(nabaztag=self.second, paired_nabaztag=self.first)
+
+    def post(self, body):
+        return self.client.post('/bulk', json.dumps(body), content_type="application/json")
+
+    @patch('nabaztag.bulk.publish_each')
+    def test_commands(self, publish_each):
+        response = self.post({"commands": [
+            {"nabaztag": self.first.id, "ear": "L", "pos": 5},
+            {"nabaztag": self.first.id, "led": "T", "color": "#ff0000"},
+            {"nabaztag": self.second.id, "ear": "R", "pos": 3},
+        ]})
+        self.assertEquals(response.status_code, 200)
+        messages = publish_each.call_args[0][0]
+        self.assertEquals(json.loads(messages[self.first.id]),
+                          {"batch": [{"ear": "L", "pos": 5}, {"led": "T", "red": 255, "green": 0, "blue": 0}]})
+        self.assertEquals(json.loads(messages[self.second.id]), {"ear": "R", "pos": 3})
+
+    @patch('nabaztag.bulk.publish_each')
+    def test_led_fade(self, publish_each):
+        response = self.post({"commands": [{"nabaztag": self.first.id, "led": "T", "color": "#ff0000", "ms": 1000}]})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(publish_each.call_args[0][0][self.first.id]),
+                          {"led": "T", "red": 255, "green": 0, "blue": 0, "ms": 1000})
+
+    @patch('nabaztag.bulk.publish_each')
+    def test_followers_selector(self, publish_each):
+        response = self.post({"selector": {"followers": self.first.id}, "command": {"ear": "L", "pos": 0}})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(publish_each.call_args[0][0].keys(), [self.second.id])
+
+    @patch('nabaztag.bulk.publish_each')
+    def test_choreography(self, publish_each):
+        response = self.post({"selector": {"all": 1}, "command": {"choreography": [
+            {"at": 500, "ear": "L", "pos": 0},
+            {"at": 0, "ear": "L", "pos": 5},
+            {"at": 0, "led": "T", "color": "#0000ff"},
+        ]}})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(publish_each.call_args[0][0][self.first.id]), {"choreography": [
+            {"at": 500, "ear": "L", "pos": 0},
+            {"at": 0, "ear": "L", "pos": 5},
+            {"at": 0, "led": "T", "red": 0, "green": 0, "blue": 255},
+        ]})
+
+    @patch('nabaztag.bulk.publish_each')
+    def test_malformed_commands_rejected(self, publish_each):
+        response = self.post({"commands": [
+            {"nabaztag": [self.first.id], "ear": "L", "pos": 5},
+            {"nabaztag": self.second.id, "ear": "L", "pos": True},
+        ]})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(json.loads(response.content)['errors'], [
+            "Command 0: nabaztag must be a Nabaztag identifier",
+            "Command 1: Value of pos not in range 0-17.",
+        ])
+        self.assertFalse(publish_each.called)
+
+    @patch('nabaztag.bulk.publish_each')
+    def test_invalid_command_runs_nothing(self, publish_each):
+        response = self.post({"commands": [
+            {"nabaztag": self.first.id, "ear": "L", "pos": 5},
+            {"nabaztag": self.second.id, "ear": "L", "pos": 18},
+        ]})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(json.loads(response.content)['errors'], ["Command 1: Value of pos not in range 0-17."])
+        self.assertFalse(publish_each.called)
@@ -1,6 +1,8 @@
 # Django imports
-from django.http import Http404
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import Http404, HttpResponse
 from django.views.generic import DetailView, ListView
 
 # Django REST Framework imports
@@ -10,7 +12,9 @@ from rest_framework.views import APIView
 
 # Nabaztag imports
 from nabaztag.forms import *
-from nabaztag.models import Nabaztag, PairedNabaztags
+from nabaztag import bulk, state
+from nabaztag.fanout import get_engine, FanoutBusyError
+from nabaztag.models import Nabaztag, PairedNabaztags, batch_message, ear_message, get_nabaztag
 
 # Other imports
 import json
@@ -25,6 +29,17 @@ ZERO_EAR_POS = 0
 ZERO_COLOR_VALUE = "#000000"
 PRESSED = 1
 
+# Nabaztag fields holding the position of each ear
+EAR_FIELDS = {LEFT: 'left_ear_pos', RIGHT: 'right_ear_pos'}
+
+# Maximum number of Nabaztags suggested when searching for one to pair with
+PAIRING_CANDIDATES = 10
+
+# Number of Nabaztags on each page of the index, and the number of seconds a rendered page is cached for
+INDEX_PAGE_SIZE = getattr(settings, 'NABAZTAG_INDEX_PAGE_SIZE', 50)
+INDEX_CACHE_TTL = getattr(settings, 'NABAZTAG_INDEX_CACHE_TTL', 30)
+INDEX_CACHE_KEY = 'nabaztag:index:{version}:{page}'
+
 
 ################## VIEW CLASSES ##################
 
@@ -32,11 +47,36 @@ class IndexView(ListView):
 
     """Instances of this class are created with requests to /
 
-    A response is returned containing a list of all Nabaztags ordered by name.
+    A response is returned containing a page of the list of all Nabaztags ordered by name. Only the
+    identifier and name of each Nabaztag is loaded, and rendered pages are cached until a Nabaztag is
+    created, renamed or deleted, or for INDEX_CACHE_TTL seconds.
     """
 
     template_name = 'index.html'
-    queryset = Nabaztag.objects.all().order_by('name')
+    queryset = Nabaztag.objects.only('id', 'name').order_by('name', 'id')
+    paginate_by = INDEX_PAGE_SIZE
+
+    def get(self, request, *args, **kwargs):
+
+        """Returns the cached page if there is one, otherwise renders the page and caches it.
+        """
+
+        version = state.get_index_version()
+
+        # If Redis is unavailable we can't tell whether a cached page is current, so don't use one.
+        if version is None:
+            return super(IndexView, self).get(request, *args, **kwargs)
+
+        key = INDEX_CACHE_KEY.format(version=version, page=request.GET.get('page', 1))
+        content = cache.get(key)
+
+        if content is None:
+            response = super(IndexView, self).get(request, *args, **kwargs)
+            response.render()
+            cache.set(key, response.content, INDEX_CACHE_TTL)
+            return response
+
+        return HttpResponse(content)
 
 
 class ControlView(DetailView):
@@ -51,10 +91,13 @@ class ControlView(DetailView):
 
     def get_object(self, queryset=None):
 
-        """Returns the Nabaztag object identified by the pk value in the url.
+        """Returns the Nabaztag object identified by the pk value in the url, from the state cache if possible.
         """
 
-        return get_object_or_404(Nabaztag, pk=self.kwargs.get('pk', None))
+        try:
+            return get_nabaztag(self.kwargs.get('pk', None))
+        except Nabaztag.DoesNotExist:
+            raise Http404
 
     def get_context_data(self, **kwargs):
 
@@ -89,91 +132,174 @@ class ControlView(DetailView):
         confirms the form is valid and sets the relevant value in the Nabaztag object, then
         calls the relevant function in the Nabaztag object to send the new value over the
         websocket connection.
+
+        Only the submitted form is built. Requests made by the control page's javascript
+        (X-Requested-With: XMLHttpRequest) get a small JSON response containing any form errors
+        and the values changed, rather than the whole page.
         """
 
-        self.object = self.get_object()
+        self.object = nabaztag = self.get_object()
+        name, form = self.get_submitted_form(request.POST, nabaztag)
+
+        if form is not None and form.is_valid():
+            changes = self.apply_form(name, form.cleaned_data, nabaztag)
+            errors = {}
+        else:
+            changes = {}
+            errors = dict((field, [unicode(error) for error in field_errors])
+                          for field, field_errors in form.errors.items()) if form is not None else {'__all__': ["Unknown form"]}
+
+        if request.is_ajax():
+            return HttpResponse(
+                json.dumps({"status": 400 if errors else 200, "errors": errors, "changes": changes}),
+                status=400 if errors else 200,
+                content_type="application/json"
+            )
+
         context = self.get_context_data(**kwargs)
-        nabaztag = self.object
-
-        if 'left_ear_pos' in request.POST:
-            context['left_ear_form'] = LeftEarForm(request.POST)
-            if context['left_ear_form'].is_valid():
-                position = context['left_ear_form'].cleaned_data['left_ear_pos']
-                nabaztag.left_ear_pos = position
-                nabaztag.save()
-                nabaztag.move_ear(LEFT, position)
-
-        elif 'right_ear_pos' in request.POST:
-            context['right_ear_form'] = RightEarForm(request.POST)
-            if context['right_ear_form'].is_valid():
-                position = context['right_ear_form'].cleaned_data['right_ear_pos']
-                nabaztag.right_ear_pos = position
-                nabaztag.save()
-                nabaztag.move_ear(RIGHT, position)
-
-        elif 'reset_ears' in request.POST:
-            context['reset_ears_form'] = ResetEarsForm(request.POST)
-            if context['reset_ears_form'].is_valid():
-                nabaztag.left_ear_pos = ZERO_EAR_POS
-                nabaztag.right_ear_pos = ZERO_EAR_POS
-                nabaztag.save()
-                context['left_ear_form'] = LeftEarForm({'left_ear_pos': context['nabaztag'].left_ear_pos})
-                context['right_ear_form'] = RightEarForm({'right_ear_pos': context['nabaztag'].right_ear_pos})
-                nabaztag.move_ear(LEFT, ZERO_EAR_POS)
-                nabaztag.move_ear(RIGHT, ZERO_EAR_POS)
-
-        elif 'top_led_color' in request.POST:
-            context['top_led_form'] = TopLedForm(request.POST)
-            if context['top_led_form'].is_valid():
-                color = context['top_led_form'].cleaned_data['top_led_color']
-                nabaztag.top_led_color = color
-                nabaztag.save()
-                nabaztag.change_led(TOP, hex_to_rgb(color))
-
-        elif 'bottom_led_color' in request.POST:
-            context['bottom_led_form'] = BottomLEDForm(request.POST)
-            if context['bottom_led_form'].is_valid():
-                color = context['bottom_led_form'].cleaned_data['bottom_led_color']
-                nabaztag.bottom_led_color = color
-                nabaztag.save()
-                nabaztag.change_led(BOTTOM, hex_to_rgb(color))
-
-        elif 'reset_leds' in request.POST:
-            context['reset_leds_form'] = ResetLedsForm(request.POST)
-            if context['reset_leds_form'].is_valid():
-                nabaztag.top_led_color = ZERO_COLOR_VALUE
-                nabaztag.bottom_led_color = ZERO_COLOR_VALUE
-                nabaztag.save()
-                context['top_led_form'] = TopLedForm({'top_led_color': context['nabaztag'].top_led_color})
-                context['bottom_led_form'] = BottomLEDForm({'bottom_led_color': context['nabaztag'].bottom_led_color})
-                nabaztag.change_led(TOP, hex_to_rgb(ZERO_COLOR_VALUE))
-                nabaztag.change_led(BOTTOM, hex_to_rgb(ZERO_COLOR_VALUE))
-
-        elif 'create_pairing_identifier' in request.POST:
-            context['create_pairing_form'] = CreatePairingForm(request.POST, nabaztag=nabaztag)
-            if context['create_pairing_form'].is_valid():
-                nabaztag_to_pair = Nabaztag.objects.get(id=context['create_pairing_form'].
-                                                        cleaned_data['create_pairing_identifier'])
-                pairing = PairedNabaztags(nabaztag=nabaztag, paired_nabaztag=nabaztag_to_pair)
-                pairing.save()
-                context['paired_list'] = nabaztag.get_pairings()
-
-        elif 'delete_pairing_identifier' in request.POST:
-            context['delete_pairing_form'] = DeletePairingForm(request.POST, nabaztag=nabaztag)
-            if context['delete_pairing_form'].is_valid():
-                nabaztag_to_unpair = context['delete_pairing_form']. \
-                    cleaned_data['delete_pairing_identifier'].paired_nabaztag
-                PairedNabaztags.objects.filter(nabaztag=nabaztag, paired_nabaztag=nabaztag_to_unpair).delete()
-                context['paired_list'] = nabaztag.get_pairings()
-
-        elif 'text_to_speech' in request.POST:
-            ttsform = TextToSpeechForm(request.POST, auto_id=False)
-            if ttsform.is_valid():
-                text = ttsform.cleaned_data['text_to_speech']
-                nabaztag.speak_message(text)
+
+        # Show the submitted form with its errors, the other forms show the Nabaztag's current state.
+        if errors and form is not None:
+            context[name] = form
 
         return self.render_to_response(context)
 
+    def get_submitted_form(self, data, nabaztag):
+
+        """Returns the context name of the form submitted, and the form bound to the POST data.
+
+        :param data: The POST data of the request.
+        :param nabaztag: The Nabaztag object being controlled.
+        :returns: A tuple of the name and form, or (None, None) if the POST data doesn't match a form.
+        """
+
+        if 'left_ear_pos' in data:
+            return 'left_ear_form', LeftEarForm(data)
+        elif 'right_ear_pos' in data:
+            return 'right_ear_form', RightEarForm(data)
+        elif 'reset_ears' in data:
+            return 'reset_ears_form', ResetEarsForm(data)
+        elif 'top_led_color' in data:
+            return 'top_led_form', TopLedForm(data)
+        elif 'bottom_led_color' in data:
+            return 'bottom_led_form', BottomLEDForm(data)
+        elif 'reset_leds' in data:
+            return 'reset_leds_form', ResetLedsForm(data)
+        elif 'create_pairing_identifier' in data:
+            return 'create_pairing_form', CreatePairingForm(data, nabaztag=nabaztag)
+        elif 'delete_pairing_identifier' in data:
+            return 'delete_pairing_form', DeletePairingForm(data, nabaztag=nabaztag)
+        elif 'text_to_speech' in data:
+            return 'text_to_speech_form', TextToSpeechForm(data, auto_id=False)
+
+        return None, None
+
+    def apply_form(self, name, data, nabaztag):
+
+        """Acts on a valid form, updating the Nabaztag's state and sending it the new values.
+
+        :param name: The context name of the form, from get_submitted_form.
+        :param data: The cleaned data of the form.
+        :param nabaztag: The Nabaztag object being controlled.
+        :returns: A Dict of the values changed, e.g. {'left_ear_pos': 5}
+        """
+
+        if name == 'left_ear_form':
+            nabaztag.update_state(left_ear_pos=data['left_ear_pos'])
+            nabaztag.move_ear(LEFT, data['left_ear_pos'])
+            return {'left_ear_pos': data['left_ear_pos']}
+
+        elif name == 'right_ear_form':
+            nabaztag.update_state(right_ear_pos=data['right_ear_pos'])
+            nabaztag.move_ear(RIGHT, data['right_ear_pos'])
+            return {'right_ear_pos': data['right_ear_pos']}
+
+        elif name == 'reset_ears_form':
+            nabaztag.update_state(left_ear_pos=ZERO_EAR_POS, right_ear_pos=ZERO_EAR_POS)
+            nabaztag.move_ears(ZERO_EAR_POS, ZERO_EAR_POS)
+            return {'left_ear_pos': ZERO_EAR_POS, 'right_ear_pos': ZERO_EAR_POS}
+
+        elif name == 'top_led_form':
+            nabaztag.update_state(top_led_color=data['top_led_color'])
+            nabaztag.change_led(TOP, hex_to_rgb(data['top_led_color']))
+            return {'top_led_color': data['top_led_color']}
+
+        elif name == 'bottom_led_form':
+            nabaztag.update_state(bottom_led_color=data['bottom_led_color'])
+            nabaztag.change_led(BOTTOM, hex_to_rgb(data['bottom_led_color']))
+            return {'bottom_led_color': data['bottom_led_color']}
+
+        elif name == 'reset_leds_form':
+            nabaztag.update_state(top_led_color=ZERO_COLOR_VALUE, bottom_led_color=ZERO_COLOR_VALUE)
+            nabaztag.change_leds(hex_to_rgb(ZERO_COLOR_VALUE), hex_to_rgb(ZERO_COLOR_VALUE))
+            return {'top_led_color': ZERO_COLOR_VALUE, 'bottom_led_color': ZERO_COLOR_VALUE}
+
+        elif name == 'create_pairing_form':
+            pairing = PairedNabaztags(nabaztag=nabaztag, paired_nabaztag=data['nabaztag_to_pair'])
+            pairing.save()
+            return {'paired_list': nabaztag.get_pairings()}
+
+        elif name == 'delete_pairing_form':
+            nabaztag_to_unpair = data['delete_pairing_identifier'].paired_nabaztag
+            PairedNabaztags.objects.filter(nabaztag=nabaztag, paired_nabaztag=nabaztag_to_unpair).delete()
+            return {'paired_list': nabaztag.get_pairings()}
+
+        elif name == 'text_to_speech_form':
+            nabaztag.speak_message(data['text_to_speech'])
+            return {}
+
+
+class PairingCandidates(APIView):
+
+    """Instances of this class are created when a request is made to /control/<pk>/pairing-candidates?q=<search>
+
+    Only GET requests are acted upon.
+    """
+
+    def get(self, request, pk):
+
+        """Called when a GET request is made to /control/<pk>/pairing-candidates
+
+        :param request: The Django request object.
+        :param pk: The primary key of the Nabaztag being controlled.
+
+        Returns up to PAIRING_CANDIDATES Nabaztags whose identifier or name starts with the search
+        text, excluding the Nabaztag itself and those it is already paired with, e.g.
+        {"candidates": [{"id": "00:00:00:00:00:01", "name": "Rabbit"}]}
+        """
+
+        search = request.GET.get('q', '').strip()
+
+        if not search:
+            return Response({"candidates": []}, content_type="application/json")
+
+        return Response(
+            {"candidates": [{"id": id, "name": name} for id, name in
+                            get_pairing_candidates(pk, search).values_list('id', 'name')[:PAIRING_CANDIDATES]]},
+            content_type="application/json"
+        )
+
+
+def get_pairing_candidates(pk, search):
+
+    """Returns a QuerySet of the Nabaztags whose identifier or name starts with the search text, excluding
+    the Nabaztag identified by pk and those it is already paired with.
+
+    The prefix is matched as a range, name >= search AND name < search + u'\uffff', rather than with startswith,
+    which compiles to a case-insensitive LIKE on SQLite that can't use an index. The identifier and name are
+    both indexed, so the search doesn't scan the Nabaztag table. The match is case-sensitive.
+
+    :param pk: The primary key of the Nabaztag being controlled.
+    :param search: The search text.
+    """
+
+    end = search + u'\uffff'
+    paired = PairedNabaztags.objects.filter(nabaztag=pk).values('paired_nabaztag')
+
+    return Nabaztag.objects.filter(
+        Q(id__gte=search, id__lt=end) | Q(name__gte=search, name__lt=end)
+    ).exclude(id=pk).exclude(id__in=paired).order_by('name', 'id')
+
 
 ################## NABAZTAG API FUNCTIONS ##################
 
@@ -192,7 +318,7 @@ class EarMoved(APIView):
         """
 
         try:
-            return Nabaztag.objects.get(pk=pk)
+            return get_nabaztag(pk)
         except Nabaztag.DoesNotExist:
             raise Http404
 
@@ -203,35 +329,24 @@ class EarMoved(APIView):
         :param request: The Django request object.
         :param pk: The primary key of the Nabaztag object.
 
-        The Nabaztag object identified by pk is obtained, and we check whether any other
-        Nabaztag objects are paired to it. If so, their state is updated and we send them
-        a message telling them to reset the relevant ear, returning a HTTP_200_OK
+        The Nabaztag object identified by pk is obtained, and the event is passed to the fan-out
+        engine, returning a HTTP_200_OK straight away. In the background, any Nabaztags paired
+        to it have their state updated and are sent a message telling them to reset the relevant ear.
 
         If the body of the request is not valid JSON, or doesn't contain the information we
-        expect, return a HTTP_400_BAD_REQUEST.
+        expect, return a HTTP_400_BAD_REQUEST. If the fan-out engine is overloaded, return a
+        HTTP_503_SERVICE_UNAVAILABLE.
         """
 
         paired_nabaztag = self.get_object(pk)
-        pairings = PairedNabaztags.objects.all().filter(paired_nabaztag=paired_nabaztag)
 
         try:
-            message = json.loads(request.body)
-
-            for pair in pairings:
-                nabaztag = pair.nabaztag
-
-                if message['ear'] == LEFT:
-                    nabaztag.move_ear(LEFT, ZERO_EAR_POS)
-                    paired_nabaztag.left_ear_pos = ZERO_EAR_POS
-                    nabaztag.left_ear_pos = ZERO_EAR_POS
-                elif message['ear'] == RIGHT:
-                    nabaztag.move_ear(RIGHT, ZERO_EAR_POS)
-                    paired_nabaztag.right_ear_pos = ZERO_EAR_POS
-                    nabaztag.right_ear_pos = ZERO_EAR_POS
-
-                nabaztag.save()
-                paired_nabaztag.save()
-                return Response({"status": 200, "message": "OK"}, content_type="application/json")
+            event = ear_moved(json.loads(request.body))
+
+            if event is not None:
+                get_engine().submit(paired_nabaztag, *event)
+
+            return Response({"status": 200, "message": "OK"}, content_type="application/json")
         except ValueError:
             return Response(
                 {"status": 400, "message": "Request was not valid JSON"},
@@ -244,6 +359,12 @@ class EarMoved(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
                 content_type="application/json"
             )
+        except FanoutBusyError:
+            return Response(
+                {"status": 503, "message": "Server busy, try again later"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                content_type="application/json"
+            )
 
 
 class ButtonPressed(APIView):
@@ -261,7 +382,7 @@ class ButtonPressed(APIView):
         """
 
         try:
-            return Nabaztag.objects.get(pk=pk)
+            return get_nabaztag(pk)
         except Nabaztag.DoesNotExist:
             raise Http404
 
@@ -272,34 +393,23 @@ class ButtonPressed(APIView):
         :param request: The Django request object.
         :param pk: The primary key of the Nabaztag object.
 
-        The Nabaztag object identified by pk is obtained, and we check whether any other
-        Nabaztag objects are paired to it. If so, their state is updated and we send them
-        a message telling them to reset both ears, returning a HTTP_200_OK
+        The Nabaztag object identified by pk is obtained, and the event is passed to the fan-out
+        engine, returning a HTTP_200_OK straight away. In the background, any Nabaztags paired
+        to it have their state updated and are sent a message telling them to reset both ears.
 
         If the body of the request is not valid JSON, or doesn't contain the information we
-        expect, return a HTTP_400_BAD_REQUEST.
+        expect, return a HTTP_400_BAD_REQUEST. If the fan-out engine is overloaded, return a
+        HTTP_503_SERVICE_UNAVAILABLE.
         """
 
         paired_nabaztag = self.get_object(pk)
-        pairings = PairedNabaztags.objects.all().filter(paired_nabaztag=paired_nabaztag)
 
         try:
-            message = json.loads(request.body)
+            event = button_pressed(json.loads(request.body))
 
-            for pair in pairings:
-                nabaztag = pair.nabaztag
+            if event is not None:
+                get_engine().submit(paired_nabaztag, *event)
 
-                if message['button'] == PRESSED:
-                    nabaztag.move_ear(LEFT, ZERO_EAR_POS)
-                    nabaztag.move_ear(RIGHT, ZERO_EAR_POS)
-                    paired_nabaztag.left_ear_pos = ZERO_EAR_POS
-                    paired_nabaztag.right_ear_pos = ZERO_EAR_POS
-                    nabaztag.left_ear_pos = ZERO_EAR_POS
-                    nabaztag.right_ear_pos = ZERO_EAR_POS
-
-                nabaztag.save()
-
-            paired_nabaztag.save()
             return Response({"status": 200, "message": "OK"}, content_type="application/json")
         except ValueError:
             return Response(
@@ -313,6 +423,12 @@ class ButtonPressed(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
                 content_type="application/json"
             )
+        except FanoutBusyError:
+            return Response(
+                {"status": 503, "message": "Server busy, try again later"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                content_type="application/json"
+            )
 
 
 class SetLocation(APIView):
@@ -330,7 +446,7 @@ class SetLocation(APIView):
         """
 
         try:
-            return Nabaztag.objects.get(pk=pk)
+            return get_nabaztag(pk)
         except Nabaztag.DoesNotExist:
             raise Http404
 
@@ -350,14 +466,7 @@ class SetLocation(APIView):
 
         try:
             nabaztag = self.get_object(pk)
-            location = json.loads(request.body)
-
-            # If the location service on the Nabaztag was unavilable, the body will contain {"unavailable": 1},
-            # in which case we don't update the location.
-            if not 'unavailable' in location:
-                nabaztag.latitude = location['lat']
-                nabaztag.longitude = location['lon']
-                nabaztag.save()
+            set_location(nabaztag, json.loads(request.body))
 
             return Response({"status": 200, "message": "OK"}, content_type="application/json")
         except ValueError:
@@ -374,6 +483,100 @@ class SetLocation(APIView):
             )
 
 
+class BulkCommand(APIView):
+
+    """Instances of this class are created when a request is made to /bulk
+
+    Only POST requests are acted upon.
+    """
+
+    def post(self, request):
+
+        """Called when a POST request is made to /bulk
+
+        :param request: The Django request object.
+
+        The body is a list of commands for many Nabaztags, or a command for every Nabaztag chosen by a
+        selector, see nabaztag.bulk.run. All of the commands are validated, then run together, returning
+        a HTTP_200_OK with the number of Nabaztags and commands.
+
+        If the body of the request is not valid JSON, or any command is invalid, none are run and a
+        HTTP_400_BAD_REQUEST is returned listing the errors.
+        """
+
+        try:
+            summary = bulk.run(json.loads(request.body))
+
+            return Response(dict(summary, status=200, message="OK"), content_type="application/json")
+        except ValueError:
+            return Response(
+                {"status": 400, "message": "Request was not valid JSON"},
+                status=status.HTTP_400_BAD_REQUEST,
+                content_type="application/json"
+            )
+        except bulk.BulkCommandError as e:
+            return Response(
+                {"status": 400, "message": "Invalid request", "errors": e.errors},
+                status=status.HTTP_400_BAD_REQUEST,
+                content_type="application/json"
+            )
+
+
+################## UPDATE FUNCTIONS ##################
+
+# These functions are shared by the update views above, and by the websocket server (nabaztag.subscriber)
+# for updates which Nabaztags send over their websocket connection.
+
+def ear_moved(update):
+
+    """Returns the event to relay to followers when an ear is moved on a Nabaztag.
+
+    :param update: The update from the Nabaztag, e.g. {"ear": "L", "moved": 1}
+    :returns: A tuple of the message to send to each follower and the field values to store, or None.
+
+    Raises a KeyError if the update doesn't contain the information we expect.
+    """
+
+    ear = update['ear']
+
+    if ear in EAR_FIELDS:
+        return ear_message(ear, ZERO_EAR_POS), {EAR_FIELDS[ear]: ZERO_EAR_POS}
+
+
+def button_pressed(update):
+
+    """Returns the event to relay to followers when the button is pressed on a Nabaztag.
+
+    :param update: The update from the Nabaztag, e.g. {"button": 1}
+    :returns: A tuple of the message to send to each follower and the field values to store, or None.
+
+    A Pi may also send "press": "double" or "long", which is ignored, so every kind of press resets the ears.
+
+    Raises a KeyError if the update doesn't contain the information we expect.
+    """
+
+    if update['button'] == PRESSED:
+        return (
+            batch_message([ear_message(LEFT, ZERO_EAR_POS), ear_message(RIGHT, ZERO_EAR_POS)]),
+            {'left_ear_pos': ZERO_EAR_POS, 'right_ear_pos': ZERO_EAR_POS}
+        )
+
+
+def set_location(nabaztag, location):
+
+    """Updates the stored location of a Nabaztag.
+
+    :param nabaztag: The Nabaztag object to update.
+    :param location: The location from the Nabaztag, e.g. {"lat": 50.93, "lon": -1.39, "location": 1}
+
+    Raises a KeyError if the location doesn't contain the information we expect.
+    """
+
+    # If the location service on the Nabaztag was unavilable, the body will contain {"unavailable": 1},
+    # in which case we don't update the location.
+    if not 'unavailable' in location:
+        nabaztag.update_state(latitude=location['lat'], longitude=location['lon'])
+
 
 ################## HELPER FUNCTIONS ##################
 
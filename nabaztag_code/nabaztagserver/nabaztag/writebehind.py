@@ -0,0 +1,177 @@
+import atexit
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from nabaztag import state
+
+
+# Number of seconds between flushes of deferred state changes to the database, i.e. the most recent
+# changes which may be lost if a server process dies. 0, the default, saves every change immediately.
+INTERVAL = getattr(settings, 'NABAZTAG_WRITE_BEHIND_INTERVAL', 0)
+
+# Number of Nabaztags with deferred changes which triggers a flush before the interval is up.
+MAX_PENDING = getattr(settings, 'NABAZTAG_WRITE_BEHIND_MAX_PENDING', 500)
+
+logger = logging.getLogger(__name__)
+
+_writer = None
+_lock = threading.Lock()
+
+
+class StateWriter(object):
+
+    """A class which collects changes to the state of Nabaztags and saves them to the database in batches.
+
+    Changes are merged per Nabaztag as they arrive, so a Nabaztag changed several times between flushes
+    is only written once. Each flush writes every pending change in a single transaction, grouping
+    Nabaztags given the same values into one UPDATE, so writers take the database lock once per interval
+    rather than once per change.
+    """
+
+    def __init__(self, interval, max_pending):
+
+        """Create an instance of StateWriter and start its flushing thread.
+
+        :param interval: The number of seconds between flushes.
+        :param max_pending: The number of Nabaztags with pending changes which triggers an early flush.
+        """
+
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+        flusher = threading.Thread(target=self.run, name="writebehind")
+        flusher.daemon = True
+        flusher.start()
+
+        # Save anything still pending when the server process exits normally.
+        atexit.register(self.flush)
+
+    def defer(self, pks, fields):
+
+        """Queues field values to be saved for one or more Nabaztags.
+
+        :param pks: An iterable of the primary keys of the Nabaztags.
+        :param fields: A Dict of field values, e.g. {'left_ear_pos': 0}
+        """
+
+        with self.lock:
+            for pk in pks:
+                self.pending.setdefault(pk, {}).update(fields)
+            full = len(self.pending) >= self.max_pending
+
+        if full:
+            self.wake.set()
+
+    def get_pending(self, pk):
+
+        """Returns the field values waiting to be saved for a Nabaztag, which may be empty.
+
+        :param pk: The primary key of the Nabaztag.
+        """
+
+        with self.lock:
+            return dict(self.pending.get(pk, {}))
+
+    def run(self):
+
+        """Started by the flushing thread.
+
+        Flushes pending changes every interval, or sooner if too many are pending, logging any error
+        without stopping the thread.
+        """
+
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to save deferred Nabaztag state")
+            finally:
+                close_old_connections()
+
+    def flush(self):
+
+        """Saves all pending changes to the database in a single transaction.
+
+        If the transaction fails, the changes are put back to be retried, unless they have since
+        been superseded by newer changes.
+
+        Once saved, the cached state of the Nabaztags is removed. Other server processes may have read and
+        cached their old state from the database while the changes were pending.
+        """
+
+        with self.lock:
+            batch, self.pending = self.pending, {}
+
+        if not batch:
+            return
+
+        started = time.time()
+
+        try:
+            updates = save_changes(batch)
+        except Exception:
+            with self.lock:
+                for pk, fields in batch.items():
+                    fields.update(self.pending.get(pk, {}))
+                    self.pending[pk] = fields
+            raise
+
+        state.invalidate(*batch.keys())
+
+        logger.info(
+            "Saved state of {count} Nabaztags in {updates} updates in {total:.1f}ms".format(
+                count=len(batch),
+                updates=updates,
+                total=(time.time() - started) * 1000
+            )
+        )
+
+
+def get_writer():
+
+    """Returns the StateWriter for this process, starting it on first use, or None if write-behind is disabled.
+    """
+
+    global _writer
+
+    if INTERVAL <= 0:
+        return None
+
+    if _writer is None:
+        with _lock:
+            if _writer is None:
+                _writer = StateWriter(INTERVAL, MAX_PENDING)
+
+    return _writer
+
+
+def save_changes(changes):
+
+    """Saves field values for several Nabaztags in a single transaction.
+
+    Nabaztags given the same values, e.g. every follower of a button press, share one UPDATE.
+
+    :param changes: A Dict of the field values for each Nabaztag, e.g. {'00:00:00:00:00:01': {'left_ear_pos': 0}}
+    :returns: The number of UPDATE statements run.
+    """
+
+    from nabaztag.models import Nabaztag
+
+    groups = {}
+    for pk, fields in changes.items():
+        groups.setdefault(tuple(sorted(fields.items())), []).append(pk)
+
+    with transaction.atomic():
+        for fields, pks in groups.items():
+            Nabaztag.objects.filter(pk__in=pks).update(**dict(fields))
+
+    return len(groups)
@@ -65,13 +65,58 @@ WEBSOCKET_URL = '/ws/'
 # Set the number of seconds each message shall persited
 WS4REDIS_EXPIRE = 3600
 
+# Subscriber used for each websocket connection, which also accepts updates sent by Nabaztags over the websocket.
+WS4REDIS_SUBSCRIBER = 'nabaztag.subscriber.NabaztagSubscriber'
+
+# Maximum number of Redis connections each server process may open to publish messages to Nabaztags, and the
+# number of seconds to wait for one to become free when they are all in use.
+NABAZTAG_REDIS_MAX_CONNECTIONS = 20
+NABAZTAG_REDIS_CONNECTION_TIMEOUT = 5
+
+# Number of worker threads relaying button presses and ear movements to paired Nabaztags, and the
+# maximum number of events which may wait for them, in each server process.
+NABAZTAG_FANOUT_WORKERS = 4
+NABAZTAG_FANOUT_QUEUE_SIZE = 1000
+
+# Number of seconds each Nabaztag's state (ear positions, LED colours, location) is cached in Redis, in
+# front of the database.
+NABAZTAG_STATE_TTL = 300
+
+# If NABAZTAG_WRITE_BEHIND_INTERVAL is set, state changes are saved to the database in a batch every that many
+# seconds (or once NABAZTAG_WRITE_BEHIND_MAX_PENDING Nabaztags have changes waiting). Up to that many seconds of
+# changes may be lost if a server process dies or is recycled by uWSGI, and other processes may see the old state
+# until the batch is saved. It is 0 by default, saving every change immediately.
+NABAZTAG_WRITE_BEHIND_INTERVAL = 0
+NABAZTAG_WRITE_BEHIND_MAX_PENDING = 500
+
+# Number of Nabaztags on each page of the index, and the number of seconds each rendered page is cached for.
+NABAZTAG_INDEX_PAGE_SIZE = 50
+NABAZTAG_INDEX_CACHE_TTL = 30
+
+# Maximum number of commands accepted by a single request to /bulk.
+NABAZTAG_BULK_MAX_COMMANDS = 1000
+
+# Render speech once on the server with festival's text2wave, and send Nabaztags the URL of the audio,
+# rather than have every Nabaztag synthesise it.
+NABAZTAG_TTS_ENABLED = False
+NABAZTAG_TTS_VOICE = 'kal_diphone'
+
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
 
+# The database is configured from the environment, defaulting to the SQLite file in db/, e.g. for PostgreSQL:
+# NABAZTAG_DB_ENGINE=django.db.backends.postgresql_psycopg2 NABAZTAG_DB_NAME=nabaztag NABAZTAG_DB_USER=...
+# Connections are kept open for NABAZTAG_DB_CONN_MAX_AGE seconds and reused between requests.
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db/db.sqlite3'),
+        'ENGINE': os.environ.get('NABAZTAG_DB_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME': os.environ.get('NABAZTAG_DB_NAME', os.path.join(BASE_DIR, 'db/db.sqlite3')),
+        'USER': os.environ.get('NABAZTAG_DB_USER', ''),
+        'PASSWORD': os.environ.get('NABAZTAG_DB_PASSWORD', ''),
+        'HOST': os.environ.get('NABAZTAG_DB_HOST', ''),
+        'PORT': os.environ.get('NABAZTAG_DB_PORT', ''),
+        'CONN_MAX_AGE': int(os.environ.get('NABAZTAG_DB_CONN_MAX_AGE', 60)),
     }
 }
 
@@ -93,3 +138,7 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.6/howto/static-files/
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, "static/")
+
+# Media files (e.g. rendered speech), served by Nginx
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.path.join(BASE_DIR, "media/")
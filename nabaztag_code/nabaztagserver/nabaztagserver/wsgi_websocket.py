@@ -3,6 +3,7 @@ import gevent.monkey
 import redis.connection
 
 # This module is used by uWSGI to create the websocket server instance.
+# Updates sent by Nabaztags over their websocket are handled by the WS4REDIS_SUBSCRIBER set in settings.py
 
 redis.connection.socket = gevent.socket
 os.environ.update(DJANGO_SETTINGS_MODULE='nabaztagserver.settings')